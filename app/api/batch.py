@@ -0,0 +1,39 @@
+from typing import Dict, List
+
+from fastapi import HTTPException, status
+
+from app.config import BATCH_MAX_IDS
+
+
+def parse_ids(ids: str) -> List[int]:
+    """
+    parse comma separated ids of a batch read, order and duplicates are kept
+    :param ids: e.g. '3,1,2'
+    :return: list() or HTTPException(400)
+    """
+    try:
+        values = [int(value) for value in ids.split(',') if value.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Invalid ids'
+        )
+    if not values or len(values) > BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'From 1 to {BATCH_MAX_IDS} ids are expected'
+        )
+    return values
+
+
+def batch_items(ids: List[int], found: Dict[int, dict], name: str, error: str) -> List[dict]:
+    """
+    result of a batch read in the order of requested ids, missing ids get the error instead of failing the batch
+    :param ids: requested ids
+    :param found: rows by id
+    :param name: key of the row in an item
+    :param error: message of a missing id
+    :return: list() of {id, <name>, error}
+    """
+    return [{'id': item_id, name: found.get(item_id), 'error': None if item_id in found else error}
+            for item_id in ids]
@@ -0,0 +1,68 @@
+from typing import Callable
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+# statuses that must not have a body
+NO_BODY_STATUSES = {204, 304}
+
+
+def accepts_json(request: Request) -> bool:
+    """
+    check if Accept header of the request asks for application/json (media type parameters and case ignored,
+    q=0 means "not acceptable")
+    :param request:
+    :return: True or False
+    """
+    accept = request.headers.get('accept')
+    if not accept:
+        return False
+    for media_range in accept.split(','):
+        media_type, *params = media_range.split(';')
+        if media_type.strip().lower() != 'application/json':
+            continue
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def wrap_response(response: Response) -> Response:
+    """
+    put body of successful response into {payload, message, title, code} envelope,
+    serialized JSON payload is embedded as is without parsing
+    :param response:
+    :return: the same response with new body
+    """
+    status_code = response.status_code
+    payload = b'null'
+    if response.headers.get('content-type', '').startswith('application/json') and response.body:
+        payload = response.body
+    response.body = b''.join((b'{"payload":', payload, b',"message":"OK","title":null,"code":',
+                              str(status_code).encode(), b'}'))
+    response.headers['content-length'] = str(len(response.body))
+    response.headers['content-type'] = 'application/json'
+    return response
+
+
+class EnvelopeRoute(APIRoute):
+    """
+    Route wrapping successful responses into the API envelope for clients accepting application/json
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def envelope_handler(request: Request) -> Response:
+            response = await handler(request)
+            if response.status_code >= 300 or response.status_code in NO_BODY_STATUSES \
+                    or getattr(response, 'body', None) is None or not accepts_json(request):
+                return response
+            return wrap_response(response)
+
+        return envelope_handler
@@ -1,12 +1,13 @@
 from fastapi import APIRouter, Body
 from starlette import status
 
+from app.api.envelope import EnvelopeRoute
 from app.api.schema import RegistrationForm, AccessToken, Auth
 from app.api.security import create_access_token, verify_password, get_password_hash
 
 from app.db.repositories.users_repository import UserRepository
 
-router = APIRouter()
+router = APIRouter(route_class=EnvelopeRoute)
 
 
 @router.post('/auth', tags=["auth"], response_model=AccessToken)
@@ -16,7 +17,7 @@ async def authorize_user(request: Auth = Body(..., embed=True)):
     """
     user = await UserRepository.get_user(request.login, UserRepository.login,
                                          UserRepository.format_fields(UserRepository.login, UserRepository.hash))
-    verify_password(request.password, user['hash'])
+    await verify_password(request.password, user['hash'])
     jwt = create_access_token(data={"sub": user['login']})
     return {"access_token": jwt, "token_type": "bearer"}
 
@@ -26,7 +27,7 @@ async def registrate_new_user(user_form: RegistrationForm = Body(..., embed=True
     """
     Registration
     """
-    await UserRepository.create_user(user_form.login, get_password_hash(user_form.password),
+    await UserRepository.create_user(user_form.login, await get_password_hash(user_form.password),
                                      user_form.first_name, user_form.last_name)
     jwt = create_access_token(data={"sub": user_form.login})
     return {"access_token": jwt, "token_type": "bearer"}
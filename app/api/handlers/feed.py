@@ -1,62 +1,98 @@
-from typing import List
+from typing import List, Optional, Union
 
-from fastapi import APIRouter, UploadFile, status, Body, Depends
+from fastapi import APIRouter, UploadFile, status, Body, Depends, Query
 from fastapi.responses import Response
 
-from app.api.schema import PostCreate, Feed
+from app.api.response_cache import CachedRoute, cached, describe_posts
+from app.api.batch import batch_items, parse_ids
+from app.api.schema import PostCreate, Feed, FeedBatch, FeedPage
 from app.api.security import get_user_by_token, is_user_post
 
+from app.config import RESPONSE_CACHE_RECOMMENDED_TTL, FEED_MAX_LIMIT
+from app.db.loaders import MediaLoader, get_media_loader, attach_media
 from app.db.repositories.like_repository import LikeRepository
 from app.db.repositories.feed_repository import FeedRepository
 from app.db.repositories.media_repository import MediaRepository
+from app.db.repositories.timeline_repository import TimelineRepository
+from app.utils.response_cache import FEED, SEARCH
 
-router = APIRouter()
+router = APIRouter(route_class=CachedRoute)
 
 
 @router.get("/feed/recommended", tags=["posts"], response_model=List[Feed])
-async def get_recommended_feed(limit: int = 1):
+@cached(describe_posts, tags=[FEED], ttl=RESPONSE_CACHE_RECOMMENDED_TTL)
+async def get_recommended_feed(limit: int = Query(1, ge=1, le=FEED_MAX_LIMIT),
+                               loader: MediaLoader = Depends(get_media_loader)):
     """
     get recommended feed, sorted by likes
     """
     feed = await FeedRepository.get_recommended_posts(limit)
-    for post in feed:
-        if post['media_count'] > 0:
-            media = await MediaRepository.get_post_media(post['id'])
-            if media is False:
-                media = []
-            post['media'] = media
-        else:
-            post['media'] = []
-    return feed
+    return await attach_media(feed, loader)
+
+
+@router.get("/feed/home", tags=["posts"], response_model=FeedPage)
+async def get_home_feed(limit: int = Query(10, ge=1, le=FEED_MAX_LIMIT), cursor: Optional[str] = None,
+                        current_user: dict = Depends(get_user_by_token),
+                        loader: MediaLoader = Depends(get_media_loader)):
+    """
+    get home feed if authorized: own posts and posts of followed users, newest first as {items, next_cursor},
+    pass next_cursor to get the next page
+    """
+    feed, next_cursor = await TimelineRepository.get_home(current_user['id'], limit, cursor)
+    await attach_media(feed, loader)
+    return {'items': feed, 'next_cursor': next_cursor}
+
+
+@router.get("/feed/search", tags=["posts"], response_model=FeedPage)
+@cached(describe_posts, tags=[FEED, SEARCH])
+async def search_feed(q: str, limit: int = Query(10, ge=1, le=FEED_MAX_LIMIT), cursor: Optional[str] = None,
+                      loader: MediaLoader = Depends(get_media_loader)):
+    """
+    search posts by title and message, best matches first as {items, next_cursor},
+    pass next_cursor to get the next page
+
+    q supports web search syntax: words, "quoted phrases", or, -excluded words
+    """
+    feed, next_cursor = await FeedRepository.search_posts(q, limit, cursor)
+    await attach_media(feed, loader)
+    return {'items': feed, 'next_cursor': next_cursor}
 
 
 @router.get("/feed/{post_id}", tags=["posts"], response_model=Feed)
-async def get_post(post_id: int):
+@cached(describe_posts)
+async def get_post(post_id: int, loader: MediaLoader = Depends(get_media_loader)):
     """
     get post by id
     """
     feed = await FeedRepository.get_post(post_id)
-    if feed['media_count'] > 0:
-        media = await MediaRepository.get_post_media(post_id)
-        feed['media'] = media
-    else:
-        feed['media'] = []
+    await attach_media([feed], loader)
     return feed
 
 
-@router.get("/feed", tags=["posts"], response_model=List[Feed])
-async def get_feed(limit: int = 1, page: int = 0):
+@router.get("/feed", tags=["posts"], response_model=Union[FeedBatch, FeedPage, List[Feed]])
+@cached(describe_posts, tags=[FEED])
+async def get_feed(limit: int = Query(1, ge=1, le=FEED_MAX_LIMIT), page: int = Query(0, ge=0),
+                   cursor: Optional[str] = None, ids: Optional[str] = None, loader: MediaLoader = Depends(get_media_loader)):
     """
     get all feed by limit with paging(optional), page starts from 0
-    """
+
+    cursor mode: pass cursor (empty for the first page) to get newest posts first
+    as {items, next_cursor}, then pass next_cursor to get the next page
+
+    batch mode: pass comma separated ids to get the posts in their order as {items: [{id, post, error}]},
+    missing posts have post null and an error
+    """
+    if ids is not None:
+        post_ids = parse_ids(ids)
+        found = await FeedRepository.get_posts_by_ids(post_ids)
+        await attach_media(list(found.values()), loader)
+        return {'items': batch_items(post_ids, found, 'post', 'Post not found')}
+    if cursor is not None:
+        feed, next_cursor = await FeedRepository.get_posts_by_cursor(limit, cursor)
+        await attach_media(feed, loader)
+        return {'items': feed, 'next_cursor': next_cursor}
     feed = await FeedRepository.get_posts(limit, page)
-    for post in feed:
-        if post['media_count'] > 0:
-            media = await MediaRepository.get_post_media(post['id'])
-            post['media'] = media
-        else:
-            post['media'] = []
-    return feed
+    return await attach_media(feed, loader)
 
 
 @router.post("/feed", tags=["posts"], response_model=Feed, response_model_exclude_unset=True,
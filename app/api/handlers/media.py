@@ -0,0 +1,21 @@
+import mimetypes
+from typing import Optional
+
+from fastapi import APIRouter, Request, Response
+
+from app.api.media_response import file_response
+from app.db.repositories.media_repository import MediaRepository
+
+router = APIRouter()
+
+
+@router.get("/media/{media_id}", tags=["media"], response_class=Response)
+async def get_media(media_id: int, request: Request, size: Optional[int] = None):
+    """
+    download media file, supports Range and conditional (ETag, Last-Modified) requests,
+    size selects a resized copy by its max side (see media derivatives), the original is sent if there's no such copy
+    """
+    media = await MediaRepository.get_media_file(media_id, size)
+    etag = f'"{media["digest"]}"' if media['digest'] else None
+    media_type = mimetypes.guess_type(f'media{media["extension"]}')[0]
+    return file_response(request, media['uri'], media['size'], media['mtime_ns'], etag, media_type)
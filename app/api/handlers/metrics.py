@@ -0,0 +1,11 @@
+from fastapi import Request
+from fastapi.responses import PlainTextResponse
+
+from app.utils.metrics import registry
+
+
+async def get_metrics(request: Request):
+    """
+    metrics in Prometheus text format
+    """
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
@@ -1,15 +1,17 @@
-from fastapi import APIRouter, Body, status, Depends
-from fastapi.responses import Response
+from fastapi import APIRouter, Body, status, Depends, HTTPException
+from fastapi.responses import Response, ORJSONResponse
 
-from app.api.schema import ProfileSettings, User
-from app.api.security import get_password_hash, get_user_by_token, verify_password
+from app.api.envelope import EnvelopeRoute
+from app.api.schema import ProfileSettings, User, Job
+from app.api.security import get_login_by_token, get_password_hash, get_user_by_token, verify_password
+from app.config import ACCOUNT_DELETE_SYNC_LIMIT, JOB_STATUS_TTL
 from app.db.repositories.feed_repository import FeedRepository
-from app.db.repositories.like_repository import LikeRepository
-from app.db.repositories.media_repository import MediaRepository
 
 from app.db.repositories.users_repository import UserRepository
+from app.utils.jobs import JobRegistry
 
-router = APIRouter()
+router = APIRouter(route_class=EnvelopeRoute)
+account_deletions = JobRegistry(1000, JOB_STATUS_TTL)
 
 
 @router.get("/profile", response_model=User, tags=["profile"])
@@ -26,27 +28,46 @@ async def update_profile(user_info: ProfileSettings = Body(..., embed=True),
     """
     update profile info/settings if authorized
     """
-    verify_password(user_info.old_password, current_user['hash'])
+    await verify_password(user_info.old_password, await UserRepository.get_hash(current_user['id']))
     data = user_info.dict(exclude_none=True)
     if 'password' in data:
-        data['hash'] = get_password_hash(user_info.password)
+        data['hash'] = await get_password_hash(user_info.password)
         del data['password']
     del data['old_password']
     await UserRepository.update_data(current_user['id'], data)
     return Response()
 
 
-@router.delete("/profile", tags=["profile"], status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/profile", tags=["profile"], status_code=status.HTTP_204_NO_CONTENT,
+               responses={status.HTTP_202_ACCEPTED: {"model": Job}})
 async def delete_profile(password: str = Body(..., embed=True),
                          current_user: dict = Depends(get_user_by_token)):
     """
-    delete profile if authorized
+    delete profile if authorized,
+    accounts with many posts are deleted in background: 202 with job to check by /profile/deletion/{job_id},
+    repeated requests while the deletion runs return the same job
     """
-    verify_password(password, current_user['hash'])
-    posts = await FeedRepository.get_user_posts(current_user['id'])
-    for post in posts:
-        await MediaRepository.del_post_media(post['id'])
-        await FeedRepository.delete_post(post['id'])
-    await LikeRepository.delete_all_user_likes(current_user['id'])
-    await UserRepository.delete_user(current_user['id'])
+    await verify_password(password, await UserRepository.get_hash(current_user['id']))
+    job = account_deletions.running(current_user['id'])
+    if job is None and await FeedRepository.count_user_posts(current_user['id']) > ACCOUNT_DELETE_SYNC_LIMIT:
+        job = account_deletions.start(UserRepository.delete_account, current_user['id'],
+                                      key=current_user['id'], owner=current_user['login'])
+    if job is not None:
+        return ORJSONResponse(status_code=status.HTTP_202_ACCEPTED, content=Job(**job).dict())
+    await UserRepository.delete_account(current_user['id'])
     return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get("/profile/deletion/{job_id}", response_model=Job, tags=["profile"])
+async def get_profile_deletion(job_id: str, login: str = Depends(get_login_by_token)):
+    """
+    get status of background profile deletion (pending, running, done, failed) by the token of its owner,
+    the token stays valid for it after the account is deleted
+    """
+    job = account_deletions.get(job_id)
+    if job is None or job['owner'] != login:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Job not found'
+        )
+    return job
@@ -1,16 +1,77 @@
-from fastapi import APIRouter
+from typing import List
 
-from app.api.schema import User
+from fastapi import APIRouter, Depends, Query, Response, status
+
+from app.api.batch import batch_items, parse_ids
+from app.api.response_cache import CachedRoute, cached, describe_user, describe_users
+from app.api.schema import User, UserBatch
+from app.api.security import get_user_by_token
+from app.config import FEED_MAX_LIMIT
+from app.db.repositories.follow_repository import FollowRepository
+from app.db.repositories.timeline_repository import TimelineRepository
 from app.db.repositories.users_repository import UserRepository
 
-router = APIRouter()
+router = APIRouter(route_class=CachedRoute)
+
+
+@router.get("/users", response_model=UserBatch, tags=["users"],
+            response_model_exclude={'items': {'__all__': {'user': {'login'}}}})
+@cached(describe_users)
+async def get_users_by_ids(ids: str):
+    """
+    get users by comma separated ids in their order as {items: [{id, user, error}]},
+    missing users have user null and an error
+    """
+    user_ids = parse_ids(ids)
+    found = await UserRepository.get_users_by_ids(user_ids)
+    return {'items': batch_items(user_ids, found, 'user', 'User not found')}
 
 
 @router.get("/users/{user_id}", response_model=User, tags=["users"],
             response_model_exclude={'login'})
+@cached(describe_user)
 async def get_user_by_id(user_id: int = 1):
     """
     get user by id
     """
     user = await UserRepository.get_user(user_id)
     return user
+
+
+@router.get("/users/{user_id}/followers", response_model=List[User], tags=["users"],
+            response_model_exclude={'login'})
+async def get_followers(user_id: int, limit: int = Query(10, ge=1, le=FEED_MAX_LIMIT), page: int = Query(0, ge=0)):
+    """
+    get users following the user with paging, page starts from 0
+    """
+    return await FollowRepository.get_followers(user_id, limit, page)
+
+
+@router.get("/users/{user_id}/following", response_model=List[User], tags=["users"],
+            response_model_exclude={'login'})
+async def get_following(user_id: int, limit: int = Query(10, ge=1, le=FEED_MAX_LIMIT), page: int = Query(0, ge=0)):
+    """
+    get users followed by the user with paging, page starts from 0
+    """
+    return await FollowRepository.get_following(user_id, limit, page)
+
+
+@router.post("/users/{user_id}/follow", tags=["users"], status_code=status.HTTP_204_NO_CONTENT)
+async def follow_user(user_id: int, current_user: dict = Depends(get_user_by_token)):
+    """
+    follow the user if authorized, their latest posts are added to the home feed
+    """
+    followers = await FollowRepository.follow(current_user['id'], user_id)
+    if followers is not None:
+        await TimelineRepository.add_author(current_user['id'], user_id, followers)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.post("/users/{user_id}/unfollow", tags=["users"], status_code=status.HTTP_204_NO_CONTENT)
+async def unfollow_user(user_id: int, current_user: dict = Depends(get_user_by_token)):
+    """
+    unfollow the user if authorized, their posts are removed from the home feed
+    """
+    if await FollowRepository.unfollow(current_user['id'], user_id) is not None:
+        await TimelineRepository.remove_author(current_user['id'], user_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
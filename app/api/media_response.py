@@ -0,0 +1,145 @@
+import email.utils
+import mimetypes
+from typing import Optional, Tuple
+
+import anyio
+from fastapi import Request, Response, status
+from starlette.types import Receive, Scope, Send
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaFileResponse(Response):
+    """
+    Sends [start, start + length) bytes of a file.
+    Uses ASGI zero-copy extensions (http.response.zerocopysend, http.response.pathsend) when the server
+    supports them, otherwise reads the file by chunks in a worker thread
+    """
+
+    def __init__(self, path: str, start: int, length: int, status_code: int = status.HTTP_200_OK,
+                 headers: dict = None, media_type: str = None, full: bool = True):
+        self.path = path
+        self.start = start
+        self.length = length
+        self.full = full
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        headers = dict(headers or {})
+        headers['content-length'] = str(length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        extensions = scope.get('extensions') or {}
+        if scope['method'] == 'HEAD' or self.length == 0:
+            await send({'type': 'http.response.body', 'body': b''})
+        elif 'http.response.zerocopysend' in extensions:
+            with open(self.path, 'rb') as f:
+                await send({'type': 'http.response.zerocopysend', 'file': f,
+                            'offset': self.start, 'count': self.length})
+        elif self.full and 'http.response.pathsend' in extensions:
+            await send({'type': 'http.response.pathsend', 'path': self.path})
+        else:
+            async with await anyio.open_file(self.path, mode='rb') as f:
+                await f.seek(self.start)
+                remaining = self.length
+                while remaining > 0:
+                    chunk = await f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+                if remaining > 0:
+                    await send({'type': 'http.response.body', 'body': b''})
+
+
+def make_etag(size: int, mtime_ns: int) -> str:
+    return f'"{size:x}-{mtime_ns:x}"'
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    parse single range of Range header
+    :param header: value like bytes=0-99, bytes=100-, bytes=-100
+    :param size: file size
+    :return: (start, end) with inclusive end, None if the header has to be ignored,
+             (size, size) if the range is not satisfiable
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first == '':
+            suffix = int(last)
+            if suffix == 0:
+                return size, size
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start > end:
+        return None
+    if start >= size:
+        return size, size
+    return start, min(end, size - 1)
+
+
+def _matches(header: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def file_response(request: Request, path: str, size: int, mtime_ns: int, etag: str = None,
+                  media_type: str = None) -> Response:
+    """
+    build response for file with conditional (If-None-Match, If-Modified-Since) and Range requests support
+    :param request:
+    :param path:
+    :param size: bytes
+    :param mtime_ns: modification time
+    :param etag: strong validator, default is made from size and mtime
+    :param media_type: default is guessed by path
+    :return: 200, 206, 304 or 416 response
+    """
+    etag = etag or make_etag(size, mtime_ns)
+    mtime = mtime_ns // 1_000_000_000
+    last_modified = email.utils.formatdate(mtime, usegmt=True)
+    headers = {
+        'etag': etag,
+        'last-modified': last_modified,
+        'accept-ranges': 'bytes',
+        'cache-control': 'public, no-cache',
+    }
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if _matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    elif 'if-modified-since' in request.headers:
+        try:
+            since = email.utils.parsedate_to_datetime(request.headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and mtime <= since:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    media_type = media_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    byte_range = None
+    if 'range' in request.headers:
+        if_range = request.headers.get('if-range')
+        if if_range is None or if_range.strip() in (etag, last_modified):
+            byte_range = parse_range(request.headers['range'], size)
+    if byte_range is None:
+        return MediaFileResponse(path, 0, size, headers=headers, media_type=media_type)
+    start, end = byte_range
+    if start >= size:
+        headers['content-range'] = f'bytes */{size}'
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+    headers['content-range'] = f'bytes {start}-{end}/{size}'
+    return MediaFileResponse(path, start, end - start + 1, status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             headers=headers, media_type=media_type, full=False)
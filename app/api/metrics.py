@@ -0,0 +1,44 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.utils.metrics import registry
+
+in_flight = registry.gauge('http_requests_in_flight', 'Requests being served')
+requests_total = registry.counter('http_requests_total', 'Finished requests', ('method', 'route', 'status'))
+request_seconds = registry.histogram('http_request_duration_seconds', 'Time to serve a request',
+                                     ('method', 'route'))
+
+
+class MetricsMiddleware:
+    """
+    Counts requests by route template and status and observes their latency,
+    requests matching no route share the 'unmatched' route to keep labels bounded
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            # routes added by app.add_route() have no parameters and don't set scope['route']
+            route = scope.get('route')
+            path = route.path if route is not None else scope['path'] if 'endpoint' in scope else 'unmatched'
+            requests_total.inc(scope['method'], path, str(status))
+            request_seconds.observe(time.perf_counter() - started, scope['method'], path)
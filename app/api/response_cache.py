@@ -0,0 +1,143 @@
+import hashlib
+from typing import Any, Callable, FrozenSet, Hashable, Iterable, List, NamedTuple, Optional, Tuple
+
+import orjson
+from fastapi import Request, Response, status
+
+from app.api.envelope import EnvelopeRoute, accepts_json
+from app.utils.metrics import Counter, Metric, registry
+from app.utils.response_cache import CachedResponse, blob_tag, post_tag, response_cache, user_tag
+
+# payload -> tags of the response and data its ETag is derived from
+Describe = Callable[[Any], Tuple[Iterable[Hashable], Any]]
+
+
+class CachePolicy(NamedTuple):
+    describe: Describe
+    # tags added to every response of the route
+    tags: FrozenSet[Hashable] = frozenset()
+    # seconds, None is the cache's ttl
+    ttl: Optional[float] = None
+
+
+def cached(describe: Describe, tags: Iterable[Hashable] = (), ttl: Optional[float] = None):
+    """
+    mark GET endpoint of a router with CachedRoute to be served from the response cache
+    :param describe: gets tags and ETag data from the payload
+    :param tags: tags of every response of the endpoint
+    :param ttl: seconds, default is RESPONSE_CACHE_TTL
+    :return: decorator, put it under the router's one
+    """
+    def decorator(endpoint: Callable) -> Callable:
+        endpoint.cache_policy = CachePolicy(describe, frozenset(tags), ttl)
+        return endpoint
+
+    return decorator
+
+
+def describe_posts(payload) -> Tuple[List[tuple], List[tuple]]:
+    """
+    tags and ETag data of a post, list of posts, page {items, next_cursor} or batch {items: [{id, post, error}]}:
+    id, updated_at, likes and media_count of every post and ids of its media with their derivatives count
+    """
+    posts = payload['items'] if isinstance(payload, dict) and 'items' in payload else payload
+    if isinstance(posts, dict):
+        posts = [posts]
+    tags, version = [], []
+    for post in posts:
+        if 'error' in post:
+            # missing posts of a batch are versioned by id only
+            post = post['post'] or {'id': post['id']}
+        media = post.get('media') or []
+        tags.append(post_tag(post['id']))
+        tags.extend(blob_tag(item['uri']) for item in media)
+        version.append((post['id'], post.get('updated_at'), post.get('likes'), post.get('media_count'),
+                        [(item['id'], len(item.get('derivatives') or [])) for item in media]))
+    if isinstance(payload, dict) and 'items' in payload:
+        version.append(payload.get('next_cursor'))
+    return tags, version
+
+
+def describe_user(payload) -> Tuple[List[tuple], dict]:
+    """
+    tags and ETag data of a user, users have no updated_at, so the whole payload is used
+    """
+    return [user_tag(payload['id'])], payload
+
+
+def describe_users(payload) -> Tuple[List[tuple], dict]:
+    """
+    tags and ETag data of a batch of users {items: [{id, user, error}]}
+    """
+    return [user_tag(item['id']) for item in payload['items']], payload
+
+
+def make_etag(version) -> str:
+    return f'W/"{hashlib.blake2b(orjson.dumps(version), digest_size=12).hexdigest()}"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """
+    weak comparison of If-None-Match header with the ETag
+    :param header:
+    :param etag:
+    :return: True if the client has this version
+    """
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == opaque:
+            return True
+    return False
+
+
+class CachedRoute(EnvelopeRoute):
+    """
+    Route serving endpoints marked by cached() from the response cache: responses are stored serialized
+    (with the envelope if it's been added) and get ETag, If-None-Match is answered by 304
+    without calling the endpoint, other endpoints are served as by EnvelopeRoute
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        policy: Optional[CachePolicy] = getattr(self.endpoint, 'cache_policy', None)
+        if policy is None:
+            return handler
+
+        async def cached_handler(request: Request) -> Response:
+            envelope = accepts_json(request)
+            key = (self.path, request.url.path, tuple(sorted(request.query_params.multi_items())), envelope)
+            entry = response_cache.get(key)
+            if entry is None:
+                generation = response_cache.generation
+                response = await handler(request)
+                if response.status_code != status.HTTP_200_OK or not getattr(response, 'body', None):
+                    return response
+                payload = orjson.loads(response.body)
+                if envelope:
+                    payload = payload['payload']
+                tags, version = policy.describe(payload)
+                entry = CachedResponse(response.body, response.headers.get('content-type', 'application/json'),
+                                       make_etag(version), frozenset(tags) | policy.tags)
+                response_cache.set(key, entry, generation, policy.ttl)
+            if etag_matches(request.headers.get('if-none-match'), entry.etag):
+                response_cache.not_modified += 1
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'etag': entry.etag})
+            return Response(entry.body, media_type=entry.media_type, headers={'etag': entry.etag})
+
+        return cached_handler
+
+
+def collect_metrics() -> List[Metric]:
+    not_modified = Counter('response_cache_not_modified_total', 'Requests answered by 304 Not Modified')
+    invalidations = Counter('response_cache_invalidations_total', 'Invalidations of cached responses by changes')
+    not_modified.inc(amount=response_cache.not_modified)
+    invalidations.inc(amount=response_cache.invalidations)
+    return [not_modified, invalidations]
+
+
+registry.add_collector(collect_metrics)
@@ -41,6 +41,13 @@ class ProfileSettings(BaseModel):
     old_password: str = Field(min_length=8, max_length=128)
 
 
+class Derivative(BaseModel):
+    max_side: int
+    width: int
+    height: int
+    size: int
+
+
 class Media(BaseModel):
     id: str
     author_id: str
@@ -49,6 +56,7 @@ class Media(BaseModel):
     extension: str
     likes: int
     created_at: datetime.datetime
+    derivatives: List[Derivative] = []
 
 
 class Feed(BaseModel):
@@ -63,6 +71,47 @@ class Feed(BaseModel):
     media: List[Media] = []
 
 
+class FeedPage(BaseModel):
+    items: List[Feed] = []
+    next_cursor: Optional[str] = None
+
+
+class FeedBatchItem(BaseModel):
+    id: int
+    post: Optional[Feed] = None
+    error: Optional[str] = None
+
+    class Config:
+        # keeps pages and lists of posts from passing for a batch in Union response models
+        extra = 'forbid'
+
+
+class FeedBatch(BaseModel):
+    items: List[FeedBatchItem] = []
+
+    class Config:
+        extra = 'forbid'
+
+
+class UserBatchItem(BaseModel):
+    id: int
+    user: Optional[User] = None
+    error: Optional[str] = None
+
+
+class UserBatch(BaseModel):
+    items: List[UserBatchItem] = []
+
+
+class Job(BaseModel):
+    id: str
+    status: str
+    created_at: datetime.datetime
+    finished_at: Optional[datetime.datetime] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+
 class PostCreate(BaseModel):
     title: str
     message: str
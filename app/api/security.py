@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta
 
 from passlib.context import CryptContext
@@ -5,17 +6,26 @@ from fastapi import HTTPException, status, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, JWTError
 
-from app.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from app.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, TOKEN_CACHE_SIZE, \
+    PASSWORD_HASH_WORKERS, PASSWORD_HASH_CONCURRENCY, PASSWORD_HASH_QUEUE_TIMEOUT
 
 from app.db.repositories.feed_repository import FeedRepository
 from app.db.repositories.users_repository import UserRepository
+from app.utils.cache import TTLCache
+from app.utils.metrics import registry
+from app.utils.password_hasher import PasswordHasher
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher(pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_CONCURRENCY,
+                                 PASSWORD_HASH_QUEUE_TIMEOUT)
+registry.add_collector(password_hasher.collect_metrics)
 security = HTTPBearer()
+# login by access token, entries expire with the token
+token_cache = TTLCache(TOKEN_CACHE_SIZE, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
 
 
-def verify_password(plain_password: str, hashed_password: str):
-    res = pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str):
+    res = await password_hasher.verify(plain_password, hashed_password)
     if not res:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -23,8 +33,8 @@ def verify_password(plain_password: str, hashed_password: str):
         )
 
 
-def get_password_hash(password: str):
-    return pwd_context.hash(password)
+async def get_password_hash(password: str):
+    return await password_hasher.hash(password)
 
 
 def create_access_token(data: dict):
@@ -36,11 +46,16 @@ def create_access_token(data: dict):
 
 
 def verify_token(token: str, credentials_exception):
+    login = token_cache.get(token)
+    if login is not None:
+        return login
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         login: str = payload.get("sub")
         if login is None:
             raise credentials_exception
+        if "exp" in payload:
+            token_cache.set(token, login, ttl=payload["exp"] - time.time())
         return login
     except JWTError:
         raise credentials_exception
@@ -66,9 +81,13 @@ def auth_check(access_token: str):
     return login
 
 
+async def get_login_by_token(access_token: HTTPAuthorizationCredentials = Security(security)):
+    return auth_check(access_token.credentials)
+
+
 async def get_user_by_token(access_token: HTTPAuthorizationCredentials = Security(security)):
     login = auth_check(access_token.credentials)
-    user = await UserRepository.get_user(login, UserRepository.login)
+    user = await UserRepository.get_user_by_login(login)
     return user
 
 
@@ -0,0 +1,58 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.db.instrumentation import RequestStats, end_request, start_request
+from app.utils.log_settings import log
+
+
+class ServerTimingMiddleware:
+    """
+    Collects statements sent to the database by every request, reports them in Server-Timing header
+    and logs N+1 suspects: requests over the statements budget or repeating one statement
+    """
+
+    def __init__(self, app: ASGIApp, budget: int, repeat_limit: int, header: bool = True):
+        self.app = app
+        self.budget = budget
+        self.repeat_limit = repeat_limit
+        self.header = header
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        stats, token = start_request()
+        started = time.perf_counter()
+
+        async def send_with_timing(message: Message):
+            if message['type'] == 'http.response.start' and self.header:
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', self.header_value(stats, started).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            end_request(token)
+            self.check(scope, stats)
+
+    @staticmethod
+    def header_value(stats: RequestStats, started: float) -> str:
+        total = (time.perf_counter() - started) * 1000
+        return f'db;dur={stats.db_time * 1000:.3f};desc="{stats.queries} queries", total;dur={total:.3f}'
+
+    def check(self, scope: Scope, stats: RequestStats):
+        """
+        log the request if it looks like N+1 queries
+        :param scope:
+        :param stats:
+        :return:
+        """
+        repeated = stats.repeated(self.repeat_limit)
+        if stats.queries <= self.budget and not repeated:
+            return
+        details = ''.join(f'; {count}x {shape[:200]}' for shape, count in repeated[:3])
+        log.warning(f"N+1 suspect {scope['method']} {scope['path']}: {stats.queries} queries "
+                    f"in {stats.db_time * 1000:.1f} ms{details}")
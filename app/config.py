@@ -9,6 +9,21 @@ ALGORITHM = 'HS256'
 # secret key for cash
 SECRET_KEY = os.environ.get('SECRET_KEY', config('SECRET_KEY', cast=str, default=""))
 
+# logging
+LOG_LEVEL = config('LOG_LEVEL', cast=str, default='INFO')
+LOG_FILE = config('LOG_FILE', cast=str, default='aesn.log')
+LOG_FILE_LEVEL = config('LOG_FILE_LEVEL', cast=str, default='WARNING')
+# the file is rotated when it grows over the size, 0 disables rotation
+LOG_FILE_MAX_BYTES = config('LOG_FILE_MAX_BYTES', cast=int, default=50 * 1024 * 1024)
+LOG_FILE_BACKUPS = config('LOG_FILE_BACKUPS', cast=int, default=5)
+# records waiting for the writer thread, records over it are dropped
+LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', cast=int, default=10000)
+# records written at once
+LOG_BATCH_SIZE = config('LOG_BATCH_SIZE', cast=int, default=500)
+# client errors (4xx) logged per second for each status, 0 logs all of them
+LOG_EXPECTED_ERRORS_RATE = config('LOG_EXPECTED_ERRORS_RATE', cast=float, default=5.0)
+LOG_EXPECTED_ERRORS_BURST = config('LOG_EXPECTED_ERRORS_BURST', cast=int, default=20)
+
 # data_path
 """
 path to media storage, if DATA_PATH not found -> use 'static' directory in root dir
@@ -18,3 +33,120 @@ DATA_PATH = config('DATA_PATH', cast=str, default=path)
 
 # database
 DATABASE_URL = os.environ.get('DATABASE_URL', config('DATABASE_URL', cast=str)).replace("s://", "sql://", 1)
+
+# database pool
+DB_POOL_MIN_SIZE = config('DB_POOL_MIN_SIZE', cast=int, default=2)
+DB_POOL_MAX_SIZE = config('DB_POOL_MAX_SIZE', cast=int, default=10)
+# seconds to wait for a free connection before answering 503
+DB_POOL_ACQUIRE_TIMEOUT = config('DB_POOL_ACQUIRE_TIMEOUT', cast=float, default=5.0)
+# seconds after which an idle connection is closed
+DB_POOL_MAX_INACTIVE_LIFETIME = config('DB_POOL_MAX_INACTIVE_LIFETIME', cast=float, default=300.0)
+DB_COMMAND_TIMEOUT = config('DB_COMMAND_TIMEOUT', cast=float, default=30.0)
+# apply schema migrations at startup, otherwise only report pending ones (python -m app.db.migrations)
+DB_MIGRATE_ON_STARTUP = config('DB_MIGRATE_ON_STARTUP', cast=bool, default=True)
+
+# database instrumentation
+# statements per request above which the request is logged as an N+1 suspect
+DB_QUERY_BUDGET = config('DB_QUERY_BUDGET', cast=int, default=20)
+# times one statement may be repeated in a request before it's logged as an N+1 suspect
+DB_REPEATED_QUERY_LIMIT = config('DB_REPEATED_QUERY_LIMIT', cast=int, default=5)
+# add Server-Timing header with database time and statements count to responses
+SERVER_TIMING_HEADER = config('SERVER_TIMING_HEADER', cast=bool, default=True)
+
+# metrics (/metrics)
+# seconds between event loop lag samples, 0 disables sampling
+METRICS_LOOP_LAG_INTERVAL = config('METRICS_LOOP_LAG_INTERVAL', cast=float, default=0.5)
+
+# feed pages
+# max items per page of /feed, /feed/recommended, /feed/home, /feed/search and users' followers/following,
+# bigger or non-positive limits get 422
+FEED_MAX_LIMIT = config('FEED_MAX_LIMIT', cast=int, default=100)
+
+# recommended feed
+# posts kept in memory for /feed/recommended, bigger limits are read from database
+RECOMMENDED_INDEX_SIZE = config('RECOMMENDED_INDEX_SIZE', cast=int, default=1000)
+# seconds between reseeding the index from database, bounds staleness across workers
+RECOMMENDED_REFRESH_INTERVAL = config('RECOMMENDED_REFRESH_INTERVAL', cast=float, default=60.0)
+
+# home feed (/feed/home)
+# posts of authors with up to this many followers are written to followers' timelines,
+# posts of authors with more are merged in when the home feed is read
+FEED_FANOUT_MAX_FOLLOWERS = config('FEED_FANOUT_MAX_FOLLOWERS', cast=int, default=10000)
+# newest entries kept in every timeline, older ones are removed by a periodic job
+FEED_TIMELINE_SIZE = config('FEED_TIMELINE_SIZE', cast=int, default=1000)
+# seconds between timeline trims, 0 disables the job
+FEED_TIMELINE_TRIM_INTERVAL = config('FEED_TIMELINE_TRIM_INTERVAL', cast=float, default=3600.0)
+# users whose timelines are trimmed by one statement
+FEED_TIMELINE_TRIM_BATCH = config('FEED_TIMELINE_TRIM_BATCH', cast=int, default=500)
+# latest posts of an author added to the timeline on follow
+FEED_FOLLOW_BACKFILL = config('FEED_FOLLOW_BACKFILL', cast=int, default=50)
+# seconds between repairs of users' followers counters, 0 disables the job
+FOLLOWERS_RECONCILE_INTERVAL = config('FOLLOWERS_RECONCILE_INTERVAL', cast=float, default=600.0)
+
+# likes
+# seconds between repairs of posts' likes counters, 0 disables the job, it's always off with LIKES_WRITE_BEHIND
+LIKES_RECONCILE_INTERVAL = config('LIKES_RECONCILE_INTERVAL', cast=float, default=600.0)
+# posts locked and recounted by one transaction of the repair
+LIKES_RECONCILE_BATCH = config('LIKES_RECONCILE_BATCH', cast=int, default=1000)
+# buffer likes counters in memory and write them in batches (for viral posts)
+LIKES_WRITE_BEHIND = config('LIKES_WRITE_BEHIND', cast=bool, default=False)
+# seconds between flushes of buffered likes counters
+LIKES_FLUSH_INTERVAL = config('LIKES_FLUSH_INTERVAL', cast=float, default=1.0)
+# buffered like/unlike events that trigger a flush before the interval
+LIKES_FLUSH_MAX_PENDING = config('LIKES_FLUSH_MAX_PENDING', cast=int, default=1000)
+
+# authentication caches
+# user rows without password hash by login, invalidated only on the worker that changed the user:
+# other workers may serve a changed profile or a deleted user's token for up to USER_CACHE_TTL seconds,
+# password checks always read the hash from the database
+USER_CACHE_SIZE = config('USER_CACHE_SIZE', cast=int, default=10000)
+USER_CACHE_TTL = config('USER_CACHE_TTL', cast=float, default=60.0)
+# decoded access tokens, kept until the token expires
+TOKEN_CACHE_SIZE = config('TOKEN_CACHE_SIZE', cast=int, default=10000)
+
+# response cache of read routes (posts, feed listings, users)
+# entries are dropped on changes made by this worker, ttl bounds staleness between workers
+RESPONSE_CACHE_SIZE = config('RESPONSE_CACHE_SIZE', cast=int, default=10000)
+RESPONSE_CACHE_TTL = config('RESPONSE_CACHE_TTL', cast=float, default=30.0)
+# /feed/recommended is reordered by likes of posts it doesn't show yet, so it's kept shorter
+RESPONSE_CACHE_RECOMMENDED_TTL = config('RESPONSE_CACHE_RECOMMENDED_TTL', cast=float, default=5.0)
+
+# batch reads (/feed?ids=, /users?ids=)
+BATCH_MAX_IDS = config('BATCH_MAX_IDS', cast=int, default=100)
+
+# password hashing
+# threads running bcrypt
+PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', cast=int, default=4)
+# hashing calls running at once, others are queued
+PASSWORD_HASH_CONCURRENCY = config('PASSWORD_HASH_CONCURRENCY', cast=int, default=4)
+# seconds a call waits in queue before 503
+PASSWORD_HASH_QUEUE_TIMEOUT = config('PASSWORD_HASH_QUEUE_TIMEOUT', cast=float, default=2.0)
+
+# media upload
+# max size of one uploaded file in bytes
+MEDIA_MAX_FILE_SIZE = config('MEDIA_MAX_FILE_SIZE', cast=int, default=20 * 1024 * 1024)
+# bytes copied at once while saving uploads
+MEDIA_CHUNK_SIZE = config('MEDIA_CHUNK_SIZE', cast=int, default=1024 * 1024)
+# media id -> file info lookups kept for downloads
+MEDIA_FILE_CACHE_SIZE = config('MEDIA_FILE_CACHE_SIZE', cast=int, default=10000)
+MEDIA_FILE_CACHE_TTL = config('MEDIA_FILE_CACHE_TTL', cast=float, default=300.0)
+
+# media derivatives (resized copies of images)
+# max side of every derivative in pixels, empty disables derivatives
+DERIVATIVE_SIZES = config('DERIVATIVE_SIZES', cast=lambda v: [int(s) for s in str(v).split(',') if s.strip()],
+                          default='320,1080')
+# processes resizing images
+DERIVATIVE_WORKERS = config('DERIVATIVE_WORKERS', cast=int, default=2)
+# resize jobs waiting for a worker, jobs over it are dropped
+DERIVATIVE_QUEUE_SIZE = config('DERIVATIVE_QUEUE_SIZE', cast=int, default=1000)
+DERIVATIVE_QUALITY = config('DERIVATIVE_QUALITY', cast=int, default=85)
+# seconds between sweeps queueing blobs still without derivatives (e.g. dropped on a full queue), 0 disables it
+DERIVATIVE_SWEEP_INTERVAL = config('DERIVATIVE_SWEEP_INTERVAL', cast=float, default=300.0)
+
+# account deletion
+# accounts with more posts are deleted by a background job
+ACCOUNT_DELETE_SYNC_LIMIT = config('ACCOUNT_DELETE_SYNC_LIMIT', cast=int, default=500)
+# seconds a finished job's status is kept, in memory of the worker which runs the job:
+# status is per-process only and lost on restart, a deletion interrupted by a crash is rolled back
+# (it runs in one transaction) and DELETE /profile has to be repeated
+JOB_STATUS_TTL = config('JOB_STATUS_TTL', cast=float, default=3600.0)
@@ -1,62 +1,398 @@
+import asyncio
+import contextvars
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
 import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
 from fastapi import HTTPException, status
 
-from app.config import DATABASE_URL
-from app.utils.create_db import add_all_tables
+from app.config import DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT, \
+    DB_POOL_MAX_INACTIVE_LIFETIME, DB_COMMAND_TIMEOUT, DB_MIGRATE_ON_STARTUP
+from app.db import instrumentation
+from app.db.instrumentation import QueryTimer, affected_rows
+from app.db.migrations import migrate, check_schema
+from app.utils.log_settings import log
+from app.utils.metrics import Counter, Gauge, Metric, registry
+from app.utils.response_cache import response_cache
+from app.utils.single_flight import SingleFlight
+
+# connection pinned to the current task by DB.connection(), shared by nested repository calls
+_scoped_connection: contextvars.ContextVar = contextvars.ContextVar('db_connection', default=None)
+acquire_seconds = registry.histogram('db_pool_acquire_seconds', 'Time waited for a pooled connection',
+                                     buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+
+class PreparedConnection(asyncpg.connection.Connection):
+    """
+    pooled connection keeping its prepared statements of the registry (DB.statements) by key
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Dict[str, PreparedStatement] = {}
 
 
 class DB:
-    con: asyncpg.connection.Connection = None
-    tablesCount: int = 4
+    pool: asyncpg.pool.Pool = None
+    # pool counters, always updated through DB (not cls) so every repository shares them
+    waiting: int = 0
+    acquire_timeouts: int = 0
+    # SQL of all repositories by 'Repository.name', prepared on every pooled connection
+    statements: Dict[str, str] = {}
+    # columns update_row() may change
+    updatable: frozenset = frozenset()
+    # concurrent identical reads of coalesce(), shared by every repository
+    flights: SingleFlight = SingleFlight()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, sql in cls.build_statements().items():
+            DB.statements[f'{cls.__name__}.{name}'] = sql
 
     @staticmethod
     def format_fields(*args):
         return ','.join(args)
 
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        """
+        fixed SQL of the repository, built once at import
+        :return: dict() name -> sql
+        """
+        return {}
+
+    @classmethod
+    def register(cls, name: str, build: Callable[[], str]) -> str:
+        """
+        add a statement built on demand, one per variant of a dynamic query
+        :param name: unique within the repository
+        :param build: returns sql, called only if the name isn't registered yet
+        :return: name
+        """
+        key = f'{cls.__name__}.{name}'
+        if key not in DB.statements:
+            DB.statements[key] = build()
+        return name
+
     @classmethod
     async def connect_db(cls):
         """
-        Connect to database or create new database by repositories
-        :return: True or False
+        Bring schema up to date and create connection pool to database
+        :return:
         """
+        await cls.connect_tables()
         try:
-            cls.con = await asyncpg.connect(DATABASE_URL)
+            DB.pool = await asyncpg.create_pool(DATABASE_URL,
+                                                min_size=DB_POOL_MIN_SIZE,
+                                                max_size=DB_POOL_MAX_SIZE,
+                                                max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                                                command_timeout=DB_COMMAND_TIMEOUT,
+                                                connection_class=PreparedConnection,
+                                                init=cls.init_connection)
         except Exception as er:
-            cls.con = None
+            DB.pool = None
             raise HTTPException(
                 status_code=status.HTTP_504_GATEWAY_TIMEOUT,
                 detail='Connection to database is failed'
             )
-        await cls.connect_tables()
+
+    @staticmethod
+    async def init_connection(con: PreparedConnection):
+        """
+        set up a new pooled connection and prepare registered statements on it
+        :param con:
+        :return:
+        """
+        await con.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+        for key, sql in list(DB.statements.items()):
+            try:
+                con.prepared[key] = await con.prepare(sql)
+            except asyncpg.PostgresError as er:
+                log.warning(f'statement {key} is not prepared: {er}')
 
     @classmethod
     async def connect_tables(cls):
         """
-        connect to tables in db, create if found 0, else raise ConnectionRefusedError
-        :return: True, False, ConnectionRefusedError
+        apply pending migrations (app/db/migrations.py) or, if DB_MIGRATE_ON_STARTUP is off,
+        only report what's missing. Runs on its own connection before the pool prepares statements
+        :return:
         """
         try:
-            a = await cls.con.fetch("select table_name from information_schema.tables where table_schema='public'")
+            con = await asyncpg.connect(DATABASE_URL)
+            try:
+                if DB_MIGRATE_ON_STARTUP:
+                    await migrate(con)
+                report = await check_schema(con)
+            finally:
+                await con.close()
         except Exception as er:
-            await cls.disconnect_db()
+            log.critical(er, exc_info=True)
             raise HTTPException(
                 status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-                detail='Connection to database is failed'
+                detail='Connection to tables is failed'
             )
-        if len(a) != cls.tablesCount:
-            try:
-                add_all_tables(DATABASE_URL)
-            except Exception as er:
-                await cls.disconnect_db()
-                raise HTTPException(
-                    status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-                    detail='Connection to tables is failed'
-                )
+        for key in ('pending', 'missing_indexes', 'invalid_indexes'):
+            if report[key]:
+                log.warning(f"schema {key.replace('_', ' ')}: {', '.join(map(str, report[key]))}")
 
     @classmethod
     async def disconnect_db(cls):
         """
-        disconnect from database
+        close all connections of the pool
         :return:
         """
-        await cls.con.close()
+        if DB.pool is not None:
+            await DB.pool.close()
+            DB.pool = None
+
+    @classmethod
+    @asynccontextmanager
+    async def connection(cls):
+        """
+        acquire a connection from the pool and pin it to the current task,
+        repository calls inside the block reuse it instead of acquiring their own.
+        Don't run concurrent queries (asyncio.gather) inside the block: they would share one connection
+        :return: asyncpg connection
+        """
+        con = _scoped_connection.get()
+        if con is not None:
+            yield con
+            return
+        DB.waiting += 1
+        started = time.perf_counter()
+        try:
+            con = await DB.pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            DB.acquire_timeouts += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Database is busy, try again later'
+            )
+        finally:
+            DB.waiting -= 1
+            acquire_seconds.observe(time.perf_counter() - started)
+        token = _scoped_connection.set(con)
+        try:
+            yield con
+        finally:
+            _scoped_connection.reset(token)
+            await DB.pool.release(con)
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls):
+        """
+        run the block in one transaction on a scoped connection
+        :return: asyncpg connection
+        """
+        async with cls.connection() as con:
+            async with con.transaction():
+                yield con
+
+    # every helper below times its statement (app/db/instrumentation.py)
+
+    @classmethod
+    async def fetch(cls, sql: str, *args):
+        async with cls.connection() as con:
+            with QueryTimer(sql) as timer:
+                res = await con.fetch(sql, *args)
+                timer.rows = len(res)
+            return res
+
+    @classmethod
+    async def fetchrow(cls, sql: str, *args):
+        async with cls.connection() as con:
+            with QueryTimer(sql) as timer:
+                res = await con.fetchrow(sql, *args)
+                timer.rows = int(res is not None)
+            return res
+
+    @classmethod
+    async def fetchval(cls, sql: str, *args):
+        async with cls.connection() as con:
+            with QueryTimer(sql) as timer:
+                res = await con.fetchval(sql, *args)
+                timer.rows = int(res is not None)
+            return res
+
+    @classmethod
+    async def execute(cls, sql: str, *args):
+        async with cls.connection() as con:
+            with QueryTimer(sql) as timer:
+                res = await con.execute(sql, *args)
+                timer.rows = affected_rows(res)
+            return res
+
+    @classmethod
+    async def executemany(cls, sql: str, args):
+        async with cls.connection() as con:
+            with QueryTimer(sql):
+                return await con.executemany(sql, args)
+
+    @classmethod
+    async def prepared(cls, con: PreparedConnection, name: str) -> PreparedStatement:
+        """
+        registered statement of the repository prepared on the connection, prepared now if it's new there
+        :param con:
+        :param name:
+        :return: PreparedStatement
+        """
+        key = f'{cls.__name__}.{name}'
+        stmt = con.prepared.get(key)
+        if stmt is None:
+            stmt = con.prepared[key] = await con.prepare(DB.statements[key])
+        return stmt
+
+    @classmethod
+    async def fetch_named(cls, name: str, *args) -> List[asyncpg.Record]:
+        async with cls.connection() as con:
+            with QueryTimer(f'{cls.__name__}.{name}') as timer:
+                res = await (await cls.prepared(con, name)).fetch(*args)
+                timer.rows = len(res)
+            return res
+
+    @classmethod
+    async def fetchrow_named(cls, name: str, *args) -> Optional[asyncpg.Record]:
+        async with cls.connection() as con:
+            with QueryTimer(f'{cls.__name__}.{name}') as timer:
+                res = await (await cls.prepared(con, name)).fetchrow(*args)
+                timer.rows = int(res is not None)
+            return res
+
+    @classmethod
+    async def fetchval_named(cls, name: str, *args) -> Any:
+        async with cls.connection() as con:
+            with QueryTimer(f'{cls.__name__}.{name}') as timer:
+                res = await (await cls.prepared(con, name)).fetchval(*args)
+                timer.rows = int(res is not None)
+            return res
+
+    @classmethod
+    async def execute_named(cls, name: str, *args) -> str:
+        """
+        run registered statement
+        :param name:
+        :param args:
+        :return: status, e.g. 'UPDATE 1'
+        """
+        async with cls.connection() as con:
+            with QueryTimer(f'{cls.__name__}.{name}') as timer:
+                stmt = await cls.prepared(con, name)
+                await stmt.fetch(*args)
+                res = stmt.get_statusmsg()
+                timer.rows = affected_rows(res)
+            return res
+
+    @classmethod
+    async def executemany_named(cls, name: str, args):
+        async with cls.connection() as con:
+            with QueryTimer(f'{cls.__name__}.{name}'):
+                return await (await cls.prepared(con, name)).executemany(args)
+
+    @classmethod
+    async def coalesce(cls, fetch: Callable[..., Awaitable], name: str, *args) -> Any:
+        """
+        run a read of registered statement once for all concurrent callers with the same arguments,
+        every caller gets the same result (records are immutable) or exception.
+        Reads on a scoped connection (inside transaction()) aren't shared, they have to see its changes
+        :param fetch: fetch_named, fetchrow_named or fetchval_named of the repository
+        :param name:
+        :param args: list arguments are compared by their items
+        :return: result of fetch
+        """
+        if _scoped_connection.get() is not None:
+            return await fetch(name, *args)
+        key = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        return await DB.flights.do(f'{cls.__name__}.{name}', key, fetch, name, *args)
+
+    @classmethod
+    async def update_row(cls, row_id: int, data: dict) -> str:
+        """
+        update whitelisted columns of the row by id, one statement per combination of columns
+        :param row_id:
+        :param data: dict of values for updating in the format (field:value)
+        :return: status or HTTPException(400) if a field isn't in cls.updatable
+        """
+        fields = sorted(data)
+        unknown = set(fields) - cls.updatable
+        if len(unknown) > 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Fields can't be updated: {', '.join(sorted(unknown))}"
+            )
+        if len(fields) == 0:
+            return 'UPDATE 0'
+
+        def build():
+            sets = cls.format_fields(*(f'{field}=${i}' for i, field in enumerate(fields, 1)))
+            return f'update {cls.table_name} set {sets} where {cls.id}=${len(fields) + 1}'
+
+        name = cls.register('update:' + ','.join(fields), build)
+        return await cls.execute_named(name, *(data[field] for field in fields), row_id)
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        """
+        current pool usage
+        :return: dict()
+        """
+        if DB.pool is None:
+            return {}
+        size = DB.pool.get_size()
+        idle = DB.pool.get_idle_size()
+        max_size = DB.pool.get_max_size()
+        return {
+            'min_size': DB.pool.get_min_size(),
+            'max_size': max_size,
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'waiting': DB.waiting,
+            'acquire_timeouts': DB.acquire_timeouts,
+            'saturation': round((size - idle) / max_size, 3) if max_size else 0.0,
+        }
+
+    @classmethod
+    def collect_metrics(cls) -> Iterable[Metric]:
+        """
+        pool usage and statement totals for /metrics, built at scrape time,
+        statements are labelled by registered name, totals of raw SQL are summed under 'other'
+        :return: list of metrics
+        """
+        pool_stats = cls.pool_stats()
+        pool = Gauge('db_pool_connections', 'Connections of the pool by state', ('state',))
+        for state, key in (('open', 'size'), ('idle', 'idle'), ('in_use', 'in_use'), ('max', 'max_size')):
+            pool.set(pool_stats.get(key, 0), state)
+        waiting = Gauge('db_pool_waiting', 'Tasks waiting for a pooled connection')
+        waiting.set(DB.waiting)
+        timeouts = Counter('db_pool_acquire_timeouts_total', 'Pool acquires that timed out')
+        timeouts.inc(amount=DB.acquire_timeouts)
+        calls = Counter('db_statement_calls_total', 'Statements sent', ('statement',))
+        errors = Counter('db_statement_errors_total', 'Statements failed', ('statement',))
+        seconds = Counter('db_statement_seconds_total', 'Time spent in statements', ('statement',))
+        max_seconds = Gauge('db_statement_max_seconds', 'Slowest run of the statement', ('statement',))
+        rows = Counter('db_statement_rows_total', 'Rows returned or affected', ('statement',))
+        flight_runs = Counter('db_coalesced_runs_total', 'Reads sent by coalesce()', ('statement',))
+        flight_shared = Counter('db_coalesced_shared_total', 'Reads of coalesce() served by a concurrent identical one',
+                                ('statement',))
+        flight_errors = Counter('db_coalesced_errors_total', 'Failed reads of coalesce()', ('statement',))
+        for shape, stats in list(instrumentation.statements.items()):
+            label = shape if shape in DB.statements else 'other'
+            calls.inc(label, amount=stats.calls)
+            errors.inc(label, amount=stats.errors)
+            seconds.inc(label, amount=stats.total)
+            max_seconds.set(max(stats.max, max_seconds.values.get((label,), 0)), label)
+            rows.inc(label, amount=stats.rows)
+        for shape, (runs, shared, failed) in list(DB.flights.counts.items()):
+            flight_runs.inc(shape, amount=runs)
+            flight_shared.inc(shape, amount=shared)
+            flight_errors.inc(shape, amount=failed)
+        return [pool, waiting, timeouts, calls, errors, seconds, max_seconds, rows,
+                flight_runs, flight_shared, flight_errors]
+
+
+registry.add_collector(DB.collect_metrics)
+# reads started before a change aren't shared with reads made after it
+response_cache.add_listener(DB.flights.forget)
@@ -0,0 +1,156 @@
+import asyncio
+import datetime
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Set
+
+from app.config import DERIVATIVE_SIZES, DERIVATIVE_WORKERS, DERIVATIVE_QUEUE_SIZE, DERIVATIVE_QUALITY, \
+    DERIVATIVE_SWEEP_INTERVAL
+from app.db.repositories.blob_repository import BlobRepository
+from app.utils.images import make_derivatives
+from app.utils.log_settings import log
+from app.utils.metrics import Counter, Gauge, Metric, registry
+from app.utils.tasks import PeriodicTask
+
+
+class DerivativePipeline:
+    """
+    Background resizing of uploaded images.
+
+    Jobs (blob digest and path, no image data) wait in a bounded queue, when it's full new jobs are dropped
+    and the periodic sweep queues blobs still without derivatives again. Each consumer task keeps one job
+    in the process pool, so at most `workers` images are decoded at once
+    """
+
+    def __init__(self, sizes: List[int], workers: int, queue_size: int, quality: int, sweep_interval: float):
+        self.sizes = sizes
+        self.workers = workers
+        self.queue_size = queue_size
+        self.quality = quality
+        self.sweep_interval = sweep_interval
+        self._sweep = PeriodicTask(self.sweep, sweep_interval)
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._consumers: List[asyncio.Task] = []
+        self._pending: Set[str] = set()
+        # metrics
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.requeued = 0
+
+    @property
+    def running(self) -> bool:
+        return self._queue is not None
+
+    def start(self):
+        if self.running or self.workers <= 0 or len(self.sizes) == 0:
+            return
+        if importlib.util.find_spec('PIL') is None:
+            log.warning('Pillow is not installed, media derivatives are disabled')
+            return
+        self._queue = asyncio.Queue(self.queue_size)
+        # fork would copy the locks of threads already running (password hashing, threadpool, log writer)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        self._consumers = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        self._sweep.start()
+
+    async def stop(self):
+        await self._sweep.stop()
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._queue = None
+        self._pending.clear()
+
+    def submit(self, digest: str, uri: str) -> bool:
+        """
+        queue derivatives of the blob, never waits
+        :param digest:
+        :param uri: path of the original
+        :return: True if queued
+        """
+        if not self.running or digest in self._pending:
+            return False
+        try:
+            self._queue.put_nowait((digest, uri))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self._pending.add(digest)
+        self.submitted += 1
+        return True
+
+    async def sweep(self):
+        """
+        queue blobs without derivatives up to free space of the queue, blobs newer than the sweep interval
+        are skipped since their jobs may still be queued in some worker
+        :return: count of queued jobs
+        """
+        free = self.queue_size - self._queue.qsize() if self.running else 0
+        if free <= 0:
+            return 0
+        before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.sweep_interval)
+        count = 0
+        for digest, uri in await BlobRepository.get_pending_derivatives(free, before):
+            if self.submit(digest, uri):
+                count += 1
+        self.requeued += count
+        if count > 0:
+            log.info(f'{count} blobs without derivatives have been queued again')
+        return count
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            digest, uri = await self._queue.get()
+            try:
+                derivatives = await loop.run_in_executor(self._executor, make_derivatives, uri, self.sizes,
+                                                         self.quality)
+                await BlobRepository.set_derivatives(digest, derivatives)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                log.warning(e, exc_info=True)
+            finally:
+                self._pending.discard(digest)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self.running else 0,
+            'queue_size': self.queue_size,
+            'workers': self.workers,
+            'submitted': self.submitted,
+            'dropped': self.dropped,
+            'completed': self.completed,
+            'failed': self.failed,
+            'requeued': self.requeued,
+        }
+
+    def collect_metrics(self) -> List[Metric]:
+        """
+        queue depth and jobs for /metrics, built at scrape time
+        :return: list of metrics
+        """
+        queued = Gauge('derivative_jobs_queued', 'Resize jobs waiting for a worker')
+        queued.set(self._queue.qsize() if self.running else 0)
+        jobs = Counter('derivative_jobs_total', 'Resize jobs by outcome', ('outcome',))
+        for outcome, count in (('submitted', self.submitted), ('dropped', self.dropped),
+                               ('completed', self.completed), ('failed', self.failed),
+                               ('requeued', self.requeued)):
+            jobs.inc(outcome, amount=count)
+        return [queued, jobs]
+
+
+derivative_pipeline = DerivativePipeline(DERIVATIVE_SIZES, DERIVATIVE_WORKERS, DERIVATIVE_QUEUE_SIZE,
+                                         DERIVATIVE_QUALITY, DERIVATIVE_SWEEP_INTERVAL)
+registry.add_collector(derivative_pipeline.collect_metrics)
@@ -0,0 +1,101 @@
+import contextvars
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+
+class StatementStats:
+    """
+    Totals of one statement shape (registered name or SQL text) since start
+    """
+    __slots__ = ('calls', 'errors', 'total', 'max', 'rows')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def as_dict(self) -> dict:
+        return {'calls': self.calls, 'errors': self.errors, 'total_ms': round(self.total * 1000, 3),
+                'max_ms': round(self.max * 1000, 3), 'rows': self.rows}
+
+
+class RequestStats:
+    """
+    Statements sent while serving one request, shared by all tasks the request spawns
+    """
+    __slots__ = ('queries', 'db_time', 'shapes')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes: Counter = Counter()
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """
+        statement shapes sent at least threshold times, the most frequent first
+        """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+# shape -> totals of every statement sent through the DB helpers
+statements: Dict[str, StatementStats] = {}
+_request_stats: contextvars.ContextVar = contextvars.ContextVar('db_request_stats', default=None)
+
+
+def start_request() -> Tuple[RequestStats, contextvars.Token]:
+    stats = RequestStats()
+    return stats, _request_stats.set(stats)
+
+
+def end_request(token: contextvars.Token):
+    _request_stats.reset(token)
+
+
+def current_request() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+class QueryTimer:
+    """
+    Times the statement in the with block and adds it to the statement's totals and the current request,
+    set rows inside the block
+    """
+    __slots__ = ('shape', 'rows', 'started')
+
+    def __init__(self, shape: str):
+        self.shape = shape
+        self.rows = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        stats = statements.get(self.shape)
+        if stats is None:
+            stats = statements[self.shape] = StatementStats()
+        stats.calls += 1
+        stats.total += elapsed
+        stats.rows += self.rows
+        if elapsed > stats.max:
+            stats.max = elapsed
+        if exc_type is not None:
+            stats.errors += 1
+        request = _request_stats.get()
+        if request is not None:
+            request.queries += 1
+            request.db_time += elapsed
+            request.shapes[self.shape] += 1
+        return False
+
+
+def affected_rows(status: str) -> int:
+    """
+    rows count of a command status like 'UPDATE 3' or 'INSERT 0 1'
+    """
+    count = status.rsplit(' ', 1)[-1] if status else ''
+    return int(count) if count.isdigit() else 0
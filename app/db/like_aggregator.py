@@ -0,0 +1,126 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Set
+
+from app.utils.log_settings import log
+from app.utils.metrics import Counter, Gauge, Histogram, Metric
+from app.utils.tasks import PeriodicTask
+
+
+class LikeAggregator:
+    """
+    Write-behind buffer for posts' likes counters.
+
+    Like/unlike events are folded into net deltas per post and written by one batched statement
+    every interval seconds or when max_pending events are buffered.
+    Deltas not flushed before a crash are lost. The periodic reconciliation is off in this mode,
+    since it would count buffered deltas twice, run LikeRepository.reconcile_likes while writers are stopped
+    """
+
+    def __init__(self, write: Callable[[Dict[int, int]], Awaitable], interval: float, max_pending: int):
+        self.write = write
+        self.max_pending = max_pending
+        self._deltas: Dict[int, int] = {}
+        self._events = 0
+        self._lock = asyncio.Lock()
+        self._periodic = PeriodicTask(self.flush, interval)
+        self._flushes: Set[asyncio.Task] = set()
+        # metrics
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.flushed_posts = 0
+        self.flushed_events = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.flush_seconds = Histogram('likes_flush_seconds', 'Time of writing buffered likes counters',
+                                       buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+    def add(self, post_id: int, delta: int):
+        """
+        buffer a change of the post's likes counter
+        :param post_id:
+        :param delta:
+        :return:
+        """
+        self._deltas[post_id] = self._deltas.get(post_id, 0) + delta
+        self._events += 1
+        if self._events >= self.max_pending and not self._lock.locked():
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning(task.exception())
+
+    async def flush(self):
+        """
+        write buffered deltas, on error they are put back to the buffer
+        :return:
+        """
+        async with self._lock:
+            deltas, events = self._deltas, self._events
+            self._deltas, self._events = {}, 0
+            deltas = {post_id: delta for post_id, delta in deltas.items() if delta != 0}
+            if len(deltas) == 0:
+                return
+            start = time.perf_counter()
+            try:
+                await self.write(deltas)
+            except Exception:
+                self.flush_errors += 1
+                for post_id, delta in deltas.items():
+                    self._deltas[post_id] = self._deltas.get(post_id, 0) + delta
+                self._events += events
+                raise
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                self.last_flush_ms = elapsed
+                self.max_flush_ms = max(self.max_flush_ms, elapsed)
+                self.total_flush_ms += elapsed
+                self.flush_seconds.observe(elapsed / 1000)
+            self.flush_count += 1
+            self.flushed_posts += len(deltas)
+            self.flushed_events += events
+
+    def start(self):
+        self._periodic.start()
+
+    async def stop(self):
+        """
+        stop periodic flushing and write what's left in the buffer
+        :return:
+        """
+        await self._periodic.stop()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'pending_posts': len(self._deltas),
+            'pending_events': self._events,
+            'flushes': self.flush_count,
+            'flush_errors': self.flush_errors,
+            'flushed_posts': self.flushed_posts,
+            'flushed_events': self.flushed_events,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'avg_flush_ms': round(self.total_flush_ms / self.flush_count, 3) if self.flush_count else 0.0,
+        }
+
+    def collect_metrics(self) -> List[Metric]:
+        """
+        buffer depth and flushes for /metrics, built at scrape time
+        :return: list of metrics
+        """
+        pending = Gauge('likes_buffer_pending', 'Buffered likes counters changes', ('unit',))
+        pending.set(len(self._deltas), 'posts')
+        pending.set(self._events, 'events')
+        errors = Counter('likes_flush_errors_total', 'Flushes of likes counters that failed')
+        errors.inc(amount=self.flush_errors)
+        flushed = Counter('likes_flushed_events_total', 'Like/unlike events written by flushes')
+        flushed.inc(amount=self.flushed_events)
+        return [pending, errors, flushed, self.flush_seconds]
@@ -0,0 +1,82 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from app.db.repositories.media_repository import MediaRepository
+
+
+class MediaLoader:
+    """
+    Request-scoped batcher for post media (DataLoader pattern):
+    load() calls made during the same event loop iteration are coalesced
+    into one MediaRepository.get_posts_media query, results are memoized per post
+    """
+
+    def __init__(self):
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._queue: List[int] = []
+        # pending dispatch, the reference keeps the task alive until it runs
+        self._task: Optional[asyncio.Task] = None
+
+    def load(self, post_id: int) -> asyncio.Future:
+        """
+        get media of the post, the lookup is sent together with other pending ones
+        :param post_id:
+        :return: future of list()
+        """
+        future = self._futures.get(post_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[post_id] = future
+            self._queue.append(post_id)
+            if self._task is None:
+                self._task = loop.create_task(self._dispatch())
+        return future
+
+    async def load_many(self, post_ids: List[int]) -> List[list]:
+        """
+        get media of several posts by one query
+        :param post_ids:
+        :return: list() of media lists in the order of post_ids
+        """
+        return list(await asyncio.gather(*(self.load(post_id) for post_id in post_ids)))
+
+    async def _dispatch(self):
+        # one more loop iteration to collect loads of other tasks of the request
+        await asyncio.sleep(0)
+        post_ids, self._queue, self._task = self._queue, [], None
+        try:
+            media = await MediaRepository.get_posts_media(post_ids)
+        except Exception as e:
+            for post_id in post_ids:
+                future = self._futures.pop(post_id)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for post_id in post_ids:
+            future = self._futures[post_id]
+            if not future.done():
+                future.set_result(media.get(post_id, []))
+
+
+def get_media_loader() -> MediaLoader:
+    """
+    dependency, FastAPI caches it per request so every handler dependency shares one loader
+    """
+    return MediaLoader()
+
+
+async def attach_media(posts: List[dict], loader: MediaLoader) -> List[dict]:
+    """
+    fill 'media' of every post, posts without media don't hit the database
+    :param posts:
+    :param loader:
+    :return: posts
+    """
+    with_media = [post for post in posts if post['media_count'] > 0]
+    media = await loader.load_many([post['id'] for post in with_media])
+    for post in posts:
+        post['media'] = []
+    for post, post_media in zip(with_media, media):
+        post['media'] = post_media
+    return posts
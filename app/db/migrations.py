@@ -0,0 +1,201 @@
+"""
+Versioned schema migrations, applied through asyncpg at startup.
+
+Every migration is idempotent and recorded in aesn_schema_version after it has been applied.
+Tables come from app/db/models.py, indexes are declared here and created concurrently.
+
+Check mode (reports pending migrations, missing and invalid indexes, exit code 1 if any):
+    python -m app.db.migrations --check
+"""
+import asyncio
+import datetime
+import sys
+from typing import Awaitable, Callable, List, NamedTuple, Tuple
+
+import asyncpg
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from app.db.models import Base, POST_SEARCH_DOCUMENT
+from app.utils.log_settings import log
+
+VERSION_TABLE = 'aesn_schema_version'
+# pg_advisory_lock key serializing migrations of several workers
+LOCK_KEY = 7253601
+
+
+class Index(NamedTuple):
+    name: str
+    table: str
+    columns: Tuple[str, ...]
+    unique: bool = False
+    method: str = 'btree'
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[asyncpg.connection.Connection], Awaitable]
+    # False for statements that can't run inside a transaction (create index concurrently)
+    transactional: bool = True
+
+
+INDEXES = [
+    Index('ux_aesn_likes_user_id_post_id', 'aesn_likes', ('user_id', 'post_id'), unique=True),
+    Index('ix_aesn_media_post_id', 'aesn_media', ('post_id',)),
+    Index('ix_aesn_media_digest', 'aesn_media', ('digest',)),
+    Index('ix_aesn_feed_author_id', 'aesn_feed', ('author_id',)),
+    Index('ix_aesn_feed_likes_id', 'aesn_feed', ('likes', 'id')),
+    Index('ix_aesn_feed_created_at_id', 'aesn_feed', ('created_at', 'id')),
+]
+# follow graph and home timelines
+TIMELINE_INDEXES = [
+    Index('ix_aesn_follows_followee_id', 'aesn_follows', ('followee_id', 'follower_id')),
+    Index('ix_aesn_timelines_user_id_created_at', 'aesn_timelines', ('user_id', 'created_at', 'post_id')),
+    Index('ix_aesn_timelines_post_id', 'aesn_timelines', ('post_id',)),
+    Index('ix_aesn_feed_author_id_created_at', 'aesn_feed', ('author_id', 'created_at', 'id')),
+]
+# full-text search of posts (/feed/search)
+SEARCH_INDEXES = [
+    Index('ix_aesn_feed_search', 'aesn_feed', (f'({POST_SEARCH_DOCUMENT})',), method='gin'),
+]
+
+
+async def create_index(con: asyncpg.connection.Connection, index: Index):
+    """
+    create index concurrently, an invalid index left by a failed build is dropped first
+    :param con:
+    :param index:
+    :return:
+    """
+    valid = await con.fetchval('select i.indisvalid from pg_index i join pg_class c on c.oid=i.indexrelid '
+                               'where c.relname=$1', index.name)
+    if valid:
+        return
+    if valid is not None:
+        await con.execute(f'drop index concurrently if exists {index.name}')
+    unique = 'unique ' if index.unique else ''
+    await con.execute(f'create {unique}index concurrently if not exists {index.name} '
+                      f'on {index.table} using {index.method}({",".join(index.columns)})')
+
+
+async def create_tables(con: asyncpg.connection.Connection):
+    for table in Base.metadata.sorted_tables:
+        await con.execute(str(CreateTable(table, if_not_exists=True).compile(dialect=postgresql.dialect())))
+
+
+async def add_media_store_columns(con: asyncpg.connection.Connection):
+    # tables created before the content-addressed media store and derivatives
+    await con.execute('alter table aesn_media add column if not exists digest varchar '
+                      'references aesn_blobs(digest)')
+    await con.execute('alter table aesn_blobs add column if not exists derivatives jsonb')
+
+
+async def add_unique_likes(con: asyncpg.connection.Connection):
+    await con.execute('delete from aesn_likes a using aesn_likes b '
+                      'where a.user_id=b.user_id and a.post_id=b.post_id and a.id>b.id')
+    await create_index(con, INDEXES[0])
+
+
+async def add_indexes(con: asyncpg.connection.Connection):
+    for index in INDEXES[1:]:
+        await create_index(con, index)
+
+
+async def add_timelines(con: asyncpg.connection.Connection):
+    await create_tables(con)
+    await con.execute('alter table aesn_users add column if not exists followers integer not null default 0')
+    for index in TIMELINE_INDEXES:
+        await create_index(con, index)
+
+
+async def add_search_index(con: asyncpg.connection.Connection):
+    for index in SEARCH_INDEXES:
+        await create_index(con, index)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'create tables', create_tables),
+    Migration(2, 'media store columns', add_media_store_columns),
+    Migration(3, 'unique likes', add_unique_likes, transactional=False),
+    Migration(4, 'hot path indexes', add_indexes, transactional=False),
+    Migration(5, 'follow graph and home timelines', add_timelines, transactional=False),
+    Migration(6, 'posts full-text search index', add_search_index, transactional=False),
+]
+
+
+async def applied_versions(con: asyncpg.connection.Connection) -> List[int]:
+    exists = await con.fetchval('select to_regclass($1) is not null', VERSION_TABLE)
+    if not exists:
+        return []
+    return [row['version'] for row in await con.fetch(f'select version from {VERSION_TABLE} order by version')]
+
+
+async def migrate(con: asyncpg.connection.Connection) -> List[int]:
+    """
+    apply pending migrations, concurrent workers wait for each other on an advisory lock
+    :param con: connection outside of a transaction
+    :return: applied versions
+    """
+    await con.execute(f'create table if not exists {VERSION_TABLE}('
+                      f'version integer primary key, name varchar not null, applied_at timestamp not null)')
+    await con.execute('select pg_advisory_lock($1)', LOCK_KEY)
+    try:
+        done = set(await applied_versions(con))
+        applied = []
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            log.info(f'applying migration {migration.version}: {migration.name}')
+            record = f'insert into {VERSION_TABLE}(version, name, applied_at) values ($1,$2,$3)'
+            if migration.transactional:
+                async with con.transaction():
+                    await migration.apply(con)
+                    await con.execute(record, migration.version, migration.name, datetime.datetime.utcnow())
+            else:
+                await migration.apply(con)
+                await con.execute(record, migration.version, migration.name, datetime.datetime.utcnow())
+            applied.append(migration.version)
+        return applied
+    finally:
+        await con.execute('select pg_advisory_unlock($1)', LOCK_KEY)
+
+
+async def check_schema(con: asyncpg.connection.Connection) -> dict:
+    """
+    compare database with migrations
+    :param con:
+    :return: dict(version, pending, missing_indexes, invalid_indexes)
+    """
+    done = await applied_versions(con)
+    indexes = INDEXES + TIMELINE_INDEXES + SEARCH_INDEXES
+    rows = await con.fetch('select c.relname, i.indisvalid from pg_index i join pg_class c on c.oid=i.indexrelid '
+                           'where c.relname=any($1::text[])', [index.name for index in indexes])
+    found = {row['relname']: row['indisvalid'] for row in rows}
+    return {
+        'version': max(done, default=0),
+        'pending': [migration.version for migration in MIGRATIONS if migration.version not in done],
+        'missing_indexes': [index.name for index in indexes if index.name not in found],
+        'invalid_indexes': [name for name, valid in found.items() if not valid],
+    }
+
+
+async def main(argv: List[str]) -> int:
+    from app.config import DATABASE_URL
+
+    con = await asyncpg.connect(DATABASE_URL)
+    try:
+        if '--check' not in argv:
+            await migrate(con)
+        report = await check_schema(con)
+    finally:
+        await con.close()
+    print(f"schema version: {report['version']}")
+    for key in ('pending', 'missing_indexes', 'invalid_indexes'):
+        if report[key]:
+            print(f"{key.replace('_', ' ')}: {', '.join(map(str, report[key]))}")
+    return 1 if report['pending'] or report['missing_indexes'] or report['invalid_indexes'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(sys.argv[1:])))
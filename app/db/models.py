@@ -1,11 +1,17 @@
 from sqlalchemy import (
-    Column, DateTime, ForeignKey, Integer, String, Text,
+    BigInteger, Column, DateTime, ForeignKey, Integer, String, Text,
 )
+from sqlalchemy.dialects.postgresql import JSONB
 import datetime
 
 from sqlalchemy.ext.declarative import declarative_base
 
+# tables are created by app/db/migrations.py, indexes are declared there
 Base = declarative_base()
+# text search document of a post, the GIN index of app/db/migrations.py is built on this expression
+# and queries have to repeat it as is to use the index
+POST_SEARCH_DOCUMENT = "setweight(to_tsvector('english', coalesce(title, '')), 'A') || " \
+                       "setweight(to_tsvector('english', coalesce(message, '')), 'B')"
 
 
 class Post(Base):
@@ -31,6 +37,8 @@ class User(Base):
     first_name = Column(String, default='Noname')
     last_name = Column(String, default='User')
     created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # authors with many followers aren't fanned out to timelines, see TimelineRepository
+    followers = Column(Integer, nullable=False, server_default='0')
 
 
 class Media(Base):
@@ -42,6 +50,17 @@ class Media(Base):
     extension = Column(String, default='.png')
     likes = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    digest = Column(String, ForeignKey('aesn_blobs.digest'))
+
+
+class Blob(Base):
+    __tablename__ = 'aesn_blobs'
+    digest = Column(String, primary_key=True)
+    uri = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    refs = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    derivatives = Column(JSONB)
 
 
 class Likes(Base):
@@ -50,3 +69,22 @@ class Likes(Base):
     user_id = Column(Integer, ForeignKey('aesn_users.id'))
     post_id = Column(Integer, ForeignKey('aesn_feed.id'))
     media_id = Column(Integer, ForeignKey('aesn_media.id'))
+
+
+class Follow(Base):
+    __tablename__ = 'aesn_follows'
+    follower_id = Column(Integer, ForeignKey('aesn_users.id', ondelete='CASCADE'), primary_key=True)
+    followee_id = Column(Integer, ForeignKey('aesn_users.id', ondelete='CASCADE'), primary_key=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+
+class Timeline(Base):
+    """
+    materialized home feed: posts of followed authors (and user's own) fanned out on write
+    """
+    __tablename__ = 'aesn_timelines'
+    user_id = Column(Integer, ForeignKey('aesn_users.id', ondelete='CASCADE'), primary_key=True)
+    post_id = Column(Integer, ForeignKey('aesn_feed.id', ondelete='CASCADE'), primary_key=True)
+    author_id = Column(Integer, nullable=False)
+    # created_at of the post
+    created_at = Column(DateTime, nullable=False)
@@ -0,0 +1,243 @@
+import datetime
+import hashlib
+import os
+import uuid
+from typing import BinaryIO, Dict, List, Tuple
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+
+from app.config import DATA_PATH, MEDIA_CHUNK_SIZE
+from app.db.base import DB
+from app.utils.response_cache import blob_tag, response_cache
+from app.utils.tasks import BackgroundQueue
+
+
+class BlobRepository(DB):
+    """
+    Content-addressed media store: every file is kept once under its sha256 digest
+    and reference-counted by aesn_media rows.
+    Reference changes have to run inside a transaction. Files of unreferenced blobs are removed later
+    by the cleanup queue under the digest's advisory lock and only if the blob hasn't been added again,
+    acquire() stores files under the same lock. Files stored by a transaction that rolls back are removed
+    the same way (rollback_garbage())
+    """
+    table_name: str = 'aesn_blobs'
+    digest = 'digest'
+    uri = 'uri'
+    size = 'size'
+    refs = 'refs'
+    created_at = 'created_at'
+    derivatives = 'derivatives'
+    root: str = os.path.join(DATA_PATH, 'objects')
+    # removal of files of unreferenced blobs and other deferred filesystem work
+    cleanup: BackgroundQueue = BackgroundQueue()
+
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        create_fields = cls.format_fields(cls.digest, cls.uri, cls.size, cls.refs, cls.created_at)
+        return {
+            'lock': 'select pg_advisory_xact_lock(hashtextextended(d, 0)) '
+                    'from (select d from unnest($1::text[]) d order by d) s',
+            'acquire': f'insert into {cls.table_name}({create_fields}) '
+                       f'select d, u, s, n, $5 from unnest($1::text[],$2::text[],$3::bigint[],$4::int[]) '
+                       f'as t(d,u,s,n) on conflict ({cls.digest}) '
+                       f'do update set {cls.refs}={cls.table_name}.{cls.refs}+excluded.{cls.refs} '
+                       f'returning {cls.digest},{cls.uri},{cls.derivatives} is null as pending',
+            'release': f'update {cls.table_name} b set {cls.refs}=b.{cls.refs}-t.n '
+                       f'from unnest($1::text[],$2::int[]) as t(d,n) where b.{cls.digest}=t.d',
+            'delete_unreferenced': f'delete from {cls.table_name} where {cls.digest}=any($1::text[]) '
+                                   f'and {cls.refs}<=0 returning {cls.digest},{cls.uri},{cls.derivatives}',
+            'is_existed_blob': f'select exists(select 1 from {cls.table_name} where {cls.digest}=$1)',
+            'set_derivatives': f'update {cls.table_name} set {cls.derivatives}=$2 where {cls.digest}=$1 '
+                               f'returning {cls.uri}',
+            'pending_derivatives': f'select {cls.digest},{cls.uri} from {cls.table_name} '
+                                   f'where {cls.derivatives} is null and {cls.created_at}<$2 limit $1',
+        }
+
+    @classmethod
+    def blob_uri(cls, digest: str) -> str:
+        return os.path.join(cls.root, digest[:2], digest)
+
+    @staticmethod
+    def hash_file(src: BinaryIO, max_size: int) -> Tuple[str, int]:
+        """
+        read file by chunks and count its sha256 (blocking)
+        :param src:
+        :param max_size: bytes, HTTPException(413) if the file is bigger
+        :return: digest, size
+        """
+        src.seek(0)
+        digest = hashlib.sha256()
+        size = 0
+        while True:
+            chunk = src.read(MEDIA_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f'Media file has to be less than {max_size} bytes'
+                )
+            digest.update(chunk)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    def store_file(src: BinaryIO, uri: str) -> bool:
+        """
+        copy file by chunks to uri if it doesn't exist yet (blocking), the file appears atomically
+        :param src:
+        :param uri:
+        :return: True if the file has been written
+        """
+        if os.path.exists(uri):
+            return False
+        os.makedirs(os.path.dirname(uri), exist_ok=True)
+        tmp_uri = f'{uri}.{uuid.uuid4().hex}.tmp'
+        src.seek(0)
+        try:
+            with open(tmp_uri, mode='wb') as f:
+                while True:
+                    chunk = src.read(MEDIA_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(tmp_uri, uri)
+        except BaseException:
+            if os.path.exists(tmp_uri):
+                os.remove(tmp_uri)
+            raise
+        return True
+
+    @staticmethod
+    def remove_files(uris: List[str]):
+        """
+        remove files, missing ones are skipped (blocking)
+        :param uris:
+        :return:
+        """
+        for uri in uris:
+            try:
+                os.remove(uri)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    async def lock(cls, digests: List[str]):
+        """
+        lock digests till the end of the current transaction, in sorted order to avoid deadlocks
+        :param digests:
+        :return:
+        """
+        digests = sorted(set(digests))
+        if len(digests) > 0:
+            await cls.execute_named('lock', digests)
+
+    @classmethod
+    async def acquire(cls, files: List[Tuple[str, int, BinaryIO]]) -> Dict[str, Tuple[str, bool]]:
+        """
+        add references to blobs and store files of new blobs, has to run inside a transaction
+        :param files: list of (digest, size, file)
+        :return: dict() digest -> (uri, True if derivatives haven't been made)
+        """
+        if len(files) == 0:
+            return {}
+        await cls.lock([digest for digest, _, _ in files])
+        counts: Dict[str, int] = {}
+        sources: Dict[str, Tuple[int, BinaryIO]] = {}
+        for digest, size, src in files:
+            counts[digest] = counts.get(digest, 0) + 1
+            sources[digest] = size, src
+        digests = list(counts)
+        res = await cls.fetch_named('acquire', digests, [cls.blob_uri(digest) for digest in digests],
+                                    [sources[digest][0] for digest in digests],
+                                    [counts[digest] for digest in digests], datetime.datetime.utcnow())
+        blobs = {row[cls.digest]: (row[cls.uri], row['pending']) for row in res}
+        for digest, (uri, _) in blobs.items():
+            await run_in_threadpool(cls.store_file, sources[digest][1], uri)
+        return blobs
+
+    @classmethod
+    async def release(cls, digests: List[str]) -> List[Tuple[str, List[str]]]:
+        """
+        remove references to blobs and delete unreferenced blobs, has to run inside a transaction,
+        pass the result to schedule_removal() after commit. Digests are locked here, a caller
+        acquiring other ones in the same transaction has to lock all of them first
+        :param digests: one item per reference
+        :return: list of (digest, files) of deleted blobs
+        """
+        if len(digests) == 0:
+            return []
+        await cls.lock(digests)
+        counts: Dict[str, int] = {}
+        for digest in digests:
+            counts[digest] = counts.get(digest, 0) + 1
+        await cls.execute_named('release', list(counts), list(counts.values()))
+        res = await cls.fetch_named('delete_unreferenced', list(counts))
+        garbage = []
+        for row in res:
+            uris = [row[cls.uri]] + [derivative['uri'] for derivative in row[cls.derivatives] or []]
+            garbage.append((row[cls.digest], uris))
+        return garbage
+
+    @classmethod
+    def rollback_garbage(cls, digests: List[str]) -> List[Tuple[str, List[str]]]:
+        """
+        files acquire() may have stored in a transaction that has been rolled back, pass the result
+        to schedule_removal(), files of blobs that exist (or have been added again meanwhile) are kept
+        :param digests: digests passed to acquire()
+        :return: list of (digest, files)
+        """
+        return [(digest, [cls.blob_uri(digest)]) for digest in sorted(set(digests))]
+
+    @classmethod
+    def schedule_removal(cls, garbage: List[Tuple[str, List[str]]]):
+        """
+        queue removal of files of deleted blobs
+        :param garbage: result of release()
+        :return:
+        """
+        for digest, uris in garbage:
+            cls.cleanup.submit(cls.remove_unreferenced, digest, uris)
+
+    @classmethod
+    async def remove_unreferenced(cls, digest: str, uris: List[str]):
+        """
+        remove files of the blob if it hasn't been added again
+        :param digest:
+        :param uris:
+        :return:
+        """
+        async with cls.transaction():
+            await cls.lock([digest])
+            if not await cls.fetchval_named('is_existed_blob', digest):
+                await run_in_threadpool(cls.remove_files, uris)
+
+    @classmethod
+    async def get_pending_derivatives(cls, limit: int, before: datetime.datetime) -> List[Tuple[str, str]]:
+        """
+        blobs whose derivatives haven't been made (e.g. their job has been dropped)
+        :param limit:
+        :param before: only blobs created before it, newer ones may still be queued
+        :return: list of (digest, uri)
+        """
+        res = await cls.fetch_named('pending_derivatives', limit, before)
+        return [(row[cls.digest], row[cls.uri]) for row in res]
+
+    @classmethod
+    async def set_derivatives(cls, digest: str, derivatives: List[dict]):
+        """
+        save made derivatives of the blob, their files are removed if the blob has been deleted meanwhile
+        :param digest:
+        :param derivatives: list of dict(max_side, width, height, size, uri)
+        :return:
+        """
+        async with cls.transaction():
+            await cls.lock([digest])
+            uri = await cls.fetchval_named('set_derivatives', digest, derivatives)
+            if uri is None:
+                await run_in_threadpool(cls.remove_files, [derivative['uri'] for derivative in derivatives])
+        if uri is not None:
+            # media of posts showing the blob get the derivatives
+            response_cache.invalidate(blob_tag(uri))
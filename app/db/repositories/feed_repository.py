@@ -1,8 +1,15 @@
+import base64
+import binascii
 import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 from fastapi import HTTPException, status
 
+from app.config import RECOMMENDED_INDEX_SIZE
 from app.db.base import DB
+from app.db.models import POST_SEARCH_DOCUMENT
+from app.db.top_posts import TopPostsIndex
+from app.utils.response_cache import FEED, SEARCH, post_tag, response_cache
 
 
 class FeedRepository(DB):
@@ -15,11 +22,43 @@ class FeedRepository(DB):
     likes = 'likes'
     created_at = 'created_at'
     updated_at = 'updated_at'
+    # top posts by likes served by /feed/recommended
+    recommended: TopPostsIndex = TopPostsIndex(RECOMMENDED_INDEX_SIZE)
+    # writes a new post (post_id, author_id, created_at) to home timelines, set by TimelineRepository
+    fan_out: Optional[Callable[[int, int, datetime.datetime], Awaitable]] = None
+    updatable = frozenset((title, message, updated_at))
+
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        create_fields = cls.format_fields(cls.author_id, cls.title, cls.message, cls.media_count, cls.likes,
+                                          cls.created_at, cls.updated_at)
+        return {
+            'create_post': f'insert into {cls.table_name}({create_fields}) '
+                           f'values ($1,$2,$3,$4,$5,$6,$7) returning {cls.id}',
+            'delete_post': f'delete from {cls.table_name} where {cls.id}=$1',
+            'count_user_posts': f'select count(*) from {cls.table_name} where {cls.author_id}=$1',
+            'top_posts': f'select * from {cls.table_name} order by {cls.likes} desc, {cls.id} desc limit $1',
+            'search_first_page': cls.search_sql(False),
+            'search_after_cursor': cls.search_sql(True),
+        }
+
+    @classmethod
+    def search_sql(cls, after_cursor: bool) -> str:
+        """
+        posts matching the query ranked by ts_rank, matches are found by the GIN index on POST_SEARCH_DOCUMENT
+        :param after_cursor: add ($3, $4) cursor condition
+        :return: sql with $1 query, $2 limit
+        """
+        after = 'where (rank,id) < ($3::real,$4) ' if after_cursor else ''
+        return f'select * from (select {cls.table_name}.*, ts_rank({POST_SEARCH_DOCUMENT}, q) as rank ' \
+               f'from {cls.table_name}, websearch_to_tsquery(\'english\', $1) q ' \
+               f'where ({POST_SEARCH_DOCUMENT}) @@ q) s ' \
+               f'{after}order by rank desc, {cls.id} desc limit $2'
 
     @classmethod
     async def create_post(cls, author_id: int, title: str, message: str):
         """
-        add post to db
+        add post to db and fan it out to home timelines in the same transaction
         :param author_id:
         :param title:
         :param message:
@@ -27,11 +66,13 @@ class FeedRepository(DB):
         """
         time = datetime.datetime.utcnow()
         count = 0
-        create_fields = cls.format_fields(cls.author_id, cls.title, cls.message, cls.media_count, cls.likes,
-                                          cls.created_at, cls.updated_at)
-        sql = f'insert into {cls.table_name}({create_fields})' \
-              f' values ($1,$2,$3,$4,$5,$6,$7) returning {cls.id}'
-        res = await cls.con.fetchval(sql, author_id, title, message, count, count, time, time)
+        async with cls.transaction():
+            res = await cls.fetchval_named('create_post', author_id, title, message, count, count, time, time)
+            if cls.fan_out is not None:
+                await cls.fan_out(res, author_id, time)
+        cls.recommended.add({cls.id: res, cls.author_id: author_id, cls.title: title, cls.message: message,
+                             cls.media_count: count, cls.likes: count, cls.created_at: time, cls.updated_at: time})
+        response_cache.invalidate(FEED)
         return res
 
     @classmethod
@@ -41,20 +82,22 @@ class FeedRepository(DB):
         :param post_id:
         :return:
         """
-        sql = f'delete from {cls.table_name} where {cls.id}=$1'
-        await cls.con.execute(sql, post_id)
+        await cls.execute_named('delete_post', post_id)
+        cls.recommended.remove(post_id)
+        response_cache.invalidate(post_tag(post_id), FEED)
 
     @classmethod
     async def get_post(cls, value: int, field: str = 'id', fields: str = '*'):
         """
-        get post by value
+        get post by value, concurrent lookups of the same post share one query
         :param value:
         :param field:
         :param fields: return fields of post
         :return: dict()
         """
-        sql = f"select {fields} from {cls.table_name} where {field}=$1"
-        res = await cls.con.fetchrow(sql, value)
+        name = cls.register(f'get_post:{field}:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} where {field}=$1')
+        res = await cls.coalesce(cls.fetchrow_named, name, value)
         if res is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -62,6 +105,19 @@ class FeedRepository(DB):
             )
         return dict(res)
 
+    @classmethod
+    async def get_posts_by_ids(cls, post_ids: List[int], fields: str = '*') -> Dict[int, dict]:
+        """
+        get posts by one query, missing posts are left out
+        :param post_ids:
+        :param fields: return fields, have to contain id
+        :return: dict() of posts by id
+        """
+        name = cls.register(f'get_posts_by_ids:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} where {cls.id}=any($1::int[])')
+        res = await cls.fetch_named(name, list(set(post_ids)))
+        return {row[cls.id]: dict(row) for row in res}
+
     @classmethod
     async def get_user_posts(cls, user_id: int, fields: str = '*'):
         """
@@ -70,12 +126,17 @@ class FeedRepository(DB):
         :param fields:
         :return: list()
         """
-        sql = f"select {fields} from {cls.table_name} where {cls.author_id}=$1"
-        res = await cls.con.fetch(sql, user_id)
+        name = cls.register(f'get_user_posts:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} where {cls.author_id}=$1')
+        res = await cls.fetch_named(name, user_id)
         if len(res) == 0:
             return []
         return list(map(dict, res))
 
+    @classmethod
+    async def count_user_posts(cls, user_id: int) -> int:
+        return await cls.fetchval_named('count_user_posts', user_id)
+
     @classmethod
     async def get_posts(cls, limit: int = 10, page: int = 0, fields: str = '*'):
         """
@@ -86,8 +147,9 @@ class FeedRepository(DB):
         :return: list()
         """
         offset = page * limit
-        sql = f'select {fields} from {cls.table_name} limit $1 offset $2'
-        res = await cls.con.fetch(sql, limit, offset)
+        name = cls.register(f'get_posts:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} order by {cls.id} limit $1 offset $2')
+        res = await cls.fetch_named(name, limit, offset)
         if len(res) == 0:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -95,6 +157,117 @@ class FeedRepository(DB):
             )
         return list(map(dict, res))
 
+    @classmethod
+    async def get_posts_by_cursor(cls, limit: int = 10, cursor: Optional[str] = None,
+                                  fields: str = '*') -> Tuple[list, Optional[str]]:
+        """
+        get posts from newest to oldest by keyset pagination on (created_at, id)
+        :param limit: optional, default = 10
+        :param cursor: next_cursor of the previous page, None or '' for the first page
+        :param fields: return fields, have to contain created_at and id
+        :return: list(), next_cursor (None on the last page)
+        """
+        order = f'order by {cls.created_at} desc, {cls.id} desc limit $1'
+        if cursor:
+            created_at, post_id = cls.decode_cursor(cursor)
+            name = cls.register(f'posts_after_cursor:{fields}',
+                                lambda: f'select {fields} from {cls.table_name} '
+                                        f'where ({cls.created_at},{cls.id}) < ($2,$3) {order}')
+            res = await cls.fetch_named(name, limit + 1, created_at, post_id)
+        else:
+            name = cls.register(f'posts_first_page:{fields}',
+                                lambda: f'select {fields} from {cls.table_name} {order}')
+            res = await cls.fetch_named(name, limit + 1)
+        posts = list(map(dict, res[:limit]))
+        next_cursor = None
+        if len(res) > limit:
+            last = posts[-1]
+            next_cursor = cls.encode_cursor(last[cls.created_at], last[cls.id])
+        return posts, next_cursor
+
+    @classmethod
+    async def search_posts(cls, query: str, limit: int = 10,
+                           cursor: Optional[str] = None) -> Tuple[list, Optional[str]]:
+        """
+        full-text search of posts' titles and messages, best matches first,
+        keyset pagination on (rank, id) keeps deep pages as cheap as the first one
+        :param query: web search syntax: words, "phrases", or, -excluded
+        :param limit: optional, default = 10
+        :param cursor: next_cursor of the previous page, None or '' for the first page
+        :return: list(), next_cursor (None on the last page)
+        """
+        if not query.strip():
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Search query is empty'
+            )
+        if cursor:
+            rank, post_id = cls.decode_search_cursor(cursor)
+            res = await cls.fetch_named('search_after_cursor', query, limit + 1, rank, post_id)
+        else:
+            res = await cls.fetch_named('search_first_page', query, limit + 1)
+        posts = list(map(dict, res[:limit]))
+        next_cursor = None
+        if len(res) > limit:
+            last = posts[-1]
+            next_cursor = cls.encode_search_cursor(last['rank'], last[cls.id])
+        for post in posts:
+            del post['rank']
+        return posts, next_cursor
+
+    @staticmethod
+    def pack_cursor(*values) -> str:
+        raw = '|'.join(map(str, values)).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def unpack_cursor(cursor: str, *types: Callable):
+        """
+        parse cursor made by pack_cursor
+        :param cursor:
+        :param types: parsers of the values
+        :return: tuple of values or HTTPException(400)
+        """
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            values = raw.split('|')
+            if len(values) != len(types):
+                raise ValueError(raw)
+            return tuple(parse(value) for parse, value in zip(types, values))
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Invalid cursor'
+            )
+
+    @classmethod
+    def encode_cursor(cls, created_at: datetime.datetime, post_id: int) -> str:
+        """
+        opaque page cursor
+        :param created_at:
+        :param post_id:
+        :return: str
+        """
+        return cls.pack_cursor(created_at.isoformat(), post_id)
+
+    @classmethod
+    def decode_cursor(cls, cursor: str) -> Tuple[datetime.datetime, int]:
+        """
+        parse cursor made by encode_cursor
+        :param cursor:
+        :return: created_at, id or HTTPException(400)
+        """
+        return cls.unpack_cursor(cursor, datetime.datetime.fromisoformat, int)
+
+    @classmethod
+    def encode_search_cursor(cls, rank: float, post_id: int) -> str:
+        # repr keeps the float exact, so the next page starts right after the last post
+        return cls.pack_cursor(repr(rank), post_id)
+
+    @classmethod
+    def decode_search_cursor(cls, cursor: str) -> Tuple[float, int]:
+        return cls.unpack_cursor(cursor, float, int)
+
     @classmethod
     async def get_recommended_posts(cls, limit: int = 10, fields: str = '*'):
         """
@@ -103,8 +276,18 @@ class FeedRepository(DB):
         :param fields:
         :return: list()
         """
-        sql = f'select {fields} from {cls.table_name} order by {cls.likes} desc limit $1'
-        res = await cls.con.fetch(sql, limit)
+        if fields == '*':
+            res = cls.recommended.top(limit)
+            if res is not None:
+                if len(res) == 0:
+                    raise HTTPException(
+                        status_code=status.HTTP_404_NOT_FOUND,
+                        detail='Posts not found'
+                    )
+                return res
+        name = cls.register(f'get_recommended_posts:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} order by {cls.likes} desc limit $1')
+        res = await cls.fetch_named(name, limit)
         if len(res) == 0:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -120,19 +303,25 @@ class FeedRepository(DB):
         :param data: dict of values for updating in the format (field:value)
         :return:
         """
-        i = 1
-        args = []
         data[cls.updated_at] = datetime.datetime.utcnow()
-        for field in data:
-            args.append(f'{field}=${i}')
-            i += 1
-        sql = f'update {cls.table_name} set {DB.format_fields(*args)} where {cls.id}=${i}'
-        await cls.con.execute(sql, *data.values(), post_id)
+        await cls.update_row(post_id, data)
+        cls.recommended.update(post_id, data)
+        response_cache.invalidate(post_tag(post_id), SEARCH)
+
+    @classmethod
+    async def refresh_recommended(cls):
+        """
+        reseed in-memory top posts by likes from db
+        :return:
+        """
+        res = await cls.fetch_named('top_posts', cls.recommended.size)
+        cls.recommended.seed(list(map(dict, res)))
 
     @classmethod
     async def is_existed_post(cls, post_id: int, field: str = "id"):
-        sql = f"select exists(select 1 from {cls.table_name} where {field}=$1)"
-        res = await cls.con.fetchval(sql, post_id)
+        name = cls.register(f'is_existed_post:{field}',
+                            lambda: f'select exists(select 1 from {cls.table_name} where {field}=$1)')
+        res = await cls.fetchval_named(name, post_id)
         if not res:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
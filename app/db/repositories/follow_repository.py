@@ -0,0 +1,112 @@
+import datetime
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException, status
+
+from app.db.base import DB
+from app.db.repositories.users_repository import UserRepository
+from app.utils.log_settings import log
+
+
+class FollowRepository(DB):
+    table_name: str = 'aesn_follows'
+    follower_id = 'follower_id'
+    followee_id = 'followee_id'
+    created_at = 'created_at'
+
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        users = UserRepository
+        insert = f'insert into {cls.table_name}({cls.follower_id},{cls.followee_id},{cls.created_at}) ' \
+                 f'values ($1,$2,$3) on conflict do nothing'
+        delete = f'delete from {cls.table_name} where {cls.follower_id}=$1 and {cls.followee_id}=$2'
+        user_fields = f'u.{users.id},u.{users.first_name},u.{users.last_name},u.{users.created_at}'
+        return {
+            'follow': f'with added as ({insert} returning {cls.followee_id}) '
+                      f'update {users.table_name} set {users.followers}={users.followers}+1 '
+                      f'where {users.id}=(select {cls.followee_id} from added) returning {users.followers}',
+            'unfollow': f'with removed as ({delete} returning {cls.followee_id}) '
+                        f'update {users.table_name} set {users.followers}=greatest({users.followers}-1,0) '
+                        f'where {users.id}=(select {cls.followee_id} from removed) returning {users.followers}',
+            'is_following': f'select exists(select 1 from {cls.table_name} '
+                            f'where {cls.follower_id}=$1 and {cls.followee_id}=$2)',
+            'get_followers': f'select {user_fields} from {cls.table_name} f '
+                             f'join {users.table_name} u on u.{users.id}=f.{cls.follower_id} '
+                             f'where f.{cls.followee_id}=$1 order by f.{cls.follower_id} limit $2 offset $3',
+            'get_following': f'select {user_fields} from {cls.table_name} f '
+                             f'join {users.table_name} u on u.{users.id}=f.{cls.followee_id} '
+                             f'where f.{cls.follower_id}=$1 order by f.{cls.followee_id} limit $2 offset $3',
+            'reconcile_followers': f'update {users.table_name} u set {users.followers}=c.count '
+                                   f'from (select p.{users.id} as id, count(f.{cls.follower_id}) as count '
+                                   f'from {users.table_name} p '
+                                   f'left join {cls.table_name} f on f.{cls.followee_id}=p.{users.id} '
+                                   f'group by p.{users.id}) c '
+                                   f'where u.{users.id}=c.id and u.{users.followers} is distinct from c.count '
+                                   f'returning u.{users.id}',
+        }
+
+    @classmethod
+    async def follow(cls, follower_id: int, followee_id: int) -> Optional[int]:
+        """
+        add followee to the user's follows, the follow row and the followee's counter are changed by one statement
+        :param follower_id:
+        :param followee_id:
+        :return: new followers count of the followee or None if it's already followed
+        """
+        if follower_id == followee_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Users can't follow themselves"
+            )
+        await UserRepository.is_user_existed(UserRepository.id, user_id=followee_id)
+        return await cls.fetchval_named('follow', follower_id, followee_id, datetime.datetime.utcnow())
+
+    @classmethod
+    async def unfollow(cls, follower_id: int, followee_id: int) -> Optional[int]:
+        """
+        remove followee from the user's follows
+        :param follower_id:
+        :param followee_id:
+        :return: new followers count of the followee or None if it hasn't been followed
+        """
+        return await cls.fetchval_named('unfollow', follower_id, followee_id)
+
+    @classmethod
+    async def is_following(cls, follower_id: int, followee_id: int) -> bool:
+        return await cls.fetchval_named('is_following', follower_id, followee_id)
+
+    @classmethod
+    async def get_followers(cls, user_id: int, limit: int = 10, page: int = 0) -> List[dict]:
+        """
+        get users following the user, ordered by id
+        :param user_id:
+        :param limit: optional, default = 10
+        :param page: optional
+        :return: list()
+        """
+        res = await cls.fetch_named('get_followers', user_id, limit, page * limit)
+        return list(map(dict, res))
+
+    @classmethod
+    async def get_following(cls, user_id: int, limit: int = 10, page: int = 0) -> List[dict]:
+        """
+        get users followed by the user, ordered by id
+        :param user_id:
+        :param limit: optional, default = 10
+        :param page: optional
+        :return: list()
+        """
+        res = await cls.fetch_named('get_following', user_id, limit, page * limit)
+        return list(map(dict, res))
+
+    @classmethod
+    async def reconcile_followers(cls):
+        """
+        repair drift of users' followers counters (e.g. follows removed with deleted accounts)
+        by one set-based update
+        :return: count of repaired users
+        """
+        res = await cls.fetch_named('reconcile_followers')
+        if len(res) > 0:
+            log.info(f'followers counters of {len(res)} users have been repaired')
+        return len(res)
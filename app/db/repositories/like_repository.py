@@ -1,7 +1,13 @@
+from typing import Dict, Optional
+
+from app.config import LIKES_WRITE_BEHIND, LIKES_FLUSH_INTERVAL, LIKES_FLUSH_MAX_PENDING, LIKES_RECONCILE_BATCH
 from app.db.base import DB
+from app.db.like_aggregator import LikeAggregator
 from app.db.repositories.feed_repository import FeedRepository
 
 from app.utils.log_settings import log
+from app.utils.metrics import registry
+from app.utils.response_cache import post_tag, response_cache
 
 
 class LikeRepository(DB):
@@ -10,34 +16,78 @@ class LikeRepository(DB):
     user_id = 'user_id'
     post_id = 'post_id'
     media_id = 'media_id'
+    # write-behind buffer of likes counters, None if counters are updated with the like row
+    aggregator: Optional[LikeAggregator] = None
+
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        feed = FeedRepository
+        insert = f'insert into {cls.table_name}({cls.user_id},{cls.post_id}) values ($1,$2) on conflict do nothing'
+        delete = f'delete from {cls.table_name} where {cls.user_id}=$1 and {cls.post_id}=$2'
+        count = f'(select count(*) from {cls.table_name} l where l.{cls.post_id}=f.{feed.id})'
+        return {
+            'insert_like': f'{insert} returning {cls.id}',
+            'like_post': f'with liked as ({insert} returning {cls.post_id}) '
+                         f'update {feed.table_name} set {feed.likes}={feed.likes}+1 '
+                         f'where {feed.id}=(select {cls.post_id} from liked) returning {feed.likes}',
+            'delete_like': delete,
+            'unlike_post': f'with unliked as ({delete} returning {cls.id}) '
+                           f'update {feed.table_name} set {feed.likes}=greatest({feed.likes}-d.count,0) '
+                           f'from (select count(*) as count from unliked) d '
+                           f'where {feed.id}=$2 and d.count>0 returning {feed.likes}',
+            'check_if_liked': f'select exists(select 1 from {cls.table_name} '
+                              f'where {cls.user_id}=$1 and {cls.post_id}=$2)',
+            'delete_all_user_likes': f'delete from {cls.table_name} where {cls.user_id}=$1',
+            'update_like_info': f'update {feed.table_name} set {feed.likes}='
+                                f'(select count(*) from {cls.table_name} where {cls.post_id}=$1) '
+                                f'where {feed.id}=$1 returning {feed.likes}',
+            'apply_like_deltas': f'update {feed.table_name} f set {feed.likes}=greatest(f.{feed.likes}+d.delta,0) '
+                                 f'from unnest($1::int[],$2::int[]) as d(id,delta) where f.{feed.id}=d.id '
+                                 f'returning f.{feed.id}, f.{feed.likes}',
+            'lock_likes_batch': f'select {feed.id} from {feed.table_name} where {feed.id}>$1 '
+                                f'order by {feed.id} limit $2 for update',
+            'reconcile_likes': f'update {feed.table_name} f set {feed.likes}={count} '
+                               f'where f.{feed.id}=any($1::int[]) and f.{feed.likes} is distinct from {count} '
+                               f'returning f.{feed.id}, f.{feed.likes}',
+        }
 
     @classmethod
     async def like_post(cls, user_id: int, post_id: int):
         """
-        add like to post from user
+        add like to post from user, the like row and the post's counter are changed by one statement
         :param user_id:
         :param post_id:
-        :return:
+        :return: new likes count of the post or None if it has already been liked or the counter is buffered
         """
-        is_liked = await cls.check_if_liked(user_id, post_id)
-        if not is_liked:
-            sql = f'insert into {cls.table_name}({cls.user_id},{cls.post_id}) values ($1,$2)'
-            await cls.con.execute(sql, user_id, post_id)
-            await cls.update_like_info(post_id)
+        if cls.aggregator is not None:
+            if await cls.fetchval_named('insert_like', user_id, post_id) is not None:
+                cls.aggregator.add(post_id, 1)
+            return None
+        likes = await cls.fetchval_named('like_post', user_id, post_id)
+        if likes is not None:
+            response_cache.invalidate(post_tag(post_id))
+            await FeedRepository.recommended.set_likes(post_id, likes, FeedRepository.get_post)
+        return likes
 
     @classmethod
     async def unlike_post(cls, user_id: int, post_id: int):
         """
-        remove user's like from post
+        remove user's like from post, the like row and the post's counter are changed by one statement
         :param user_id:
         :param post_id:
-        :return:
+        :return: new likes count of the post or None if it hasn't been liked or the counter is buffered
         """
-        is_liked = await cls.check_if_liked(user_id, post_id)
-        if is_liked:
-            sql = f'delete from {cls.table_name} where {cls.user_id}=$1 and {cls.post_id}=$2'
-            await cls.con.execute(sql, user_id, post_id)
-            await cls.update_like_info(post_id)
+        if cls.aggregator is not None:
+            res = await cls.execute_named('delete_like', user_id, post_id)
+            deleted = int(res.split()[-1])
+            if deleted > 0:
+                cls.aggregator.add(post_id, -deleted)
+            return None
+        likes = await cls.fetchval_named('unlike_post', user_id, post_id)
+        if likes is not None:
+            response_cache.invalidate(post_tag(post_id))
+            await FeedRepository.recommended.set_likes(post_id, likes, FeedRepository.get_post)
+        return likes
 
     @classmethod
     async def check_if_liked(cls, user_id: int, post_id: int):
@@ -47,9 +97,7 @@ class LikeRepository(DB):
         :param user_id:
         :return: True or False
         """
-        sql = f"select exists(select 1 from {cls.table_name} where {cls.user_id}=$1 and {cls.post_id}=$2)"
-        res = await cls.con.fetchval(sql, user_id, post_id)
-        return res
+        return await cls.fetchval_named('check_if_liked', user_id, post_id)
 
     @classmethod
     async def get_likes(cls, post_id: int, fields: str = '*'):
@@ -59,29 +107,76 @@ class LikeRepository(DB):
         :param fields:
         :return: list()
         """
-        sql = f'select {fields} from {cls.table_name} where {cls.post_id}=$1'
-        res = await cls.con.fetch(sql, post_id)
+        name = cls.register(f'get_likes:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} where {cls.post_id}=$1')
+        res = await cls.fetch_named(name, post_id)
         if len(res) == 0:
             return []
         return list(map(dict, res))
 
     @classmethod
     async def delete_all_user_likes(cls, user_id: int):
-        sql = f'delete from {cls.table_name} where {cls.user_id}=$1'
-        await cls.con.execute(sql, user_id)
+        await cls.execute_named('delete_all_user_likes', user_id)
 
     @classmethod
     async def update_like_info(cls, post_id: int):
         """
-        updated on the post's likes count
+        recount the post's likes count from its like rows
         :param post_id:
         :return:
         """
-        liked_data = await LikeRepository.get_likes(post_id)
-        count = len(liked_data)
-        sql = f'update {FeedRepository.table_name} set {FeedRepository.likes}=$1 where {FeedRepository.id}=$2'
-
         try:
-            await cls.con.execute(sql, count, post_id)
+            count = await cls.fetchval_named('update_like_info', post_id)
         except Exception as e:
             log.warn(e, exc_info=True)
+            return
+        if count is not None:
+            response_cache.invalidate(post_tag(post_id))
+            await FeedRepository.recommended.set_likes(post_id, count, FeedRepository.get_post)
+
+    @classmethod
+    async def apply_like_deltas(cls, deltas: Dict[int, int]):
+        """
+        add buffered deltas to posts' likes counters by one statement
+        :param deltas: dict() post_id -> delta
+        :return:
+        """
+        res = await cls.fetch_named('apply_like_deltas', list(deltas.keys()), list(deltas.values()))
+        response_cache.invalidate(*(post_tag(row[FeedRepository.id]) for row in res))
+        for row in res:
+            await FeedRepository.recommended.set_likes(row[FeedRepository.id], row[FeedRepository.likes],
+                                                       FeedRepository.get_post)
+
+    @classmethod
+    async def reconcile_likes(cls):
+        """
+        repair drift between posts' likes counters and like rows by LIKES_RECONCILE_BATCH posts per transaction:
+        posts of the batch are locked first, so the recount's snapshot sees every committed like
+        and concurrent likes wait to increment the repaired counter,
+        it must not run while any worker buffers counters (LIKES_WRITE_BEHIND): like rows of deltas
+        not flushed yet are already counted, so the flush would add them once more
+        :return: count of repaired posts
+        """
+        res, last_id = [], 0
+        while True:
+            async with cls.transaction():
+                ids = [row[FeedRepository.id] for row in
+                       await cls.fetch_named('lock_likes_batch', last_id, LIKES_RECONCILE_BATCH)]
+                if len(ids) == 0:
+                    break
+                res += await cls.fetch_named('reconcile_likes', ids)
+            last_id = ids[-1]
+        if len(res) > 0:
+            response_cache.invalidate(*(post_tag(row[FeedRepository.id]) for row in res))
+        for row in res:
+            await FeedRepository.recommended.set_likes(row[FeedRepository.id], row[FeedRepository.likes],
+                                                       FeedRepository.get_post)
+        if len(res) > 0:
+            log.warning(f'likes counters of {len(res)} posts have been repaired')
+        return len(res)
+
+
+if LIKES_WRITE_BEHIND:
+    LikeRepository.aggregator = LikeAggregator(LikeRepository.apply_like_deltas,
+                                               LIKES_FLUSH_INTERVAL, LIKES_FLUSH_MAX_PENDING)
+    registry.add_collector(LikeRepository.aggregator.collect_metrics)
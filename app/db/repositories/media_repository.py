@@ -1,14 +1,20 @@
+import asyncio
 import datetime
 import os
 import shutil
-from typing import List
+from typing import List, Dict, Optional
 
 from fastapi import UploadFile, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 
-from app.config import DATA_PATH
+from app.config import DATA_PATH, MEDIA_MAX_FILE_SIZE, MEDIA_FILE_CACHE_SIZE, \
+    MEDIA_FILE_CACHE_TTL
 from app.db.base import DB
+from app.db.derivatives import derivative_pipeline
+from app.db.repositories.blob_repository import BlobRepository
 from app.db.repositories.feed_repository import FeedRepository
-from app.utils.log_settings import log
+from app.utils.cache import TTLCache
+from app.utils.response_cache import post_tag, response_cache
 
 
 class MediaRepository(DB):
@@ -20,62 +26,151 @@ class MediaRepository(DB):
     extension = 'extension'
     likes = 'likes'
     created_at = 'created_at'
+    digest = 'digest'
+    # media id -> file info (uri, size, mtime) for downloads
+    files_cache: TTLCache = TTLCache(MEDIA_FILE_CACHE_SIZE, MEDIA_FILE_CACHE_TTL)
 
     @classmethod
-    async def add_media(cls, author_id: int, post_id: int, media: UploadFile, i: int, part_uri: str):
+    def build_statements(cls) -> Dict[str, str]:
+        create_fields = cls.format_fields(cls.author_id, cls.post_id, cls.uri, cls.extension, cls.likes,
+                                          cls.created_at, cls.digest)
+        feed = FeedRepository
+        return {
+            'insert_media': f'insert into {cls.table_name}({create_fields}) '
+                            f'select * from unnest($1::int[],$2::int[],$3::text[],$4::text[],$5::int[],'
+                            f'$6::timestamp[],$7::text[])',
+            'delete_post_media': f'delete from {cls.table_name} where {cls.post_id}=$1 returning {cls.digest}',
+            'get_media': f'{cls.select_media()} where m.{cls.id}=$1',
+            'update_media_count': f'update {feed.table_name} set {feed.media_count}=$1 where {feed.id}=$2',
+        }
+
+    @classmethod
+    async def insert_media(cls, rows: List[tuple]):
         """
-        add a media file to post
-        :param part_uri:
-        :param author_id:
-        :param post_id:
-        :param media:
-        :param i:
+        add rows to aesn_media by one statement
+        :param rows: values (author_id, post_id, uri, extension, likes, created_at, digest)
         :return:
         """
-        extension = os.path.splitext(media.filename)[1]
-        uri = part_uri + f'/{i}{extension}'
+        await cls.execute_named('insert_media', *map(list, zip(*rows)))
+
+    @classmethod
+    def select_media(cls, fields: str = '*') -> str:
+        """
+        select clause of media rows, '*' also returns derivatives of the stored file
+        :param fields:
+        :return: sql with table alias m
+        """
+        if fields == '*':
+            return f'select m.*, b.{BlobRepository.derivatives} from {cls.table_name} m ' \
+                   f'left join {BlobRepository.table_name} b on b.{BlobRepository.digest}=m.{cls.digest}'
+        return f'select {fields} from {cls.table_name} m'
 
-        data = media.file.read()
-        with open(uri, mode='wb+') as f:
-            f.write(data)
+    @classmethod
+    def media_row(cls, row) -> dict:
+        media = dict(row)
+        if BlobRepository.derivatives in media and media[BlobRepository.derivatives] is None:
+            media[BlobRepository.derivatives] = []
+        return media
 
-        created_at = datetime.datetime.utcnow()
-        create_fields = cls.format_fields(cls.author_id, cls.post_id, cls.uri, cls.extension, cls.likes, cls.created_at)
-        sql = f'insert into {cls.table_name}({create_fields}) values ($1,$2,$3,$4,$5,$6)'
-        await cls.con.execute(sql, author_id, post_id, uri, extension, 0, created_at)
+    @classmethod
+    async def get_media_file(cls, media_id: int, max_side: Optional[int] = None) -> dict:
+        """
+        get file info of media through the cache
+        :param media_id:
+        :param max_side: size of derivative, the original is used if there's no such derivative
+        :return: dict(post_id, uri, extension, digest, size, mtime_ns) or HTTPException(404)
+        """
+        info = cls.files_cache.get((media_id, max_side))
+        if info is not None:
+            return info
+        res = await cls.fetchrow_named('get_media', media_id)
+        try:
+            if res is None:
+                raise FileNotFoundError
+            uri, extension, digest = res[cls.uri], res[cls.extension], res[cls.digest]
+            for derivative in res[BlobRepository.derivatives] or []:
+                if derivative['max_side'] == max_side:
+                    uri, extension, digest = derivative['uri'], '.jpg', f'{digest}_{max_side}'
+            stat = await run_in_threadpool(os.stat, uri)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Media not found'
+            )
+        info = {cls.post_id: res[cls.post_id], cls.uri: uri, cls.extension: extension,
+                cls.digest: digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        cls.files_cache.set((media_id, max_side), info)
+        return info
 
     @classmethod
     async def del_post_media(cls, post_id: int):
-        part_uri = DATA_PATH + f"{post_id}"
-        if os.path.exists(part_uri):
-            shutil.rmtree(part_uri)
-            os.mkdir(part_uri)
-        data = await cls.get_post_media(post_id)
-        if len(data) > 0:
-            sql = f'delete from {cls.table_name} where {cls.id}=$1'
-            for media in data:
-                await cls.con.execute(sql, media[cls.id])
+        """
+        delete all post's media, stored files are released and removed when no other media use them
+        :param post_id:
+        :return:
+        """
+        cls.files_cache.pop_where(lambda info: info[cls.post_id] == post_id)
+        async with cls.transaction():
+            res = await cls.fetch_named('delete_post_media', post_id)
+            garbage = await BlobRepository.release([row[cls.digest] for row in res if row[cls.digest] is not None])
+        response_cache.invalidate(post_tag(post_id))
+        BlobRepository.schedule_removal(garbage)
+        cls.schedule_legacy_removal([post_id])
+
+    @classmethod
+    def schedule_legacy_removal(cls, post_ids: List[int]):
+        """
+        queue removal of posts' directories of media uploaded before the content-addressed store
+        :param post_ids:
+        :return:
+        """
+        BlobRepository.cleanup.submit(run_in_threadpool, cls.remove_legacy_dirs, post_ids)
+
+    @staticmethod
+    def remove_legacy_dirs(post_ids: List[int]):
+        for post_id in post_ids:
+            part_uri = DATA_PATH + f"{post_id}"
+            if os.path.isdir(part_uri):
+                shutil.rmtree(part_uri, ignore_errors=True)
 
     @classmethod
     async def add_all_media(cls, post_id: int, author_id: int, data: List[UploadFile]):
         """
-        add all sent media to a post
+        replace all post's media by sent ones,
+        files are hashed first and only content that isn't stored yet is written
         :param post_id:
         :param author_id:
         :param data:
         :return:
         """
         if 0 < len(data) <= 10:
-            part_uri = DATA_PATH + f"{post_id}"
-            await cls.del_post_media(post_id)
-            if os.path.isdir(part_uri):
-                os.rmdir(part_uri)
-            os.mkdir(part_uri)
-            media_i = 0
-            for media in data:
-                media_i += 1
-                await cls.add_media(author_id, post_id, media, media_i, part_uri)
-            await cls.update_media_count(post_id)
+            hashed = await asyncio.gather(*(run_in_threadpool(BlobRepository.hash_file, media.file,
+                                                              MEDIA_MAX_FILE_SIZE) for media in data))
+            files = [(digest, size, media.file) for (digest, size), media in zip(hashed, data)]
+            cls.files_cache.pop_where(lambda info: info[cls.post_id] == post_id)
+            try:
+                async with cls.transaction():
+                    res = await cls.fetch_named('delete_post_media', post_id)
+                    old = [row[cls.digest] for row in res if row[cls.digest] is not None]
+                    # old and new digests at once in sorted order, so uploads swapping content don't deadlock
+                    await BlobRepository.lock(old + [digest for digest, _ in hashed])
+                    # new references first, so blobs kept by the post are never released to zero
+                    blobs = await BlobRepository.acquire(files)
+                    garbage = await BlobRepository.release(old)
+                    created_at = datetime.datetime.utcnow()
+                    await cls.insert_media([(author_id, post_id, blobs[digest][0],
+                                             os.path.splitext(media.filename)[1], 0, created_at, digest)
+                                            for (digest, _), media in zip(hashed, data)])
+                    await cls.update_media_count(post_id, len(data))
+            except BaseException:
+                BlobRepository.schedule_removal(BlobRepository.rollback_garbage([digest for digest, _ in hashed]))
+                raise
+            response_cache.invalidate(post_tag(post_id))
+            BlobRepository.schedule_removal(garbage)
+            cls.schedule_legacy_removal([post_id])
+            for digest, (uri, pending) in blobs.items():
+                if pending:
+                    derivative_pipeline.submit(digest, uri)
             return
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -85,29 +180,44 @@ class MediaRepository(DB):
     @classmethod
     async def get_post_media(cls, post_id: int, fields: str = '*'):
         """
-        get all post's media
+        get all post's media, concurrent lookups of the same post share one query
         :param post_id:
         :param fields:
         :return: list()
         """
-        sql = f'select {fields} from {cls.table_name} where {cls.post_id}=$1'
-        res = await cls.con.fetch(sql, post_id)
+        name = cls.register(f'get_post_media:{fields}',
+                            lambda: f'{cls.select_media(fields)} where m.{cls.post_id}=$1 order by m.{cls.id}')
+        res = await cls.coalesce(cls.fetch_named, name, post_id)
         if len(res) == 0:
             return []
-        return list(map(dict, res))
+        return list(map(cls.media_row, res))
+
+    @classmethod
+    async def get_posts_media(cls, post_ids: List[int], fields: str = '*') -> Dict[int, list]:
+        """
+        get media of several posts by one query, concurrent lookups of the same posts share it
+        :param post_ids:
+        :param fields: return fields, have to contain post_id
+        :return: dict() post_id -> list()
+        """
+        grouped = {post_id: [] for post_id in post_ids}
+        if len(grouped) == 0:
+            return grouped
+        name = cls.register(f'get_posts_media:{fields}',
+                            lambda: f'{cls.select_media(fields)} where m.{cls.post_id}=any($1::int[]) '
+                                    f'order by m.{cls.post_id},m.{cls.id}')
+        res = await cls.coalesce(cls.fetch_named, name, list(grouped))
+        for row in res:
+            grouped.setdefault(row[cls.post_id], []).append(cls.media_row(row))
+        return grouped
 
     @classmethod
-    async def update_media_count(cls, post_id):
+    async def update_media_count(cls, post_id: int, count: int):
         """
-        update media count variable in post
+        update media count variable in post, errors are raised to roll back the caller's transaction
         :param post_id:
+        :param count: media files of the post
         :return:
         """
-        path_post_media = DATA_PATH + f"{post_id}"
-        count = len(os.listdir(path_post_media))
-        sql = f'update {FeedRepository.table_name} set {FeedRepository.media_count}=$1 where {FeedRepository.id}=$2'
-
-        try: 
-            await cls.con.execute(sql, count, post_id)
-        except Exception as e:
-            log.warn(e, exc_info=True)
+        await cls.execute_named('update_media_count', count, post_id)
+        FeedRepository.recommended.update(post_id, {FeedRepository.media_count: count})
@@ -0,0 +1,161 @@
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.config import FEED_FANOUT_MAX_FOLLOWERS, FEED_TIMELINE_SIZE, FEED_TIMELINE_TRIM_BATCH, FEED_FOLLOW_BACKFILL
+from app.db.base import DB
+from app.db.repositories.feed_repository import FeedRepository
+from app.db.repositories.follow_repository import FollowRepository
+from app.db.repositories.users_repository import UserRepository
+from app.utils.log_settings import log
+
+
+class TimelineRepository(DB):
+    """
+    Materialized home feeds with hybrid fan-out.
+
+    A new post is written to the timelines of the author and the author's followers (fan-out on write)
+    when the author has up to FEED_FANOUT_MAX_FOLLOWERS followers. Posts of authors with more followers
+    are only written to the author's own timeline and merged into followers' home feeds when they're read,
+    so neither a post nor a home feed costs more than about FEED_FANOUT_MAX_FOLLOWERS rows.
+    Posts made while the author was over the threshold aren't in followers' timelines
+    if the author drops under it later
+    """
+    table_name: str = 'aesn_timelines'
+    user_id = 'user_id'
+    post_id = 'post_id'
+    author_id = 'author_id'
+    created_at = 'created_at'
+
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        feed, follows, users = FeedRepository, FollowRepository, UserRepository
+        fields = cls.format_fields(cls.user_id, cls.post_id, cls.author_id, cls.created_at)
+        return {
+            # $1 post, $2 author, $3 created_at, $4 max followers of fanned out authors
+            'fan_out': f'insert into {cls.table_name}({fields}) '
+                       f'select $2::int, $1::int, $2::int, $3::timestamp union all '
+                       f'select f.{follows.follower_id}, $1, $2, $3 from {follows.table_name} f '
+                       f'where f.{follows.followee_id}=$2 and (select {users.followers} from {users.table_name} '
+                       f'where {users.id}=$2)<=$4 '
+                       f'on conflict do nothing',
+            'backfill': f'insert into {cls.table_name}({fields}) '
+                        f'select $1::int, {feed.id}, {feed.author_id}, {feed.created_at} from {feed.table_name} '
+                        f'where {feed.author_id}=$2 order by {feed.created_at} desc, {feed.id} desc limit $3 '
+                        f'on conflict do nothing',
+            'remove_author': f'delete from {cls.table_name} where {cls.user_id}=$1 and {cls.author_id}=$2',
+            # timelines of up to $2 users with id over $1, the newest entry over $3 ones of every timeline
+            # is found by the (user_id, created_at, post_id) index and it's removed with older ones
+            'trim': f'with batch as (select {users.id} from {users.table_name} where {users.id}>$1 '
+                    f'order by {users.id} limit $2), '
+                    f'cut as (select b.{users.id} as {cls.user_id}, c.{cls.created_at}, c.{cls.post_id} from batch b '
+                    f'cross join lateral (select {cls.created_at}, {cls.post_id} from {cls.table_name} '
+                    f'where {cls.user_id}=b.{users.id} order by {cls.created_at} desc, {cls.post_id} desc '
+                    f'offset $3 limit 1) c), '
+                    f'removed as (delete from {cls.table_name} t using cut '
+                    f'where t.{cls.user_id}=cut.{cls.user_id} '
+                    f'and (t.{cls.created_at},t.{cls.post_id}) <= (cut.{cls.created_at},cut.{cls.post_id}) '
+                    f'returning 1) '
+                    f'select (select max({users.id}) from batch) as last_id, (select count(*) from removed) as count',
+            'home_first_page': cls.home_sql(False),
+            'home_after_cursor': cls.home_sql(True),
+        }
+
+    @classmethod
+    def home_sql(cls, after_cursor: bool) -> str:
+        """
+        newest posts of the user's timeline and of followed authors over the fan-out threshold
+        :param after_cursor: add ($4, $5) cursor condition
+        :return: sql with $1 user, $2 limit, $3 fan-out threshold
+        """
+        feed, follows, users = FeedRepository, FollowRepository, UserRepository
+        timeline_after = f'and ({cls.created_at},{cls.post_id}) < ($4,$5) ' if after_cursor else ''
+        posts_after = f'and ({feed.created_at},{feed.id}) < ($4,$5) ' if after_cursor else ''
+        return f'select p.* from {feed.table_name} p join (' \
+               f'(select {cls.post_id} as id from {cls.table_name} where {cls.user_id}=$1 {timeline_after}' \
+               f'order by {cls.created_at} desc, {cls.post_id} desc limit $2) ' \
+               f'union ' \
+               f'(select c.{feed.id} from {follows.table_name} f ' \
+               f'join {users.table_name} u on u.{users.id}=f.{follows.followee_id} and u.{users.followers}>$3 ' \
+               f'cross join lateral (select {feed.id}, {feed.created_at} from {feed.table_name} ' \
+               f'where {feed.author_id}=f.{follows.followee_id} {posts_after}' \
+               f'order by {feed.created_at} desc, {feed.id} desc limit $2) c ' \
+               f'where f.{follows.follower_id}=$1)' \
+               f') h on h.id=p.{feed.id} order by p.{feed.created_at} desc, p.{feed.id} desc limit $2'
+
+    @classmethod
+    async def fan_out(cls, post_id: int, author_id: int, created_at: datetime.datetime):
+        """
+        write the new post to timelines of the author and, unless the author has too many followers, followers
+        :param post_id:
+        :param author_id:
+        :param created_at:
+        :return:
+        """
+        await cls.execute_named('fan_out', post_id, author_id, created_at, FEED_FANOUT_MAX_FOLLOWERS)
+
+    @classmethod
+    async def add_author(cls, user_id: int, author_id: int, followers: int):
+        """
+        add latest posts of a newly followed author to the user's timeline,
+        posts of authors over the fan-out threshold are merged on read instead
+        :param user_id:
+        :param author_id:
+        :param followers: followers count of the author
+        :return:
+        """
+        if followers <= FEED_FANOUT_MAX_FOLLOWERS:
+            await cls.execute_named('backfill', user_id, author_id, FEED_FOLLOW_BACKFILL)
+
+    @classmethod
+    async def remove_author(cls, user_id: int, author_id: int):
+        """
+        remove posts of an unfollowed author from the user's timeline
+        :param user_id:
+        :param author_id:
+        :return:
+        """
+        await cls.execute_named('remove_author', user_id, author_id)
+
+    @classmethod
+    async def get_home(cls, user_id: int, limit: int = 10,
+                       cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        get the user's home feed from newest to oldest by keyset pagination on (created_at, id)
+        :param user_id:
+        :param limit: optional, default = 10
+        :param cursor: next_cursor of the previous page, None or '' for the first page
+        :return: list(), next_cursor (None on the last page)
+        """
+        if cursor:
+            created_at, post_id = FeedRepository.decode_cursor(cursor)
+            res = await cls.fetch_named('home_after_cursor', user_id, limit + 1, FEED_FANOUT_MAX_FOLLOWERS,
+                                        created_at, post_id)
+        else:
+            res = await cls.fetch_named('home_first_page', user_id, limit + 1, FEED_FANOUT_MAX_FOLLOWERS)
+        posts = list(map(dict, res[:limit]))
+        next_cursor = None
+        if len(res) > limit:
+            last = posts[-1]
+            next_cursor = FeedRepository.encode_cursor(last[FeedRepository.created_at], last[FeedRepository.id])
+        return posts, next_cursor
+
+    @classmethod
+    async def trim(cls):
+        """
+        remove entries over FEED_TIMELINE_SIZE newest ones of every timeline,
+        timelines are trimmed by FEED_TIMELINE_TRIM_BATCH users per statement
+        :return: count of removed entries
+        """
+        count, last_id = 0, 0
+        while True:
+            res = await cls.fetchrow_named('trim', last_id, FEED_TIMELINE_TRIM_BATCH, FEED_TIMELINE_SIZE)
+            if res['last_id'] is None:
+                break
+            count += res['count']
+            last_id = res['last_id']
+        if count > 0:
+            log.info(f'{count} old timeline entries have been removed')
+        return count
+
+
+FeedRepository.fan_out = TimelineRepository.fan_out
@@ -1,8 +1,16 @@
 import datetime
+from typing import Dict, List, Optional
 
 from fastapi import HTTPException, status
 
+from app.config import USER_CACHE_SIZE, USER_CACHE_TTL
 from app.db.base import DB
+from app.db.repositories.blob_repository import BlobRepository
+from app.db.repositories.feed_repository import FeedRepository
+from app.db.repositories.like_repository import LikeRepository
+from app.db.repositories.media_repository import MediaRepository
+from app.utils.cache import TTLCache
+from app.utils.response_cache import FEED, post_tag, response_cache, user_tag
 
 
 class UserRepository(DB):
@@ -13,6 +21,36 @@ class UserRepository(DB):
     first_name = 'first_name'
     last_name = 'last_name'
     created_at = 'created_at'
+    followers = 'followers'
+    # user rows without hash by login for authenticated requests, and their logins by id
+    cache: Optional[TTLCache] = None
+    cache_logins: Dict[int, str] = {}
+    updatable = frozenset((login, hash, first_name, last_name))
+
+    @classmethod
+    def build_statements(cls) -> Dict[str, str]:
+        feed, likes, media = FeedRepository, LikeRepository, MediaRepository
+        create_fields = cls.format_fields(cls.login, cls.hash, cls.first_name, cls.last_name, cls.created_at)
+        user_posts = f'select {feed.id} from {feed.table_name} where {feed.author_id}=$1'
+        return {
+            'create_user': f'insert into {cls.table_name}({create_fields}) values ($1,$2,$3,$4,$5) returning {cls.id}',
+            # likes of the user, counters of liked posts are decreased
+            'delete_user_likes': f'with removed as (delete from {likes.table_name} where {likes.user_id}=$1 '
+                                 f'returning {likes.post_id}) '
+                                 f'update {feed.table_name} f set {feed.likes}=greatest(f.{feed.likes}-r.count,0) '
+                                 f'from (select {likes.post_id}, count(*) as count from removed '
+                                 f'group by {likes.post_id}) r '
+                                 f'where f.{feed.id}=r.{likes.post_id} and f.{feed.author_id}<>$1 '
+                                 f'returning f.{feed.id}, f.{feed.likes}, r.count',
+            # likes of other users on the user's posts
+            'delete_posts_likes': f'delete from {likes.table_name} where {likes.post_id} in ({user_posts})',
+            'delete_posts_media': f'delete from {media.table_name} where {media.post_id} in ({user_posts}) '
+                                  f'returning {media.digest}',
+            'delete_posts': f'delete from {feed.table_name} where {feed.author_id}=$1 returning {feed.id}',
+            'delete_account': f'delete from {cls.table_name} where {cls.id}=$1',
+            'get_users_by_ids': f'select {cls.format_fields(cls.id, cls.first_name, cls.last_name, cls.created_at)} '
+                                f'from {cls.table_name} where {cls.id}=any($1::int[])',
+        }
 
     @classmethod
     async def create_user(cls, login: str, password: str, first_name: str = 'Noname', last_name: str = 'User'):
@@ -30,9 +68,9 @@ class UserRepository(DB):
         if first_name is None and last_name is None:
             first_name = 'Noname'
             last_name = 'User'
-        create_fields = DB.format_fields(cls.login, cls.hash, cls.first_name, cls.last_name, cls.created_at)
-        sql = f'insert into {cls.table_name}({create_fields}) values ($1,$2,$3,$4,$5) returning {cls.id}'
-        await DB.con.fetchval(sql, login, password, first_name, last_name, time)
+        res = await cls.fetchval_named('create_user', login, password, first_name, last_name, time)
+        # a batch read may have cached the id as missing
+        response_cache.invalidate(user_tag(res))
 
     @classmethod
     async def delete_user(cls, value, field: str = id):
@@ -42,20 +80,57 @@ class UserRepository(DB):
         :param value:
         :return:
         """
-        sql = f"delete from {cls.table_name} where {field}=$1"
-        await cls.con.execute(sql, value)
+        name = cls.register(f'delete_user:{field}',
+                            lambda: f'delete from {cls.table_name} where {field}=$1 returning {cls.id}')
+        res = await cls.fetch_named(name, value)
+        for row in res:
+            cls.forget(row[cls.id])
+        response_cache.invalidate(*(user_tag(row[cls.id]) for row in res))
+
+    @classmethod
+    async def delete_account(cls, user_id: int) -> dict:
+        """
+        delete user with all posts, media and likes by set-based statements in one transaction,
+        files are removed later by the cleanup queue
+        :param user_id:
+        :return: dict() of deleted posts, media and likes counts
+        """
+        feed, media = FeedRepository, MediaRepository
+        async with cls.transaction():
+            liked = await cls.fetch_named('delete_user_likes', user_id)
+            res = await cls.execute_named('delete_posts_likes', user_id)
+            likes_count = sum(row['count'] for row in liked) + int(res.split()[-1])
+            deleted_media = await cls.fetch_named('delete_posts_media', user_id)
+            garbage = await BlobRepository.release([row[media.digest] for row in deleted_media
+                                                    if row[media.digest] is not None])
+            post_ids = [row[feed.id] for row in await cls.fetch_named('delete_posts', user_id)]
+            await cls.execute_named('delete_account', user_id)
+
+        cls.forget(user_id)
+        response_cache.invalidate(user_tag(user_id), FEED, *(post_tag(post_id) for post_id in post_ids),
+                                  *(post_tag(row[feed.id]) for row in liked))
+        deleted = set(post_ids)
+        media.files_cache.pop_where(lambda info: info[media.post_id] in deleted)
+        for post_id in post_ids:
+            feed.recommended.remove(post_id)
+        for row in liked:
+            await feed.recommended.set_likes(row[feed.id], row[feed.likes], feed.get_post)
+        BlobRepository.schedule_removal(garbage)
+        media.schedule_legacy_removal(post_ids)
+        return {'posts': len(post_ids), 'media': len(deleted_media), 'likes': likes_count}
 
     @classmethod
     async def get_user(cls, value, value_field: str = id, fields: str = '*') -> dict:
         """
-        get user by value
+        get user by value (id or login), concurrent lookups of the same user share one query
         :param value:
         :param value_field:
         :param fields: return fields
         :return: dict()
         """
-        sql = f"select {fields} from {cls.table_name} where {value_field}=$1"
-        res = await cls.con.fetchrow(sql, value)
+        name = cls.register(f'get_user:{value_field}:{fields}',
+                            lambda: f'select {fields} from {cls.table_name} where {value_field}=$1')
+        res = await cls.coalesce(cls.fetchrow_named, name, value)
         if res is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -63,6 +138,59 @@ class UserRepository(DB):
             )
         return dict(res)
 
+    @classmethod
+    async def get_users_by_ids(cls, user_ids: List[int]) -> Dict[int, dict]:
+        """
+        get public fields of users by one query, missing users are left out
+        :param user_ids:
+        :return: dict() of users by id
+        """
+        res = await cls.fetch_named('get_users_by_ids', list(set(user_ids)))
+        return {row[cls.id]: dict(row) for row in res}
+
+    @classmethod
+    async def get_user_by_login(cls, login: str) -> dict:
+        """
+        get user row without hash by login through the cache, password checks read the hash by get_hash
+        :param login:
+        :return: dict()
+        """
+        user = cls.cache.get(login)
+        if user is None:
+            user = await cls.get_user(login, cls.login, cls.format_fields(cls.id, cls.login, cls.first_name,
+                                                                          cls.last_name, cls.created_at,
+                                                                          cls.followers))
+            if cls.cache.maxsize > 0 and cls.cache.ttl > 0:
+                cls.cache.set(login, user)
+                cls.cache_logins[user[cls.id]] = login
+        return dict(user)
+
+    @classmethod
+    async def get_hash(cls, user_id: int) -> str:
+        """
+        get password hash of the user, it is never cached
+        :param user_id:
+        :return: str
+        """
+        user = await cls.get_user(user_id, cls.id, cls.hash)
+        return user[cls.hash]
+
+    @classmethod
+    def forget(cls, user_id: int):
+        """
+        remove the user from the cache of this worker
+        :param user_id:
+        :return:
+        """
+        login = cls.cache_logins.pop(user_id, None)
+        if login is not None:
+            cls.cache.pop(login)
+
+    @classmethod
+    def _evicted(cls, login: str, user):
+        if cls.cache_logins.get(user[cls.id]) == login:
+            del cls.cache_logins[user[cls.id]]
+
     @classmethod
     async def is_user_existed(cls, field: str, login: str = '', user_id: int = 0):
         """
@@ -72,8 +200,9 @@ class UserRepository(DB):
         :param user_id: optional
         :return: user exist: nothing; user not exist: HTTPException(404)
         """
-        sql = f"select exists(select 1 from {cls.table_name} where {field}=$1)"
-        res = await cls.con.fetchval(sql, login if field == cls.login else user_id)
+        name = cls.register(f'is_user_existed:{field}',
+                            lambda: f'select exists(select 1 from {cls.table_name} where {field}=$1)')
+        res = await cls.fetchval_named(name, login if field == cls.login else user_id)
         if not res:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -88,10 +217,9 @@ class UserRepository(DB):
         :param data: dict of values for updating in the format (field:value)
         :return:
         """
-        i = 1
-        args = []
-        for field in data:
-            args.append(f'{field}=${i}')
-            i += 1
-        sql = f'update {cls.table_name} set {DB.format_fields(*args)} where {cls.id}=${i}'
-        await cls.con.execute(sql, *data.values(), user_id)
+        await cls.update_row(user_id, data)
+        cls.forget(user_id)
+        response_cache.invalidate(user_tag(user_id))
+
+
+UserRepository.cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, on_evict=UserRepository._evicted)
@@ -0,0 +1,135 @@
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.utils.log_settings import log
+from app.utils.tasks import PeriodicTask
+
+
+class TopPostsIndex:
+    """
+    In-process top-N of posts by likes.
+
+    Invariant: every post outside the index has likes <= floor, every post inside has likes >= floor,
+    so the first k ranked entries are the real top-k while k <= len(index).
+    floor is None when the index holds every post of the table
+    """
+
+    def __init__(self, size: int, likes_field: str = 'likes', id_field: str = 'id'):
+        self.size = size
+        self.likes_field = likes_field
+        self.id_field = id_field
+        self.floor: Optional[int] = None
+        self.seeded = False
+        self._posts: Dict[int, dict] = {}
+        self._ranked: Optional[List[dict]] = None
+        self._refresh: Optional[PeriodicTask] = None
+
+    def seed(self, rows: List[dict]):
+        """
+        replace content of the index by rows ordered by likes desc (at most size rows)
+        :param rows:
+        :return:
+        """
+        self._posts = {row[self.id_field]: dict(row) for row in rows[:self.size]}
+        self.floor = rows[-1][self.likes_field] if len(rows) >= self.size else None
+        self._ranked = None
+        self.seeded = True
+
+    def top(self, limit: int) -> Optional[List[dict]]:
+        """
+        get top posts by likes
+        :param limit: at least 1
+        :return: list() or None if the index can't answer (not seeded or limit is over its size)
+        """
+        if limit < 1:
+            raise ValueError(f'limit has to be positive, got {limit}')
+        if not self.seeded or (self.floor is not None and limit > len(self._posts)):
+            return None
+        if self._ranked is None:
+            self._ranked = sorted(self._posts.values(),
+                                  key=lambda post: (post[self.likes_field], post[self.id_field]), reverse=True)
+        return [dict(post) for post in self._ranked[:limit]]
+
+    def add(self, row: dict):
+        """
+        register a new post
+        :param row:
+        :return:
+        """
+        if not self.seeded:
+            return
+        if self.floor is None or row[self.likes_field] > self.floor:
+            self._insert(dict(row))
+
+    def update(self, post_id: int, data: dict):
+        """
+        update fields (not likes) of the post if it's in the index
+        :param post_id:
+        :param data:
+        :return:
+        """
+        post = self._posts.get(post_id)
+        if post is not None:
+            post.update(data)
+
+    def remove(self, post_id: int):
+        """
+        forget deleted post
+        :param post_id:
+        :return:
+        """
+        if self._posts.pop(post_id, None) is not None:
+            self._ranked = None
+
+    async def set_likes(self, post_id: int, likes: int, load: Callable[[int], Awaitable[dict]]):
+        """
+        apply new likes count of the post
+        :param post_id:
+        :param likes:
+        :param load: coroutine function returning the post row, used when the post enters the index
+        :return:
+        """
+        if not self.seeded:
+            return
+        post = self._posts.get(post_id)
+        if post is not None:
+            if self.floor is not None and likes < self.floor:
+                self.remove(post_id)
+            else:
+                post[self.likes_field] = likes
+                self._ranked = None
+            return
+        if self.floor is None or likes <= self.floor:
+            return
+        try:
+            row = await load(post_id)
+        except Exception as e:
+            log.warning(e)
+            return
+        row[self.likes_field] = likes
+        if post_id not in self._posts and (self.floor is None or likes > self.floor):
+            self._insert(row)
+
+    def _insert(self, row: dict):
+        self._posts[row[self.id_field]] = row
+        self._ranked = None
+        if len(self._posts) > self.size:
+            lowest = min(self._posts.values(), key=lambda post: (post[self.likes_field], post[self.id_field]))
+            del self._posts[lowest[self.id_field]]
+            evicted = lowest[self.likes_field]
+            self.floor = evicted if self.floor is None else max(self.floor, evicted)
+
+    def start(self, refresh: Callable[[], Awaitable[None]], interval: float):
+        """
+        run refresh every interval seconds in background, it bounds staleness of the index
+        :param refresh: coroutine function reseeding the index
+        :param interval:
+        :return:
+        """
+        if self._refresh is None:
+            self._refresh = PeriodicTask(refresh, interval)
+            self._refresh.start()
+
+    async def stop(self):
+        if self._refresh is not None:
+            await self._refresh.stop()
+            self._refresh = None
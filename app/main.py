@@ -1,28 +1,68 @@
-import json
-
 from fastapi import FastAPI, HTTPException, status, Request
 from fastapi.encoders import jsonable_encoder
-from starlette.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse
 
+from app.config import RECOMMENDED_REFRESH_INTERVAL, LIKES_RECONCILE_INTERVAL, DB_QUERY_BUDGET, \
+    DB_REPEATED_QUERY_LIMIT, SERVER_TIMING_HEADER, METRICS_LOOP_LAG_INTERVAL, FEED_TIMELINE_TRIM_INTERVAL, \
+    FOLLOWERS_RECONCILE_INTERVAL, LIKES_WRITE_BEHIND
+from app.api.metrics import MetricsMiddleware
+from app.api.security import password_hasher, token_cache
+from app.api.server_timing import ServerTimingMiddleware
 from app.db.base import DB
+from app.db.derivatives import derivative_pipeline
+from app.db.repositories.blob_repository import BlobRepository
+from app.db.repositories.feed_repository import FeedRepository
+from app.db.repositories.follow_repository import FollowRepository
+from app.db.repositories.like_repository import LikeRepository
+from app.db.repositories.media_repository import MediaRepository
+from app.db.repositories.timeline_repository import TimelineRepository
+from app.db.repositories.users_repository import UserRepository
 from app.api.handlers.auth import router as auth_router
-from app.api.handlers.profile import router as profile_router
+from app.api.handlers.profile import router as profile_router, account_deletions
 from app.api.handlers.feed import router as feed_router
 from app.api.handlers.users import router as user_router
-from app.utils.log_settings import log
+from app.api.handlers.media import router as media_router
+from app.api.handlers.metrics import get_metrics
+from app.utils.log_settings import log, expected_log
+from app.utils.metrics import LoopLagMonitor, cache_metrics, registry
+from app.utils.response_cache import response_cache
+from app.utils.tasks import PeriodicTask
 
-app = FastAPI(title='Api-example (social network)')
+app = FastAPI(title='Api-example (social network)', default_response_class=ORJSONResponse)
 app.router.prefix = '/v1'
 app.include_router(user_router)
 app.include_router(auth_router)
 app.include_router(feed_router)
 app.include_router(profile_router)
+app.include_router(media_router)
+app.add_route('/metrics', get_metrics, include_in_schema=False)
+app.add_middleware(ServerTimingMiddleware, budget=DB_QUERY_BUDGET, repeat_limit=DB_REPEATED_QUERY_LIMIT,
+                   header=SERVER_TIMING_HEADER)
+app.add_middleware(MetricsMiddleware)
+
+# recounting races with buffered deltas of every worker, see LikeRepository.reconcile_likes
+likes_reconciliation = PeriodicTask(LikeRepository.reconcile_likes,
+                                    0 if LIKES_WRITE_BEHIND else LIKES_RECONCILE_INTERVAL)
+followers_reconciliation = PeriodicTask(FollowRepository.reconcile_followers, FOLLOWERS_RECONCILE_INTERVAL)
+timeline_trim = PeriodicTask(TimelineRepository.trim, FEED_TIMELINE_TRIM_INTERVAL)
+loop_lag = LoopLagMonitor(registry.histogram('event_loop_lag_seconds', 'Delay of event loop wake-ups',
+                                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)),
+                          registry.gauge('event_loop_lag_last_seconds', 'Last sampled event loop delay'),
+                          METRICS_LOOP_LAG_INTERVAL)
+registry.add_collector(lambda: cache_metrics({'users': UserRepository.cache, 'tokens': token_cache,
+                                              'media_files': MediaRepository.files_cache,
+                                              'responses': response_cache}))
 
 
 @app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request, exc):
-    log.warning(exc, exc_info=True)
-    return JSONResponse(
+    if exc.status_code >= 500:
+        log.warning(exc, exc_info=True)
+    else:
+        # routine client errors: no traceback, rate-limited per status
+        expected_log.warning('%s %s %s %s', request.method, request.url.path, exc.status_code, exc.detail,
+                             extra={'rate_key': exc.status_code})
+    return ORJSONResponse(
         status_code=exc.status_code,
         content=jsonable_encoder({
               "payload": None,
@@ -36,7 +76,7 @@ async def custom_http_exception_handler(request, exc):
 @app.exception_handler(Exception)
 async def custom_exception_handler(request: Request, exc: Exception):
     log.critical(exc, exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content=jsonable_encoder({
               "payload": None,
@@ -47,39 +87,34 @@ async def custom_exception_handler(request: Request, exc: Exception):
     )
 
 
-@app.middleware('http')
-async def format_response(request: Request, call_next):
-    if request.headers['accept'] != 'application/json':
-        return await call_next(request)
-    response: StreamingResponse = await call_next(request)
-    status_code = response.status_code
-    if status_code < 300:
-        content = None
-        if 'content-type' in response.headers and response.headers['content-type'] == 'application/json':
-            response_body = b""
-            async for chunk in response.body_iterator:
-                response_body += chunk
-            content = json.loads(response_body.decode('utf-8'))
-        return JSONResponse(
-            content=jsonable_encoder({
-                "payload": content,
-                "message": "OK",
-                "title": None,
-                "code": status_code
-            }),
-            status_code=status_code
-        )
-    else:
-        return response
-
-
 @app.on_event("startup")
 async def startup_event():
     await DB.connect_db()
+    await FeedRepository.refresh_recommended()
+    FeedRepository.recommended.start(FeedRepository.refresh_recommended, RECOMMENDED_REFRESH_INTERVAL)
+    likes_reconciliation.start()
+    followers_reconciliation.start()
+    timeline_trim.start()
+    loop_lag.start()
+    derivative_pipeline.start()
+    BlobRepository.cleanup.start()
+    if LikeRepository.aggregator is not None:
+        LikeRepository.aggregator.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await likes_reconciliation.stop()
+    await followers_reconciliation.stop()
+    await timeline_trim.stop()
+    await loop_lag.stop()
+    await derivative_pipeline.stop()
+    await account_deletions.stop()
+    await BlobRepository.cleanup.stop()
+    if LikeRepository.aggregator is not None:
+        await LikeRepository.aggregator.stop()
+    await FeedRepository.recommended.stop()
     await DB.disconnect_db()
+    password_hasher.shutdown()
 
 
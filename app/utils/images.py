@@ -0,0 +1,40 @@
+import os
+from typing import List
+
+# runs in worker processes, keep imports of this module light (no app config or database)
+
+
+def make_derivatives(uri: str, sizes: List[int], quality: int) -> List[dict]:
+    """
+    make resized JPEG copies of an image next to it (blocking, CPU-bound)
+    :param uri: path of the original
+    :param sizes: max side of every derivative in pixels, sizes not smaller than the original are skipped
+    :param quality: JPEG quality
+    :return: list of dict(max_side, width, height, size, uri), empty if the file isn't an image
+    """
+    from PIL import Image
+
+    derivatives = []
+    try:
+        with Image.open(uri) as image:
+            image.load()
+            for max_side in sorted(sizes):
+                if max(image.size) <= max_side:
+                    continue
+                resized = image.copy()
+                resized.thumbnail((max_side, max_side))
+                if resized.mode not in ('RGB', 'L'):
+                    resized = resized.convert('RGB')
+                out = f'{uri}_{max_side}.jpg'
+                tmp = f'{out}.{os.getpid()}.tmp'
+                resized.save(tmp, 'JPEG', quality=quality, optimize=True)
+                os.replace(tmp, out)
+                derivatives.append({'max_side': max_side, 'width': resized.width, 'height': resized.height,
+                                    'size': os.path.getsize(out), 'uri': out})
+    except Exception:
+        # not an image (video, broken file, decompression bomb): nothing to derive
+        for derivative in derivatives:
+            if os.path.exists(derivative['uri']):
+                os.remove(derivative['uri'])
+        return []
+    return derivatives
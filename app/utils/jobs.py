@@ -0,0 +1,87 @@
+import asyncio
+import datetime
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+from fastapi import HTTPException
+
+from app.utils.cache import TTLCache
+from app.utils.log_settings import log
+
+
+class JobRegistry:
+    """
+    Long operations run as background tasks, their status is kept in memory of the worker for ttl seconds:
+    it is per-process only, so it is found only on the worker that started the job and is lost on restart,
+    jobs have to be safe to run again after a crash
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._jobs = TTLCache(maxsize, ttl)
+        self._tasks: Set[asyncio.Task] = set()
+        self._running: Dict[Hashable, dict] = {}
+
+    def start(self, func: Callable[..., Awaitable], *args, key: Optional[Hashable] = None, owner: Any = None) -> dict:
+        """
+        run func(*args) in background, only one job per key runs at a time
+        :param func: coroutine function, its result is saved to the job
+        :param args:
+        :param key: while a job with the same key is unfinished it is returned instead of starting a new one
+        :param owner: saved to the job to check access to its status
+        :return: job dict(id, status, created_at, finished_at, result, error, owner)
+        """
+        if key is not None and key in self._running:
+            return self._running[key]
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'pending',
+            'created_at': datetime.datetime.utcnow(),
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            'owner': owner,
+        }
+        self._jobs.set(job['id'], job)
+        if key is not None:
+            self._running[key] = job
+        task = asyncio.create_task(self._run(job, func, args, key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._jobs.get(job_id)
+
+    def running(self, key: Hashable) -> Optional[dict]:
+        """
+        :param key:
+        :return: unfinished job started with the key or None
+        """
+        return self._running.get(key)
+
+    async def _run(self, job: dict, func: Callable[..., Awaitable], args: tuple, key: Optional[Hashable]):
+        job['status'] = 'running'
+        try:
+            job['result'] = await func(*args)
+            job['status'] = 'done'
+        except Exception as e:
+            log.warning(e, exc_info=True)
+            job['status'] = 'failed'
+            job['error'] = e.detail if isinstance(e, HTTPException) else 'Something is wrong, try again later...'
+        finally:
+            job['finished_at'] = datetime.datetime.utcnow()
+            if key is not None:
+                self._running.pop(key, None)
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        wait up to timeout seconds for running jobs, cancel the rest
+        :param timeout:
+        :return:
+        """
+        if len(self._tasks) == 0:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
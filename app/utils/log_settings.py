@@ -1,26 +1,245 @@
+import atexit
 import datetime
-import json
 import logging
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from logging.handlers import QueueHandler
+from typing import BinaryIO, Callable, Dict, Hashable, List, Optional, Tuple
+
+import orjson
+
+from app.config import LOG_LEVEL, LOG_FILE, LOG_FILE_LEVEL, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUPS, LOG_QUEUE_SIZE, \
+    LOG_BATCH_SIZE, LOG_EXPECTED_ERRORS_RATE, LOG_EXPECTED_ERRORS_BURST
 
 
 class JSONFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord):
-        return json.dumps({
-                    'args': record.args,
-                    'file': record.filename,
-                    'func': record.funcName,
-                    'line': record.lineno,
-                    'message': record.getMessage(),
-                    'datetime': str(datetime.datetime.utcnow()),
-                }, ensure_ascii=False)
+        return self.encode(record).decode()
+
+    def encode(self, record: logging.LogRecord) -> bytes:
+        data = {
+            'level': record.levelname,
+            'file': record.filename,
+            'func': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+            'datetime': str(datetime.datetime.utcfromtimestamp(record.created)),
+        }
+        if record.exc_info:
+            data['exc'] = ''.join(traceback.format_exception(*record.exc_info))
+        return orjson.dumps(data, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Puts records into a bounded queue without formatting or I/O, records over the queue size are dropped and counted.
+    The message is merged with its args now, the traceback is formatted later by the writer thread
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RotatingFileWriter:
+    """
+    Appends bytes to a file, renames it to .1 (.1 to .2 ...) when it grows over max_bytes
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file: Optional[BinaryIO] = None
+        self.size = 0
+
+    def write(self, data: bytes):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+            self.size = self.file.tell()
+        if 0 < self.max_bytes < self.size + len(data) and self.size > 0:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def write_stream(data: bytes):
+    stream = sys.stderr
+    if hasattr(stream, 'buffer'):
+        stream.buffer.write(data)
+    else:
+        stream.write(data.decode())
+    stream.flush()
+
 
+class LogWriter:
+    """
+    Background thread taking records from the queue in batches of up to batch_size,
+    each sink gets one write per batch with the records of its level.
+    Records failed to encode and failed sink writes are counted and reported on stderr
+    """
+    _stop = object()
+
+    def __init__(self, records: queue.Queue, formatter: JSONFormatter,
+                 sinks: List[Tuple[int, Callable[[bytes], None]]], batch_size: int):
+        self.queue = records
+        self.formatter = formatter
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.encode_errors = 0
+        self.write_errors = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        write queued records and stop the thread
+        :param timeout: seconds
+        :return:
+        """
+        if self._thread is None:
+            return
+        self.queue.put(self._stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = any(record is self._stop for record in batch)
+            lines, newline = [], b'\n'
+            for record in batch:
+                if record is self._stop:
+                    continue
+                try:
+                    lines.append((record.levelno, self.formatter.encode(record) + b'\n'))
+                except Exception as e:
+                    self.encode_errors += 1
+                    self._report(f'log record of {record.pathname}:{record.lineno} is dropped: {e!r}')
+            for level, write in self.sinks:
+                data = b''.join(line for levelno, line in lines if levelno >= level)
+                if data:
+                    try:
+                        write(data)
+                    except Exception as e:
+                        self.write_errors += 1
+                        self._report(f'{data.count(newline)} log records are not written by '
+                                     f'{getattr(write, "__qualname__", write)}: {e!r}')
+            if stopping:
+                return
+
+    @staticmethod
+    def _report(message: str):
+        # the sinks may be broken, so it goes straight to the process stderr
+        try:
+            sys.__stderr__.write(f'log writer: {message}\n')
+            sys.__stderr__.flush()
+        except Exception:
+            pass
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes up to rate records per second (bursts up to burst) for each key: record.rate_key if it's set
+    by extra={'rate_key': ...}, otherwise the logging call site. The next passed record tells how many
+    have been suppressed. rate <= 0 passes everything
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # key -> [tokens, updated_at, suppressed]
+        self.buckets: Dict[Hashable, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0:
+            return True
+        key = getattr(record, 'rate_key', None) or (record.pathname, record.lineno)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f'{record.getMessage()} ({bucket[2]} similar suppressed)'
+            record.args = None
+            bucket[2] = 0
+        return True
+
+
+records: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+queue_handler = LogQueueHandler(records)
+file_writer = RotatingFileWriter(LOG_FILE, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUPS)
+log_writer = LogWriter(records, JSONFormatter(), [(logging.NOTSET, write_stream),
+                                                  (logging.getLevelName(LOG_FILE_LEVEL), file_writer.write)],
+                       LOG_BATCH_SIZE)
 
 log = logging.getLogger()
-log.setLevel("INFO")
-std_handler = logging.StreamHandler()
-std_handler.setFormatter(JSONFormatter())
-file_handler = logging.FileHandler(filename="aesn.log", mode="a")
-file_handler.setLevel(logging.WARNING)
-file_handler.setFormatter(JSONFormatter())
-log.addHandler(std_handler)
-log.addHandler(file_handler)
+log.setLevel(LOG_LEVEL)
+log.addHandler(queue_handler)
+# routine client errors (4xx), rate-limited
+expected_log = logging.getLogger('aesn.expected')
+expected_log.addFilter(RateLimitFilter(LOG_EXPECTED_ERRORS_RATE, LOG_EXPECTED_ERRORS_BURST))
+
+log_writer.start()
+atexit.register(log_writer.stop)
+
+
+def _after_fork_in_child():
+    # worker processes (derivatives) don't inherit the writer thread nor should write the parent's queued records
+    global records
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler.queue = records
+    log_writer.queue = records
+    log_writer._thread = None
+    file_writer.file = None
+    log_writer.start()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,190 @@
+import asyncio
+import bisect
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+# seconds, latency of requests and statements
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Values by label values, updated from the event loop without locks and rendered at scrape time
+    in Prometheus text format
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in self.values.items():
+            lines.append(f'{self.name}{format_labels(self.labels, key)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    """
+    Observations counted per bucket, buckets are made cumulative at scrape time
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket..., count over the last bucket, sum]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        names = self.labels + ('le',)
+        for key, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{format_labels(names, key + (format_value(bound),))} {total}')
+            labels = format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class Registry:
+    """
+    Metrics updated in place plus collectors building metrics from other state at scrape time
+    """
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.add(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.add(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Metric]]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class LoopLagMonitor:
+    """
+    Sleeps interval seconds in background and records how late the event loop wakes it up
+    """
+
+    def __init__(self, histogram: Histogram, gauge: Gauge, interval: float):
+        self.histogram = histogram
+        self.gauge = gauge
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - started - self.interval, 0.0)
+            self.histogram.observe(lag)
+            self.gauge.set(lag)
+
+
+def cache_metrics(caches: Dict[str, object]) -> List[Metric]:
+    """
+    metrics of TTLCache.stats() by cache name
+    :param caches: name -> cache
+    :return: list of metrics
+    """
+    size = Gauge('cache_entries', 'Entries in the cache', ('cache',))
+    maxsize = Gauge('cache_max_entries', 'Capacity of the cache', ('cache',))
+    hits = Counter('cache_hits_total', 'Cache lookups that found a value', ('cache',))
+    misses = Counter('cache_misses_total', 'Cache lookups that found nothing', ('cache',))
+    evictions = Counter('cache_evictions_total', 'Entries evicted by size', ('cache',))
+    for name, cache in caches.items():
+        stats = cache.stats()
+        size.set(stats['size'], name)
+        maxsize.set(stats['maxsize'], name)
+        hits.inc(name, amount=stats['hits'])
+        misses.inc(name, amount=stats['misses'])
+        evictions.inc(name, amount=stats['evictions'])
+    return [size, maxsize, hits, misses, evictions]
+
+
+registry = Registry()
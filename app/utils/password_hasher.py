@@ -0,0 +1,109 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from app.utils.metrics import Counter, Gauge, Metric
+
+
+class PasswordHasher:
+    """
+    Runs passlib hashing in a dedicated thread pool so bcrypt doesn't block the event loop.
+    At most max_concurrency calls run at once, others wait in queue up to queue_timeout seconds
+    and are rejected with 503 after that
+    """
+
+    def __init__(self, context: CryptContext, workers: int, max_concurrency: int, queue_timeout: float):
+        self.context = context
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._executor = None
+        self._semaphore = None
+        # metrics
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_run_ms = 0.0
+        self.max_run_ms = 0.0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(self.context.verify, password, hashed_password)
+
+    async def _run(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hasher')
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        start = time.perf_counter()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Server is busy, try again later'
+            )
+        finally:
+            self.queued -= 1
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._semaphore.release()
+            self.in_flight -= 1
+            self.completed += 1
+            run_ms = (time.perf_counter() - start) * 1000
+            self.total_run_ms += run_ms
+            self.max_run_ms = max(self.max_run_ms, run_ms)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._semaphore = None
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self.total_wait_ms / self.completed, 3) if self.completed else 0.0,
+            'max_wait_ms': round(self.max_wait_ms, 3),
+            'avg_run_ms': round(self.total_run_ms / self.completed, 3) if self.completed else 0.0,
+            'max_run_ms': round(self.max_run_ms, 3),
+        }
+
+    def collect_metrics(self) -> List[Metric]:
+        """
+        queue and hashing time for /metrics, built at scrape time
+        :return: list of metrics
+        """
+        calls = Gauge('password_hash_calls', 'Hashing calls by state', ('state',))
+        calls.set(self.in_flight, 'running')
+        calls.set(self.queued, 'queued')
+        completed = Counter('password_hash_completed_total', 'Hashing calls finished')
+        completed.inc(amount=self.completed)
+        rejected = Counter('password_hash_rejected_total', 'Hashing calls rejected with 503 after queue timeout')
+        rejected.inc(amount=self.rejected)
+        wait = Counter('password_hash_wait_seconds_total', 'Time hashing calls waited in queue')
+        wait.inc(amount=self.total_wait_ms / 1000)
+        run = Counter('password_hash_run_seconds_total', 'Time of hashing')
+        run.inc(amount=self.total_run_ms / 1000)
+        return [calls, completed, rejected, wait, run]
@@ -0,0 +1,126 @@
+from typing import Callable, Dict, FrozenSet, Hashable, List, NamedTuple, Optional, Set
+
+from app.config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+from app.utils.cache import TTLCache
+
+# tag of responses listing posts, their pages change when posts are added or deleted
+FEED = 'feed'
+# tag of search results, they change when an edited post starts or stops matching a query
+SEARCH = 'search'
+
+
+def post_tag(post_id) -> tuple:
+    return 'post', int(post_id)
+
+
+def user_tag(user_id) -> tuple:
+    return 'user', int(user_id)
+
+
+def blob_tag(uri: str) -> tuple:
+    return 'blob', uri
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    media_type: str
+    etag: str
+    # what the response shows, e.g. ('post', 1), ('user', 2), 'feed'
+    tags: FrozenSet[Hashable]
+
+
+class ResponseCache:
+    """
+    Serialized responses of read routes by route and parameters, for use from the event loop.
+
+    Entries are tagged by what they show and dropped by invalidate(tag) once a change is committed.
+    A response whose data was read before an invalidation of one of its tags is not stored,
+    so this process never serves data older than its last change, other workers do until the entry's ttl
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize, ttl, on_evict=self._forget)
+        # tag -> keys of entries showing it
+        self._keys: Dict[Hashable, Set[Hashable]] = {}
+        # invalidations counter, read it before reading the data of a response and pass it to set()
+        self.generation = 0
+        # tag -> generation of its last invalidation, cleared when it grows over maxsize
+        self._invalidated: Dict[Hashable, int] = {}
+        # responses read before the last clearing of _invalidated are not stored
+        self._floor = 0
+        self.invalidations = 0
+        self.not_modified = 0
+        self._listeners: List[Callable[[], None]] = []
+
+    def add_listener(self, listener: Callable[[], None]):
+        """
+        call listener on every invalidation, e.g. to stop sharing reads started before the change
+        """
+        self._listeners.append(listener)
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        return self.entries.get(key)
+
+    def set(self, key: Hashable, entry: CachedResponse, generation: int, ttl: Optional[float] = None) -> bool:
+        """
+        :param key:
+        :param entry:
+        :param generation: self.generation taken before the data of the response was read
+        :param ttl: seconds, default is the cache's ttl
+        :return: False if the entry isn't stored because its data may have been changed meanwhile
+        """
+        ttl = self.entries.ttl if ttl is None else ttl
+        if ttl <= 0 or self.entries.maxsize <= 0 or generation < self._floor \
+                or any(self._invalidated.get(tag, -1) > generation for tag in entry.tags):
+            return False
+        old = self.entries.pop(key)
+        if old is not None:
+            self._forget(key, old)
+        for tag in entry.tags:
+            self._keys.setdefault(tag, set()).add(key)
+        self.entries.set(key, entry, ttl)
+        return True
+
+    def invalidate(self, *tags: Hashable) -> int:
+        """
+        drop entries showing any of tags
+        :param tags:
+        :return: count of dropped entries
+        """
+        self.generation += 1
+        self.invalidations += 1
+        if len(self._invalidated) + len(tags) > self.entries.maxsize:
+            self._invalidated.clear()
+            self._floor = self.generation
+        dropped = 0
+        for tag in tags:
+            self._invalidated[tag] = self.generation
+            for key in self._keys.pop(tag, ()):
+                entry = self.entries.pop(key)
+                if entry is not None:
+                    self._forget(key, entry)
+                    dropped += 1
+        for listener in self._listeners:
+            listener()
+        return dropped
+
+    def _forget(self, key: Hashable, entry: CachedResponse):
+        for tag in entry.tags:
+            keys = self._keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[tag]
+
+    def clear(self):
+        self.generation += 1
+        self._floor = self.generation
+        self._invalidated.clear()
+        self._keys.clear()
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {**self.entries.stats(), 'invalidations': self.invalidations, 'not_modified': self.not_modified}
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first one runs in its own task, calls made before it
+    finishes wait for it and get the same result or exception. Nothing is kept after the call has finished.
+    A waiter cancelled (e.g. by a disconnected client) doesn't cancel the call for the others
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        # group -> [calls run, calls joined to a running one, failed runs]
+        self.counts: Dict[str, List[int]] = {}
+
+    async def do(self, group: str, key: Hashable, call: Callable[..., Awaitable], *args) -> Any:
+        """
+        :param group: name of the kind of call, counters are kept by it
+        :param key: arguments identifying the call within the group
+        :param call: coroutine function
+        :param args: arguments of call
+        :return: result of call
+        """
+        counts = self.counts.get(group)
+        if counts is None:
+            counts = self.counts[group] = [0, 0, 0]
+        key = (group, key)
+        future = self._flights.get(key)
+        if future is None:
+            counts[0] += 1
+            future = asyncio.ensure_future(call(*args))
+            self._flights[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done, counts))
+        else:
+            counts[1] += 1
+        return await asyncio.shield(future)
+
+    def forget(self):
+        """
+        make running calls private to their current waiters, later calls start anew
+        (e.g. after a change they have to see)
+        :return:
+        """
+        self._flights.clear()
+
+    def _finish(self, key: Hashable, future: asyncio.Future, counts: List[int]):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        # retrieves the exception, so it isn't reported as unhandled when every waiter has gone
+        if not future.cancelled() and future.exception() is not None:
+            counts[2] += 1
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        counters by group, ratio is the part of calls served by another one's result
+        """
+        return {group: {'calls': runs, 'shared': shared, 'errors': errors,
+                        'ratio': round(shared / (runs + shared), 3) if runs + shared else 0.0}
+                for group, (runs, shared, errors) in self.counts.items()}
@@ -0,0 +1,100 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from app.utils.log_settings import log
+
+
+class PeriodicTask:
+    """
+    Runs a coroutine function every interval seconds in background,
+    errors are logged and don't stop the loop
+    """
+
+    def __init__(self, func: Callable[[], Awaitable], interval: float):
+        self.func = func
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.func()
+            except Exception as e:
+                log.warning(e, exc_info=True)
+
+
+class BackgroundQueue:
+    """
+    Runs queued coroutine jobs one by one in background, errors are logged.
+    Jobs submitted before start() wait for it
+    """
+
+    def __init__(self, drain_timeout: float = 10.0):
+        self.drain_timeout = drain_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, func: Callable[..., Awaitable], *args):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._queue.put_nowait((func, args))
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        wait up to drain_timeout seconds for queued jobs and stop
+        :return:
+        """
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning(f'{self._queue.qsize()} background jobs are dropped on shutdown')
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            func, args = await self._queue.get()
+            try:
+                await func(*args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                log.warning(e, exc_info=True)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,10 @@
+"""
+End-to-end load tests of the API against a local Postgres.
+
+    python -m benchmarks seed --users 1000 --posts 10000 --likes 50000
+    python -m benchmarks run --concurrency 32 --requests 2000 --out before.json
+    python -m benchmarks compare before.json after.json
+
+The database is taken from DATABASE_URL like the app itself. Seeding truncates all tables,
+use a dedicated database.
+"""
@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import datetime
+import os
+import platform
+import subprocess
+import sys
+
+import orjson
+
+from benchmarks.load import SCENARIOS, compare, load_context, run_scenario
+from benchmarks.seed import Graph, seed
+
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+async def seed_command(args) -> int:
+    from app.config import DATABASE_URL
+
+    graph = Graph(args.users, args.posts, args.media_per_post, args.likes, args.follows, args.skew, args.days, args.seed)
+    counts = await seed(DATABASE_URL, graph)
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+    return 0
+
+
+async def run_command(args) -> int:
+    from app.config import DATABASE_URL
+
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"unknown scenarios: {', '.join(unknown)}, known: {', '.join(SCENARIOS)}", file=sys.stderr)
+        return 2
+    if args.url:
+        from benchmarks.clients import HTTPClient
+        client = HTTPClient(args.url, args.concurrency)
+    else:
+        from benchmarks.clients import ASGIClient
+        from app.main import app
+        client = ASGIClient(app)
+
+    results = {}
+    try:
+        async with client.lifespan():
+            ctx = await load_context(DATABASE_URL, client, args.auth_users, args.seed)
+            for name in names:
+                scenario = SCENARIOS[name]
+                if args.warmup:
+                    await run_scenario(client, scenario, ctx, args.warmup, args.concurrency,
+                                       offset=args.requests)
+                result = await run_scenario(client, scenario, ctx, args.requests, args.concurrency)
+                results[name] = result
+                latency = result['latency_ms']
+                print(f"{name:<18} {result['throughput_rps']:>9} rps  p50 {latency['p50']:>8} ms  "
+                      f"p95 {latency['p95']:>8} ms  p99 {latency['p99']:>8} ms  "
+                      f"errors {result['errors']}  db {result['db_ms_per_request']} ms/req  "
+                      f"queries/req {result['queries_per_request']}")
+    finally:
+        await client.close()
+
+    out = args.out or os.path.join(RESULTS_PATH, f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    report = {
+        'meta': {
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'mode': 'http' if args.url else 'in-process',
+            'url': args.url,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'posts': len(ctx.post_ids),
+            'users': len(ctx.logins),
+        },
+        'scenarios': results,
+    }
+    with open(out, 'wb') as f:
+        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    print(f'results: {out}')
+    return 0
+
+
+def compare_command(args) -> int:
+    with open(args.old, 'rb') as f:
+        old = orjson.loads(f.read())
+    with open(args.new, 'rb') as f:
+        new = orjson.loads(f.read())
+    lines, regressed = compare(old, new, args.threshold)
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='API load tests')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='truncate tables and fill them with a synthetic social graph')
+    defaults = Graph()
+    seed_parser.add_argument('--users', type=int, default=defaults.users)
+    seed_parser.add_argument('--posts', type=int, default=defaults.posts)
+    seed_parser.add_argument('--media-per-post', type=int, default=defaults.media_per_post)
+    seed_parser.add_argument('--likes', type=int, default=defaults.likes)
+    seed_parser.add_argument('--follows', type=int, default=defaults.follows)
+    seed_parser.add_argument('--skew', type=float, default=defaults.skew,
+                             help='Zipf exponent of likes over posts and follows over users, 0 spreads them evenly')
+    seed_parser.add_argument('--days', type=int, default=defaults.days)
+    seed_parser.add_argument('--seed', type=int, default=defaults.seed)
+
+    run_parser = commands.add_parser('run', help='drive the API and save results as JSON')
+    run_parser.add_argument('--url', help='base URL of a running server (needs httpx), '
+                                          'the app is run in-process if omitted')
+    run_parser.add_argument('--scenarios', help=f"comma-separated, default all: {', '.join(SCENARIOS)}")
+    run_parser.add_argument('--requests', type=int, default=2000, help='measured requests per scenario')
+    run_parser.add_argument('--warmup', type=int, default=100, help='unmeasured requests per scenario')
+    run_parser.add_argument('--concurrency', type=int, default=32)
+    run_parser.add_argument('--auth-users', type=int, default=20, help='users logged in for like/unlike')
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--out', help='results file, default benchmarks/results/<time>.json')
+
+    compare_parser = commands.add_parser('compare', help='compare two results, exit code 1 on regression')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='allowed relative drop of throughput or rise of p95')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        return compare_command(args)
+    if args.command == 'seed':
+        return asyncio.run(seed_command(args))
+    return asyncio.run(run_command(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlsplit
+
+# status, headers (lower-cased names), body
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class ASGIClient:
+    """
+    Sends requests straight to an ASGI app in the same event loop, no sockets or HTTP parsing
+    """
+    def __init__(self, app):
+        self.app = app
+
+    @asynccontextmanager
+    async def lifespan(self):
+        """
+        run the app's startup and shutdown events around the block
+        :return:
+        """
+        inbox: asyncio.Queue = asyncio.Queue()
+        outbox: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self.app({'type': 'lifespan', 'asgi': {'version': '3.0'}},
+                                            inbox.get, outbox.put))
+        await inbox.put({'type': 'lifespan.startup'})
+        message = await outbox.get()
+        if message['type'] != 'lifespan.startup.complete':
+            task.cancel()
+            raise RuntimeError(f"app startup is failed: {message.get('message')}")
+        try:
+            yield self
+        finally:
+            await inbox.put({'type': 'lifespan.shutdown'})
+            await outbox.get()
+            await task
+
+    async def request(self, method: str, url: str, body: Optional[bytes] = None,
+                      headers: Iterable[Tuple[str, str]] = ()) -> Response:
+        parts = urlsplit(url)
+        raw_headers = [(name.lower().encode(), value.encode()) for name, value in headers]
+        if body is not None:
+            raw_headers.append((b'content-length', str(len(body)).encode()))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'path': parts.path, 'raw_path': parts.path.encode(),
+            'query_string': parts.query.encode(), 'root_path': '', 'headers': raw_headers,
+            'client': ('127.0.0.1', 50000), 'server': ('benchmark', 80),
+        }
+        done = asyncio.Event()
+        sent = False
+        status = 500
+        response_headers: Dict[str, str] = {}
+        chunks = []
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body or b'', 'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                response_headers.update((name.decode().lower(), value.decode())
+                                        for name, value in message.get('headers', []))
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    done.set()
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            done.set()
+        return status, response_headers, b''.join(chunks)
+
+    async def close(self):
+        pass
+
+
+class HTTPClient:
+    """
+    Sends requests to a running server (python -m uvicorn app.main:app), needs httpx
+    """
+    def __init__(self, base_url: str, connections: int):
+        try:
+            import httpx
+        except ImportError:
+            raise SystemExit('benchmarking a running server needs httpx: pip install httpx')
+        self.client = httpx.AsyncClient(base_url=base_url, timeout=60,
+                                        limits=httpx.Limits(max_connections=connections,
+                                                            max_keepalive_connections=connections))
+
+    @asynccontextmanager
+    async def lifespan(self):
+        yield self
+
+    async def request(self, method: str, url: str, body: Optional[bytes] = None,
+                      headers: Iterable[Tuple[str, str]] = ()) -> Response:
+        res = await self.client.request(method, url, content=body, headers=list(headers))
+        return res.status_code, dict(res.headers), res.content
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,216 @@
+import asyncio
+import math
+import random
+import re
+import time
+from collections import Counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import asyncpg
+import orjson
+
+from benchmarks.seed import PASSWORD, WORDS
+
+# method, url, body, headers
+Request = Tuple[str, str, Optional[bytes], List[Tuple[str, str]]]
+JSON = [('content-type', 'application/json')]
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+class Context(NamedTuple):
+    post_ids: List[int]
+    logins: List[str]
+    # access tokens of some seeded users, for authorized routes
+    tokens: List[str]
+    seed: int
+
+
+class Scenario(NamedTuple):
+    name: str
+    # builds the n-th request of the run
+    make: Callable[[Context, int], Request]
+
+
+def rnd_for(ctx: Context, n: int) -> random.Random:
+    return random.Random(ctx.seed * 1_000_003 + n)
+
+
+def auth_request(login: str) -> Request:
+    body = orjson.dumps({'request': {'login': login, 'password': PASSWORD}})
+    return 'POST', '/v1/auth', body, JSON
+
+
+def feed_page(ctx: Context, n: int) -> Request:
+    page = rnd_for(ctx, n).randrange(max(len(ctx.post_ids) // 10, 1))
+    return 'GET', f'/v1/feed?limit=10&page={page}', None, []
+
+
+def feed_cursor(ctx: Context, n: int) -> Request:
+    return 'GET', '/v1/feed?limit=10&cursor=', None, []
+
+
+def feed_recommended(ctx: Context, n: int) -> Request:
+    return 'GET', '/v1/feed/recommended?limit=10', None, []
+
+
+def feed_home(ctx: Context, n: int) -> Request:
+    token = rnd_for(ctx, n).choice(ctx.tokens)
+    return 'GET', '/v1/feed/home?limit=10', None, [('authorization', f'Bearer {token}')]
+
+
+def feed_search(ctx: Context, n: int) -> Request:
+    # posts are made of the seeded words, so a search matches many of them and ranking them dominates
+    words = '+'.join(rnd_for(ctx, n).sample(WORDS, 2))
+    return 'GET', f'/v1/feed/search?q={words}&limit=10', None, []
+
+
+def feed_post(ctx: Context, n: int) -> Request:
+    return 'GET', f'/v1/feed/{rnd_for(ctx, n).choice(ctx.post_ids)}', None, []
+
+
+def feed_batch(ctx: Context, n: int) -> Request:
+    ids = ','.join(map(str, rnd_for(ctx, n).sample(ctx.post_ids, min(20, len(ctx.post_ids)))))
+    return 'GET', f'/v1/feed?ids={ids}', None, []
+
+
+def auth(ctx: Context, n: int) -> Request:
+    return auth_request(rnd_for(ctx, n).choice(ctx.logins))
+
+
+def like_unlike(ctx: Context, n: int) -> Request:
+    # requests 2k and 2k+1 like and unlike the same post by the same user
+    rnd = rnd_for(ctx, n // 2)
+    token = rnd.choice(ctx.tokens)
+    action = 'like' if n % 2 == 0 else 'unlike'
+    return 'POST', f'/v1/feed/{rnd.choice(ctx.post_ids)}/{action}', None, [('authorization', f'Bearer {token}')]
+
+
+SCENARIOS: Dict[str, Scenario] = {scenario.name: scenario for scenario in (
+    Scenario('feed_page', feed_page),
+    Scenario('feed_cursor', feed_cursor),
+    Scenario('feed_recommended', feed_recommended),
+    Scenario('feed_home', feed_home),
+    Scenario('feed_search', feed_search),
+    Scenario('feed_post', feed_post),
+    Scenario('feed_batch', feed_batch),
+    Scenario('auth', auth),
+    Scenario('like_unlike', like_unlike),
+)}
+
+
+def server_timing(headers: dict) -> Tuple[Optional[float], Optional[int]]:
+    """
+    database time and statements count from Server-Timing header of the response
+    :return: ms, queries or None, None if the header is missing
+    """
+    match = SERVER_TIMING.search(headers.get('server-timing', ''))
+    if match is None:
+        return None, None
+    return float(match.group(1)), int(match.group(2))
+
+
+async def load_context(database_url: str, client, auth_users: int, seed: int) -> Context:
+    """
+    read seeded ids and log in some users through the API
+    :return: Context
+    """
+    con = await asyncpg.connect(database_url)
+    try:
+        post_ids = [row['id'] for row in await con.fetch('select id from aesn_feed')]
+        logins = [row['login'] for row in await con.fetch("select login from aesn_users "
+                                                          "where login like 'bench\\_user\\_%' order by id")]
+    finally:
+        await con.close()
+    if not post_ids or not logins:
+        raise SystemExit('database has no seeded data, run: python -m benchmarks seed')
+    tokens = []
+    for login in random.Random(seed).sample(logins, min(auth_users, len(logins))):
+        status, _, body = await client.request(*auth_request(login))
+        if status != 200:
+            raise SystemExit(f'login of {login} is failed: {status} {body[:200]!r}')
+        data = orjson.loads(body)
+        tokens.append(data.get('payload', data)['access_token'])
+    return Context(post_ids, logins, tokens, seed)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values), max(1, math.ceil(p / 100 * len(values)))) - 1]
+
+
+async def run_scenario(client, scenario: Scenario, ctx: Context, requests: int, concurrency: int,
+                       offset: int = 0) -> dict:
+    """
+    send requests by concurrent workers and summarize them
+    :param offset: number of the first request, keeps warmup and measured requests different
+    :return: dict()
+    """
+    numbers = iter(range(offset, offset + requests))
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    # database time and statements of responses with Server-Timing header
+    timed = [0, 0.0, 0]
+
+    async def worker():
+        for n in numbers:
+            method, url, body, headers = scenario.make(ctx, n)
+            start = time.perf_counter()
+            status, response_headers, _ = await client.request(method, url, body, headers)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+            db_ms, queries = server_timing(response_headers)
+            if queries is not None:
+                timed[0] += 1
+                timed[1] += db_ms
+                timed[2] += queries
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        'requests': len(ms),
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(len(ms) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(sum(ms) / len(ms), 3) if ms else 0.0,
+            'p50': round(percentile(ms, 50), 3),
+            'p95': round(percentile(ms, 95), 3),
+            'p99': round(percentile(ms, 99), 3),
+            'max': round(ms[-1], 3) if ms else 0.0,
+        },
+        'db_ms_per_request': round(timed[1] / timed[0], 3) if timed[0] else None,
+        'queries_per_request': round(timed[2] / timed[0], 2) if timed[0] else None,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> Tuple[List[str], bool]:
+    """
+    compare two results by throughput and p95 latency
+    :param threshold: allowed relative change, e.g. 0.1
+    :return: report lines, True if any scenario has regressed
+    """
+    lines = [f"{'scenario':<18}{'rps old':>10}{'rps new':>10}{'p95 old':>10}{'p95 new':>10}"
+             f"{'q/req old':>11}{'q/req new':>11}"]
+    regressed = False
+    for name, result in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if before is None:
+            continue
+        rps_old, rps_new = before['throughput_rps'], result['throughput_rps']
+        p95_old, p95_new = before['latency_ms']['p95'], result['latency_ms']['p95']
+        flag = ''
+        if rps_new < rps_old * (1 - threshold) or p95_new > p95_old * (1 + threshold):
+            regressed = True
+            flag = '  REGRESSION'
+        lines.append(f'{name:<18}{rps_old:>10}{rps_new:>10}{p95_old:>10}{p95_new:>10}'
+                     f"{str(before.get('queries_per_request')):>11}{str(result.get('queries_per_request')):>11}"
+                     f'{flag}')
+    return lines, regressed
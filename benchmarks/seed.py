@@ -0,0 +1,133 @@
+import datetime
+import random
+from typing import List, NamedTuple
+
+import asyncpg
+from passlib.context import CryptContext
+
+from app.config import FEED_FANOUT_MAX_FOLLOWERS, FEED_TIMELINE_SIZE
+from app.db.migrations import migrate
+
+# every seeded user has this password
+PASSWORD = 'benchmark-password'
+TABLES = ('aesn_timelines', 'aesn_follows', 'aesn_likes', 'aesn_media', 'aesn_blobs', 'aesn_feed', 'aesn_users')
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+
+class Graph(NamedTuple):
+    users: int = 1000
+    posts: int = 10000
+    # media rows per post are 0..media_per_post
+    media_per_post: int = 2
+    likes: int = 50000
+    follows: int = 20000
+    # Zipf exponent of likes over posts and follows over users, 0 spreads them evenly
+    skew: float = 1.1
+    # days the posts' created_at are spread over
+    days: int = 30
+    seed: int = 42
+
+
+def login(i: int) -> str:
+    return f'bench_user_{i}'
+
+
+def text(rnd: random.Random, words: int) -> str:
+    return ' '.join(rnd.choice(WORDS) for _ in range(words))
+
+
+def pick_likes(rnd: random.Random, user_ids: List[int], post_ids: List[int], count: int,
+               skew: float) -> List[tuple]:
+    """
+    unique (user_id, post_id) pairs, posts are chosen by Zipf-like weights in random order
+    :return: list of (user_id, post_id)
+    """
+    count = min(count, len(user_ids) * len(post_ids))
+    ranked = post_ids[:]
+    rnd.shuffle(ranked)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(ranked))]
+    pairs = set()
+    while len(pairs) < count:
+        posts = rnd.choices(ranked, weights, k=count - len(pairs))
+        pairs.update((rnd.choice(user_ids), post_id) for post_id in posts)
+        # the most liked posts saturate first, fall back to even picks
+        if skew > 0 and len(pairs) < count:
+            skew = 0
+            weights = None
+    return list(pairs)[:count]
+
+
+async def seed(database_url: str, graph: Graph) -> dict:
+    """
+    migrate schema, truncate tables and fill them with a synthetic social graph
+    :param database_url:
+    :param graph:
+    :return: dict() of rows per table
+    """
+    rnd = random.Random(graph.seed)
+    now = datetime.datetime.utcnow()
+    con = await asyncpg.connect(database_url)
+    try:
+        await migrate(con)
+        await con.execute(f"truncate {', '.join(TABLES)} restart identity cascade")
+
+        password_hash = CryptContext(schemes=['bcrypt']).hash(PASSWORD)
+        await con.copy_records_to_table(
+            'aesn_users', columns=['login', 'hash', 'first_name', 'last_name', 'created_at'],
+            records=[(login(i), password_hash, 'Bench', 'User', now) for i in range(graph.users)])
+        user_ids = [row['id'] for row in await con.fetch('select id from aesn_users order by id')]
+
+        # ids grow with created_at like in a live feed
+        times = sorted(now - datetime.timedelta(seconds=rnd.uniform(0, graph.days * 86400))
+                       for _ in range(graph.posts))
+        await con.copy_records_to_table(
+            'aesn_feed', columns=['author_id', 'title', 'message', 'media_count', 'likes', 'created_at',
+                                  'updated_at'],
+            records=[(rnd.choice(user_ids), text(rnd, 4), text(rnd, 40), 0, 0, time, time) for time in times])
+        posts = await con.fetch('select id, author_id, created_at from aesn_feed order by id')
+        post_ids = [row['id'] for row in posts]
+
+        media = []
+        for post in posts:
+            for i in range(rnd.randint(0, graph.media_per_post)):
+                media.append((post['author_id'], post['id'], f"bench/{post['id']}/{i}.png", '.png', 0,
+                              post['created_at']))
+        await con.copy_records_to_table(
+            'aesn_media', columns=['author_id', 'post_id', 'uri', 'extension', 'likes', 'created_at'],
+            records=media)
+
+        likes = pick_likes(rnd, user_ids, post_ids, graph.likes, graph.skew)
+        await con.copy_records_to_table('aesn_likes', columns=['user_id', 'post_id'], records=likes)
+
+        # followees are picked by the same skew, so a few users have many followers
+        follows = [(follower, followee) for follower, followee
+                   in pick_likes(rnd, user_ids, user_ids, graph.follows, graph.skew) if follower != followee]
+        await con.copy_records_to_table('aesn_follows', columns=['follower_id', 'followee_id', 'created_at'],
+                                        records=[(follower, followee, now) for follower, followee in follows])
+        await con.execute('update aesn_users u set followers=c.count from '
+                          '(select followee_id, count(*) as count from aesn_follows group by followee_id) c '
+                          'where u.id=c.followee_id')
+        # timelines as fan-out on write would have built them
+        await con.execute('insert into aesn_timelines(user_id, post_id, author_id, created_at) '
+                          'select user_id, post_id, author_id, created_at from '
+                          '(select *, row_number() over (partition by user_id '
+                          'order by created_at desc, post_id desc) as n from '
+                          '(select author_id as user_id, id as post_id, author_id, created_at from aesn_feed '
+                          'union all '
+                          'select f.follower_id, p.id, p.author_id, p.created_at from aesn_follows f '
+                          'join aesn_users u on u.id=f.followee_id and u.followers<=$1 '
+                          'join aesn_feed p on p.author_id=f.followee_id) t) r '
+                          'where n<=$2', FEED_FANOUT_MAX_FOLLOWERS, FEED_TIMELINE_SIZE)
+
+        await con.execute('update aesn_feed f set media_count=c.count from '
+                          '(select post_id, count(*) as count from aesn_media group by post_id) c '
+                          'where f.id=c.post_id')
+        await con.execute('update aesn_feed f set likes=c.count from '
+                          '(select post_id, count(*) as count from aesn_likes group by post_id) c '
+                          'where f.id=c.post_id')
+        await con.execute(f"analyze {', '.join(TABLES)}")
+    finally:
+        await con.close()
+    return {'users': len(user_ids), 'posts': len(post_ids), 'media': len(media), 'likes': len(likes),
+            'follows': len(follows)}
@@ -0,0 +1,31 @@
+import pytest
+from fastapi import HTTPException
+
+from app.api.batch import batch_items, parse_ids
+from app.config import BATCH_MAX_IDS
+
+
+def test_parse_ids_keeps_order_and_duplicates():
+    assert parse_ids('3,1,2,3') == [3, 1, 2, 3]
+    assert parse_ids(' 5 , 6,, ') == [5, 6]
+
+
+@pytest.mark.parametrize('ids', ['', ',', ' , ', '1,a', '1.5', ','.join(['1'] * (BATCH_MAX_IDS + 1))])
+def test_invalid_ids_are_bad_request(ids):
+    with pytest.raises(HTTPException) as error:
+        parse_ids(ids)
+    assert error.value.status_code == 400
+
+
+def test_batch_of_max_size_is_accepted():
+    assert len(parse_ids(','.join(['1'] * BATCH_MAX_IDS))) == BATCH_MAX_IDS
+
+
+def test_batch_items_follow_requested_ids():
+    found = {1: {'id': 1, 'title': 'one'}, 3: {'id': 3, 'title': 'three'}}
+    assert batch_items([3, 2, 1, 3], found, 'post', 'Post not found') == [
+        {'id': 3, 'post': found[3], 'error': None},
+        {'id': 2, 'post': None, 'error': 'Post not found'},
+        {'id': 1, 'post': found[1], 'error': None},
+        {'id': 3, 'post': found[3], 'error': None},
+    ]
@@ -0,0 +1,71 @@
+import pytest
+
+from app.utils import cache as cache_module
+from app.utils.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'monotonic', clock)
+    return clock
+
+
+def test_get_counts_hits_and_misses(clock):
+    cache = TTLCache(2, 10)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b', 'default') == 'default'
+    assert cache.stats() == {'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_entries_expire(clock):
+    evicted = []
+    cache = TTLCache(2, 10, on_evict=lambda key, value: evicted.append((key, value)))
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    clock.now += 10
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert evicted == [('a', 1)]
+
+
+def test_least_recently_used_is_evicted(clock):
+    evicted = []
+    cache = TTLCache(2, 10, on_evict=lambda key, value: evicted.append(key))
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert evicted == ['b']
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_disabled_cache_stores_nothing(clock):
+    for cache in (TTLCache(0, 10), TTLCache(2, 0)):
+        cache.set('a', 1)
+        assert len(cache) == 0
+    cache = TTLCache(2, 10)
+    cache.set('a', 1, ttl=0)
+    assert cache.get('a') is None
+
+
+def test_pop_and_pop_where_do_not_call_on_evict(clock):
+    evicted = []
+    cache = TTLCache(5, 10, on_evict=lambda key, value: evicted.append(key))
+    for key, value in (('a', 1), ('b', 2), ('c', 3)):
+        cache.set(key, value)
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'gone') == 'gone'
+    assert cache.pop_where(lambda value: value >= 3) == 1
+    assert len(cache) == 1 and cache.get('b') == 2
+    assert evicted == []
@@ -0,0 +1,45 @@
+import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from app.db.repositories.feed_repository import FeedRepository
+
+
+def test_pack_cursor_is_url_safe_without_padding():
+    cursor = FeedRepository.pack_cursor('a?b/c', 1)
+    assert '=' not in cursor and '/' not in cursor and '+' not in cursor
+    assert FeedRepository.unpack_cursor(cursor, str, int) == ('a?b/c', 1)
+
+
+def test_page_cursor_round_trip():
+    created_at = datetime.datetime(2022, 9, 1, 12, 30, 15, 123456)
+    cursor = FeedRepository.encode_cursor(created_at, 42)
+    assert FeedRepository.decode_cursor(cursor) == (created_at, 42)
+
+
+def test_search_cursor_keeps_rank_exact():
+    rank = 0.1 + 0.2
+    cursor = FeedRepository.encode_search_cursor(rank, 7)
+    assert FeedRepository.decode_search_cursor(cursor) == (rank, 7)
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    'not base64!',
+    FeedRepository.pack_cursor('1', '2', '3'),
+    FeedRepository.pack_cursor('rank', 1),
+    FeedRepository.pack_cursor(0.5),
+    'gA',
+])
+def test_invalid_search_cursor_is_bad_request(cursor):
+    with pytest.raises(HTTPException) as error:
+        FeedRepository.decode_search_cursor(cursor)
+    assert error.value.status_code == 400
+    assert error.value.detail == 'Invalid cursor'
+
+
+def test_invalid_page_cursor_is_bad_request():
+    with pytest.raises(HTTPException) as error:
+        FeedRepository.decode_cursor(FeedRepository.pack_cursor('yesterday', 1))
+    assert error.value.status_code == 400
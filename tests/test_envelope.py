@@ -0,0 +1,37 @@
+from typing import Optional
+
+import pytest
+from fastapi import Request
+
+from app.api.envelope import accepts_json
+
+
+def request(accept: Optional[str]) -> Request:
+    headers = [] if accept is None else [(b'accept', accept.encode())]
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers})
+
+
+@pytest.mark.parametrize('accept', [
+    'application/json',
+    'Application/JSON',
+    'text/html, application/json; charset=utf-8',
+    'application/json;q=0.5',
+    'application/json ; Q=1',
+])
+def test_json_is_accepted(accept):
+    assert accepts_json(request(accept))
+
+
+@pytest.mark.parametrize('accept', [
+    None,
+    '',
+    '*/*',
+    'application/*',
+    'text/html',
+    'application/jsonp',
+    'application/json;q=0',
+    'application/json;q=0.0',
+    'application/json;q=abc',
+])
+def test_json_is_not_accepted(accept):
+    assert not accepts_json(request(accept))
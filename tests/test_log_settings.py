@@ -0,0 +1,81 @@
+import logging
+import queue
+
+import pytest
+
+from app.utils import log_settings
+from app.utils.log_settings import JSONFormatter, LogWriter, RateLimitFilter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(log_settings.time, 'monotonic', clock)
+    return clock
+
+
+def record(message, *args, line: int = 1, **extra) -> logging.LogRecord:
+    res = logging.LogRecord('test', logging.WARNING, 'test.py', line, message, args, None)
+    res.__dict__.update(extra)
+    return res
+
+
+def test_burst_passes_then_records_are_suppressed(clock):
+    log_filter = RateLimitFilter(1, 2)
+    assert [log_filter.filter(record('e')) for _ in range(3)] == [True, True, False]
+
+
+def test_next_passed_record_tells_suppressed_count(clock):
+    log_filter = RateLimitFilter(1, 1)
+    assert log_filter.filter(record('e'))
+    assert not log_filter.filter(record('e'))
+    assert not log_filter.filter(record('e'))
+    clock.now += 1
+    passed = record('error %s', 'x')
+    assert log_filter.filter(passed)
+    assert passed.getMessage() == 'error x (2 similar suppressed)'
+    clock.now += 1
+    passed = record('e')
+    assert log_filter.filter(passed)
+    assert passed.getMessage() == 'e'
+
+
+def test_call_sites_and_rate_keys_have_own_buckets(clock):
+    log_filter = RateLimitFilter(1, 1)
+    assert log_filter.filter(record('e', line=1))
+    assert log_filter.filter(record('e', line=2))
+    assert not log_filter.filter(record('e', line=1))
+    assert log_filter.filter(record('e', line=1, rate_key='other'))
+
+
+def test_zero_rate_passes_everything(clock):
+    log_filter = RateLimitFilter(0, 1)
+    assert all(log_filter.filter(record('e')) for _ in range(10))
+
+
+def test_writer_counts_encode_and_write_errors():
+    class Broken:
+        def __str__(self):
+            raise ValueError('broken')
+
+    def failing(data: bytes):
+        raise OSError('disk full')
+
+    written = []
+    records = queue.Queue()
+    writer = LogWriter(records, JSONFormatter(), [(logging.NOTSET, failing), (logging.ERROR, written.append)], 10)
+    for item in (record('warning'), record(Broken()), logging.LogRecord('test', logging.ERROR, 'test.py', 1,
+                                                                        'error', None, None), LogWriter._stop):
+        records.put(item)
+    writer._run()
+    assert writer.encode_errors == 1
+    assert writer.write_errors == 1
+    assert written[0].count(b'\n') == 1 and b'"error"' in written[0]
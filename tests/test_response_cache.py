@@ -0,0 +1,72 @@
+from app.utils.response_cache import FEED, CachedResponse, ResponseCache, post_tag, user_tag
+
+
+def entry(*tags) -> CachedResponse:
+    return CachedResponse(b'{}', 'application/json', '"etag"', frozenset(tags))
+
+
+def test_tags():
+    assert post_tag('3') == ('post', 3)
+    assert user_tag(4) == ('user', 4)
+
+
+def test_invalidate_drops_entries_showing_the_tag():
+    cache = ResponseCache(10, 60)
+    assert cache.set('post:1', entry(post_tag(1)), cache.generation)
+    assert cache.set('feed', entry(FEED, post_tag(1), post_tag(2)), cache.generation)
+    assert cache.set('user:1', entry(user_tag(1)), cache.generation)
+    assert cache.invalidate(post_tag(1)) == 2
+    assert cache.get('post:1') is None and cache.get('feed') is None
+    assert cache.get('user:1') is not None
+    assert cache.invalidate(post_tag(1), post_tag(2)) == 0
+
+
+def test_response_read_before_invalidation_is_not_stored():
+    cache = ResponseCache(10, 60)
+    generation = cache.generation
+    cache.invalidate(post_tag(1))
+    assert not cache.set('post:1', entry(post_tag(1)), generation)
+    assert cache.set('post:2', entry(post_tag(2)), generation)
+    assert cache.set('post:1', entry(post_tag(1)), cache.generation)
+
+
+def test_replaced_entry_forgets_its_old_tags():
+    cache = ResponseCache(10, 60)
+    cache.set('key', entry(post_tag(1)), cache.generation)
+    cache.set('key', entry(post_tag(2)), cache.generation)
+    assert cache.invalidate(post_tag(1)) == 0
+    assert cache.get('key') is not None
+    assert cache.invalidate(post_tag(2)) == 1
+
+
+def test_evicted_entry_forgets_its_tags():
+    cache = ResponseCache(1, 60)
+    cache.set('a', entry(post_tag(1)), cache.generation)
+    cache.set('b', entry(post_tag(2)), cache.generation)
+    assert cache.get('a') is None
+    assert post_tag(1) not in cache._keys
+    assert cache.invalidate(post_tag(1)) == 0
+
+
+def test_forgotten_invalidations_block_older_responses():
+    cache = ResponseCache(2, 60)
+    generation = cache.generation
+    cache.invalidate(post_tag(1), post_tag(2), post_tag(3))
+    assert not cache.set('post:4', entry(post_tag(4)), generation)
+    assert cache.set('post:4', entry(post_tag(4)), cache.generation)
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(10, 0)
+    assert not cache.set('key', entry(FEED), cache.generation)
+    assert cache.get('key') is None
+
+
+def test_listeners_are_called_on_invalidation():
+    cache = ResponseCache(10, 60)
+    calls = []
+    cache.add_listener(lambda: calls.append(1))
+    cache.invalidate(FEED)
+    cache.invalidate()
+    assert calls == [1, 1]
+    assert cache.stats()['invalidations'] == 2
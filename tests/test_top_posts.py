@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from app.db.top_posts import TopPostsIndex
+
+
+def post(post_id: int, likes: int) -> dict:
+    return {'id': post_id, 'likes': likes, 'title': f'post {post_id}'}
+
+
+def ids(posts) -> list:
+    return [row['id'] for row in posts]
+
+
+def test_not_seeded_index_does_not_answer():
+    assert TopPostsIndex(3).top(1) is None
+
+
+def test_limit_has_to_be_positive():
+    index = TopPostsIndex(3)
+    index.seed([post(1, 5)])
+    with pytest.raises(ValueError):
+        index.top(0)
+
+
+def test_top_is_ordered_by_likes_then_id():
+    index = TopPostsIndex(5)
+    index.seed([post(3, 7), post(1, 5), post(2, 5)])
+    assert index.floor is None
+    assert ids(index.top(3)) == [3, 2, 1]
+    assert ids(index.top(10)) == [3, 2, 1]
+
+
+def test_full_index_does_not_answer_over_its_size():
+    index = TopPostsIndex(2)
+    index.seed([post(1, 9), post(2, 8)])
+    assert index.floor == 8
+    assert ids(index.top(2)) == [1, 2]
+    assert index.top(3) is None
+
+
+def test_returned_posts_are_copies():
+    index = TopPostsIndex(2)
+    index.seed([post(1, 9)])
+    index.top(1)[0]['likes'] = 0
+    assert index.top(1)[0]['likes'] == 9
+
+
+def test_add_over_size_evicts_lowest_and_raises_floor():
+    index = TopPostsIndex(2)
+    index.seed([post(1, 9)])
+    index.add(post(2, 3))
+    index.add(post(3, 5))
+    assert ids(index.top(2)) == [1, 3]
+    assert index.floor == 3
+    index.add(post(4, 3))
+    assert ids(index.top(2)) == [1, 3]
+
+
+def test_update_and_remove():
+    index = TopPostsIndex(3)
+    index.seed([post(1, 9), post(2, 4)])
+    index.update(1, {'title': 'edited'})
+    index.update(5, {'title': 'missing'})
+    index.remove(2)
+    assert index.top(3) == [{'id': 1, 'likes': 9, 'title': 'edited'}]
+
+
+def test_set_likes_reorders_and_drops_under_floor():
+    index = TopPostsIndex(2)
+    index.seed([post(1, 9), post(2, 8)])
+
+    async def load(post_id):
+        raise AssertionError('posts in the index are not loaded')
+
+    asyncio.run(index.set_likes(2, 10, load))
+    assert ids(index.top(2)) == [2, 1]
+    asyncio.run(index.set_likes(1, 7, load))
+    assert ids(index.top(1)) == [2]
+    assert index.top(2) is None
+
+
+def test_set_likes_loads_post_entering_index():
+    index = TopPostsIndex(2)
+    index.seed([post(1, 9), post(2, 8)])
+    loaded = []
+
+    async def load(post_id):
+        loaded.append(post_id)
+        return post(post_id, 0)
+
+    asyncio.run(index.set_likes(3, 8, load))
+    assert loaded == []
+    asyncio.run(index.set_likes(3, 12, load))
+    assert loaded == [3]
+    assert ids(index.top(2)) == [3, 1]
+    assert index.top(1)[0]['likes'] == 12